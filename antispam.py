@@ -4,6 +4,9 @@ import discord
 
 from discord.ext import commands
 
+import db
+import metrics
+
 class GuildAntispamEngine:
     def __init__(self, guild: discord.Guild):
         self.guild = guild
@@ -46,6 +49,9 @@ class GuildAntispamEngine:
 
     async def _do_user_mute(self, member: discord.Member, channel: discord.abc.Messageable) -> None:
         await member.timeout(timedelta(days=28), reason='Anti-Spam Engine')
+        metrics.antispam_detections.inc('muted')
+        db.add_case(member.guild, member.id, member.guild.me.id, 'antispam mute', 'Anti-Spam Engine',
+                    int(timedelta(days=28).total_seconds()))
 
         embed = discord.Embed()
         embed.title = 'Anti-Spam'
@@ -66,6 +72,7 @@ class GuildAntispamEngine:
         message_is_sus = self._is_sus(message)
 
         if message_is_sus:
+            metrics.antispam_detections.inc('suspicious')
             if message.author.id not in self.users_sus_count:
                 self.users_sus_count[message.author.id] = 1
             else:
@@ -0,0 +1,88 @@
+"""Compare the old linear ban reconciliation against db.SavedBanIndex on synthetic months.
+
+Run from the repository root with `python -m benchmarks.ban_matching`; uses a temporary database.
+"""
+import os
+import random
+import tempfile
+import time
+from datetime import datetime, timezone, timedelta
+from typing import List
+
+os.environ['DB_FILENAME'] = os.path.join(tempfile.mkdtemp(), 'bench.db')
+
+import db
+
+MONTH_START = datetime(2025, 1, 1, tzinfo=timezone.utc)
+
+
+def make_month(ban_count: int) -> tuple[List[db.AuditLogBan], List[db.SavedBan]]:
+    audit_log_bans = []
+    saved_bans = []
+    for index in range(ban_count):
+        banned_time = MONTH_START + timedelta(seconds=random.randrange(30 * 24 * 3600))
+
+        audit_log_ban = db.AuditLogBan()
+        audit_log_ban.entry_id = index
+        audit_log_ban.banned_user_id = random.randrange(ban_count * 10)
+        audit_log_ban.responsible_mod_id = random.randrange(20)
+        audit_log_ban.banned_time = banned_time
+        audit_log_bans.append(audit_log_ban)
+
+        # Most bans also have a DB entry, written a few seconds apart from the audit log entry
+        if random.random() < 0.9:
+            saved_ban = db.SavedBan()
+            saved_ban.banned_user_id = audit_log_ban.banned_user_id
+            saved_ban.responsible_mod_id = audit_log_ban.responsible_mod_id
+            saved_ban.banned_time = banned_time + timedelta(seconds=random.uniform(-5, 5))
+            saved_bans.append(saved_ban)
+    return audit_log_bans, saved_bans
+
+
+def match_linear(audit_log_bans: List[db.AuditLogBan], saved_bans: List[db.SavedBan]) -> int:
+    # The reconciliation banstats used before SavedBanIndex
+    saved_bans = list(saved_bans)
+    matched = 0
+    for audit_log_ban in audit_log_bans:
+        closest = None
+        for saved_ban in saved_bans:
+            if saved_ban.banned_user_id == audit_log_ban.banned_user_id and abs(
+                    (audit_log_ban.banned_time - saved_ban.banned_time).total_seconds()) <= 20:
+                if closest is None or abs((audit_log_ban.banned_time - saved_ban.banned_time).total_seconds()) < abs(
+                        (audit_log_ban.banned_time - closest.banned_time).total_seconds()):
+                    closest = saved_ban
+        if closest is not None:
+            saved_bans.remove(closest)
+            matched += 1
+    return matched
+
+
+def match_indexed(audit_log_bans: List[db.AuditLogBan], saved_bans: List[db.SavedBan]) -> int:
+    index = db.SavedBanIndex(saved_bans)
+    matched = 0
+    for audit_log_ban in audit_log_bans:
+        if index.pop_closest(audit_log_ban.banned_user_id, audit_log_ban.banned_time) is not None:
+            matched += 1
+    return matched
+
+
+def main() -> None:
+    random.seed(0)
+    for ban_count in [1_000, 10_000]:
+        audit_log_bans, saved_bans = make_month(ban_count)
+
+        start = time.perf_counter()
+        linear_matched = match_linear(audit_log_bans, saved_bans)
+        linear_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        indexed_matched = match_indexed(audit_log_bans, saved_bans)
+        indexed_time = time.perf_counter() - start
+
+        assert linear_matched == indexed_matched
+        print(f'{ban_count} bans ({indexed_matched} matched): linear {linear_time * 1000:.1f}ms, '
+              f'indexed {indexed_time * 1000:.1f}ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+"""Compare the memory the discord.py cache takes with each cache_policy profile, on synthetic guilds.
+
+Guilds are fed into the client state the way the gateway would deliver them: members of large guilds only arrive if
+the profile chunks, and presences only with the presences intent. The message cache is filled to max_messages.
+
+Run from the repository root with `python -m benchmarks.cache_memory`.
+"""
+import gc
+import tracemalloc
+
+import discord
+
+import cache_policy
+
+# (amount of guilds, members per guild); Discord calls guilds of more than 250 members large
+GUILD_SIZES = [(5, 20_000), (50, 1_000), (200, 50)]
+LARGE_THRESHOLD = 250
+SELF_ID = 1
+
+
+def make_guild_payload(guild_id: int, member_count: int, chunked: bool, presences: bool) -> dict:
+    large = member_count > LARGE_THRESHOLD
+    member_ids = range(guild_id * 100_000, guild_id * 100_000 + member_count)
+    # Large guilds only send their members when they are chunked
+    sent_member_ids = member_ids if chunked or not large else []
+
+    return {
+        'id': str(guild_id),
+        'name': f'Guild {guild_id}',
+        'owner_id': str(SELF_ID),
+        'member_count': member_count,
+        'large': large,
+        'features': [],
+        'roles': [{'id': str(guild_id), 'name': '@everyone', 'permissions': '0', 'position': 0, 'color': 0,
+                   'hoist': False, 'managed': False, 'mentionable': False}],
+        'channels': [{'id': str(guild_id + 1), 'type': 0, 'name': 'general', 'position': 0,
+                      'permission_overwrites': []}],
+        'members': [{'user': {'id': str(member_id), 'username': f'user{member_id}', 'discriminator': '0',
+                              'global_name': f'User {member_id}', 'avatar': None},
+                     'roles': [], 'joined_at': '2024-01-01T00:00:00+00:00', 'deaf': False, 'mute': False,
+                     'nick': None, 'flags': 0} for member_id in sent_member_ids],
+        'presences': [{'user': {'id': str(member_id)}, 'status': 'online', 'client_status': {'desktop': 'online'},
+                       'activities': [{'name': 'A game', 'type': 0}]} for member_id in sent_member_ids]
+        if presences else [],
+        'voice_states': [],
+    }
+
+
+def make_message(state, channel: discord.TextChannel, message_id: int) -> discord.Message:
+    return discord.Message(state=state, channel=channel, data={
+        'id': str(message_id), 'channel_id': str(channel.id), 'type': 0, 'content': 'Some message content ' * 5,
+        'author': {'id': str(message_id), 'username': 'someone', 'discriminator': '0', 'avatar': None},
+        'timestamp': '2024-01-01T00:00:00+00:00', 'edited_timestamp': None, 'tts': False, 'mention_everyone': False,
+        'mentions': [], 'mention_roles': [], 'attachments': [], 'embeds': [], 'pinned': False,
+    })
+
+
+def measure(profile_name: str) -> tuple[int, int]:
+    options = cache_policy.get_client_options(profile_name)
+    client = discord.Client(**options)
+    state = client._connection
+    state.user = discord.ClientUser(state=state, data={'id': str(SELF_ID), 'username': 'bot', 'discriminator': '0',
+                                                       'avatar': None, 'bot': True})
+
+    gc.collect()
+    tracemalloc.start()
+    start, _ = tracemalloc.get_traced_memory()
+
+    guild_id = 10
+    for guild_count, member_count in GUILD_SIZES:
+        for _ in range(guild_count):
+            payload = make_guild_payload(guild_id, member_count, options['chunk_guilds_at_startup'],
+                                         options['intents'].presences)
+            state._add_guild_from_data(payload)
+            del payload
+            guild_id += 10
+
+    if state._messages is not None:
+        channel = state.guilds[0].text_channels[0]
+        for message_id in range(state.max_messages):
+            state._messages.append(make_message(state, channel, 10**15 + message_id))
+
+    gc.collect()
+    end, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    cached_members = sum(len(guild.members) for guild in state.guilds)
+    return end - start, cached_members
+
+
+def main() -> None:
+    for profile_name in cache_policy.PROFILES:
+        used, cached_members = measure(profile_name)
+        print(f'{profile_name}: {used / 1024 / 1024:.1f}MB, {cached_members} members cached')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+"""Compare the exact unique active user query against the HyperLogLog estimate.
+
+Run from the repository root with `python -m benchmarks.unique_users`; uses a temporary database.
+"""
+import os
+import random
+import tempfile
+import time
+import types
+from datetime import datetime, timezone
+
+os.environ['DB_FILENAME'] = os.path.join(tempfile.mkdtemp(), 'bench.db')
+
+import db
+
+GUILD_ID = 1
+USER_POOL = 200_000
+USERS_PER_DAY = 5_000
+DAYS = 365
+
+
+def exact_unique_active_users(guild_id: int, first_day: int, last_day: int) -> int:
+    cursor = db.sqlite_db.cursor()
+    cursor.execute('SELECT COUNT(DISTINCT user_id) FROM user_activity WHERE guild = ? AND days_since_epoch BETWEEN ? AND ?',
+                   (guild_id, first_day, last_day))
+    res = cursor.fetchone()[0]
+    cursor.close()
+    return res
+
+
+def main() -> None:
+    random.seed(0)
+    today = (datetime.now(timezone.utc) - datetime(1970, 1, 1, tzinfo=timezone.utc)).days
+
+    print(f'Generating {DAYS} days of {USERS_PER_DAY} active users out of {USER_POOL}...')
+    rows = []
+    for day in range(today - DAYS + 1, today + 1):
+        for user_id in random.sample(range(USER_POOL), USERS_PER_DAY):
+            rows.append((GUILD_ID, 10 ** 17 + user_id, day, 0, 0))
+    db.sqlite_db.executemany('INSERT INTO user_activity VALUES (?, ?, ?, ?, ?)', rows)
+    db.sqlite_db.commit()
+    db.rebuild_activity_sketches()
+
+    guild = types.SimpleNamespace(id=GUILD_ID)
+    for days in [30, 365]:
+        start = time.perf_counter()
+        exact = exact_unique_active_users(GUILD_ID, today - days + 1, today)
+        exact_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        estimate = db.get_unique_active_user_estimate(guild, days)
+        estimate_time = time.perf_counter() - start
+
+        print(f'{days:>3} days: exact {exact} in {exact_time * 1000:.1f}ms, '
+              f'estimate {estimate} in {estimate_time * 1000:.1f}ms '
+              f'({(estimate - exact) / exact * 100:+.2f}%)')
+
+
+if __name__ == '__main__':
+    main()
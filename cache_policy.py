@@ -0,0 +1,64 @@
+import os
+
+import discord
+
+# CACHE_PROFILE picks the defaults:
+# - full: every intent, every member cached and chunked at startup, 1000 cached messages; what the bot always did
+# - lean: no presences, only members Discord sends on its own are cached, no chunking, 100 cached messages.
+#   Status fields in /info are left out, and member updates are only logged for members that are cached.
+# Each setting can also be overridden on its own with the environment variables read below.
+PROFILES = {
+    'full': {
+        'presences': True,
+        'member_cache': 'all',
+        'max_messages': 1000,
+        'chunk_guilds_at_startup': True,
+    },
+    'lean': {
+        'presences': False,
+        'member_cache': 'joined',
+        'max_messages': 100,
+        'chunk_guilds_at_startup': False,
+    },
+}
+
+MEMBER_CACHE_FLAGS = {
+    'all': discord.MemberCacheFlags.all,
+    'joined': lambda: discord.MemberCacheFlags(joined=True, voice=False),
+    'voice': lambda: discord.MemberCacheFlags(joined=False, voice=True),
+    'none': discord.MemberCacheFlags.none,
+}
+
+
+def _get_setting(profile: dict, name: str, env_name: str):
+    if env_name not in os.environ:
+        return profile[name]
+
+    value = os.environ[env_name]
+    if isinstance(profile[name], bool):
+        return value == '1'
+    if isinstance(profile[name], int):
+        return int(value)
+    return value
+
+
+def get_client_options(profile_name: str | None = None) -> dict:
+    """Get the intents and cache keyword arguments for the bot, for a profile and the overrides in the environment."""
+    profile = PROFILES[profile_name or os.environ.get('CACHE_PROFILE', 'full')]
+
+    intents = discord.Intents.all()
+    intents.presences = _get_setting(profile, 'presences', 'INTENTS_PRESENCES')
+
+    member_cache = _get_setting(profile, 'member_cache', 'MEMBER_CACHE')
+    if member_cache not in MEMBER_CACHE_FLAGS:
+        raise ValueError(f'MEMBER_CACHE must be one of {', '.join(MEMBER_CACHE_FLAGS)}, not {member_cache}')
+
+    # 0 turns the message cache off; edits and deletes are then logged from the DB only
+    max_messages = _get_setting(profile, 'max_messages', 'MAX_MESSAGES')
+
+    return {
+        'intents': intents,
+        'member_cache_flags': MEMBER_CACHE_FLAGS[member_cache](),
+        'max_messages': max_messages if max_messages > 0 else None,
+        'chunk_guilds_at_startup': _get_setting(profile, 'chunk_guilds_at_startup', 'CHUNK_GUILDS_AT_STARTUP'),
+    }
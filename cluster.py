@@ -0,0 +1,119 @@
+"""Run the bot as several processes, each running its own range of shards on its own core.
+
+Start with `python cluster.py` instead of `python main.py`. CLUSTER_PROCESSES sets the amount of processes (default:
+the amount of cores), and SHARD_COUNT the total amount of shards (default: what Discord recommends). Workers that exit
+are restarted.
+"""
+import asyncio
+import logging
+import os
+import secrets
+import signal
+import sys
+from time import monotonic
+from typing import List
+
+import aiohttp
+
+# Runs the DB migrations and rebuilds once, before any worker opens the DB
+import db
+import log_setup
+
+_log = logging.getLogger(__name__)
+
+main_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.py')
+
+
+async def get_recommended_shard_count(token: str) -> int:
+    async with aiohttp.ClientSession() as session:
+        async with session.get('https://discord.com/api/v10/gateway/bot',
+                               headers={'Authorization': f'Bot {token}'}) as response:
+            response.raise_for_status()
+            return (await response.json())['shards']
+
+
+def split_shards(shard_count: int, process_count: int) -> List[List[int]]:
+    # Contiguous ranges; if the shards do not divide evenly, the first processes get one more
+    per_process, remainder = divmod(shard_count, process_count)
+    ranges = []
+    first_shard = 0
+    for cluster_id in range(process_count):
+        size = per_process + (1 if cluster_id < remainder else 0)
+        ranges.append(list(range(first_shard, first_shard + size)))
+        first_shard += size
+    return [shard_ids for shard_ids in ranges if len(shard_ids) > 0]
+
+
+class Worker:
+    def __init__(self, cluster_id: int, shard_ids: List[int], env: dict[str, str]):
+        self.cluster_id = cluster_id
+        self.shard_ids = shard_ids
+        self.env = env
+        self.process: asyncio.subprocess.Process | None = None
+
+    async def run(self, stopping: asyncio.Event) -> None:
+        backoff = 1
+        while not stopping.is_set():
+            _log.info('Starting cluster %s with shards %s', self.cluster_id, self.shard_ids)
+            started = monotonic()
+            self.process = await asyncio.create_subprocess_exec(sys.executable, main_path, env=self.env)
+            return_code = await self.process.wait()
+            if stopping.is_set():
+                break
+
+            # Only back off further if the worker keeps crashing right away
+            if monotonic() - started > 60:
+                backoff = 1
+            _log.warning('Cluster %s exited with %s; restarting in %ss', self.cluster_id, return_code, backoff)
+            try:
+                await asyncio.wait_for(stopping.wait(), timeout=backoff)
+            except asyncio.TimeoutError:
+                pass
+            backoff = min(backoff * 2, 60)
+
+    def stop(self) -> None:
+        if self.process is not None and self.process.returncode is None:
+            self.process.terminate()
+
+
+async def main() -> None:
+    process_count = int(os.environ.get('CLUSTER_PROCESSES', str(os.cpu_count() or 1)))
+    shard_count = int(os.environ['SHARD_COUNT']) if 'SHARD_COUNT' in os.environ \
+        else await get_recommended_shard_count(os.environ['BOT_TOKEN'])
+
+    base_env = dict(os.environ)
+    base_env['SHARD_COUNT'] = str(shard_count)
+    # Purge log links are made by every worker, but served by the first one, so they need to share the secret
+    base_env.setdefault('PURGE_LOGS_HTTP_SECRET', secrets.token_hex(32))
+    # Workers share the DB; a batch of uncommitted activity writes would lock out all other workers until committed
+    base_env.setdefault('DB_BATCHED_COMMIT_SECONDS', '0')
+
+    workers = []
+    for cluster_id, shard_ids in enumerate(split_shards(shard_count, process_count)):
+        env = dict(base_env)
+        env['CLUSTER_ID'] = str(cluster_id)
+        env['SHARD_IDS'] = ','.join(str(shard_id) for shard_id in shard_ids)
+        workers.append(Worker(cluster_id, shard_ids, env))
+    _log.info('Running %s shards in %s processes', shard_count, len(workers))
+
+    stopping = asyncio.Event()
+
+    def stop() -> None:
+        stopping.set()
+        for worker in workers:
+            worker.stop()
+
+    loop = asyncio.get_running_loop()
+    loop.add_signal_handler(signal.SIGINT, stop)
+    loop.add_signal_handler(signal.SIGTERM, stop)
+
+    await asyncio.gather(*(worker.run(stopping) for worker in workers))
+    db.sqlite_db.close()
+
+
+if __name__ == '__main__':
+    log_setup.setup()
+    try:
+        asyncio.run(main())
+    finally:
+        log_setup.stop()
@@ -90,4 +90,7 @@ class ConfigCog(commands.Cog):
     async def ping(self, ctx: commands.Context) -> None:
         embed = discord.Embed(title='Pong!', colour=discord.Colour.blue())
         embed.description = f'Latency: {round(self.bot.latency * 1000)}ms'
+        if ctx.guild is not None and self.bot.get_shard(ctx.guild.shard_id) is not None:
+            embed.description += (f'\nShard {ctx.guild.shard_id}: '
+                                  f'{round(self.bot.get_shard(ctx.guild.shard_id).latency * 1000)}ms')
         await ctx.send(embed=embed)
@@ -1,11 +1,16 @@
+import logging
 import sqlite3
 import os
+from bisect import bisect_left
 from typing import List
 
 import discord
-from datetime import datetime, timezone
+from datetime import datetime, timezone, date, timedelta
 
-from pprint import pprint
+from hyperloglog import HyperLogLog
+import metrics
+
+_log = logging.getLogger(__name__)
 
 def column_exists(table_name: str, column_name: str) -> bool:
     cursor = sqlite_db.cursor()
@@ -44,42 +49,326 @@ def ensure_config_columns():
             add_column('config', column_name, column_type, default)
 
 
-sqlite_db = sqlite3.connect(os.environ.get('DB_FILENAME', 'gargibot.db'))
+# In cluster mode (see cluster.py) several processes share the DB. WAL lets them read while another one writes, and
+# writers wait up to DB_BUSY_TIMEOUT seconds for each other instead of failing.
+sqlite_db = sqlite3.connect(os.environ.get('DB_FILENAME', 'gargibot.db'),
+                            timeout=float(os.environ.get('DB_BUSY_TIMEOUT', '5')))
+sqlite_db.execute('PRAGMA journal_mode=WAL')
+sqlite_db.execute('PRAGMA synchronous=NORMAL')
+# Activity writes are committed at most this often. An uncommitted batch holds the write lock of the whole DB, so the
+# cluster launcher sets this to 0; with WAL, single commits are cheap enough.
+batched_commit_seconds = float(os.environ.get('DB_BATCHED_COMMIT_SECONDS', '10'))
 sqlite_db.execute('CREATE TABLE IF NOT EXISTS config(guild ID PRIMARY KEY)')
+# Bot wide values that have to survive restarts, such as the hash of the last synced command tree
+sqlite_db.execute('CREATE TABLE IF NOT EXISTS bot_state(key STRING PRIMARY KEY, value STRING)')
 ensure_config_columns()
 sqlite_db.execute('CREATE TABLE IF NOT EXISTS messages(message_id ID NOT NULL PRIMARY KEY, contents STRING, '
                   'author_id ID NOT NULL, created_at TIMESTAMP NOT NULL)')
 sqlite_db.execute('CREATE TABLE IF NOT EXISTS ban_owners(guild ID, banned_user ID, responsible_mod ID, '
                   'banned_time EPOCH)')
+# Local copy of the ban entries of each guild's audit log, synced incrementally from the newest entry ID we have seen
+sqlite_db.execute('CREATE TABLE IF NOT EXISTS audit_log_bans(entry_id ID PRIMARY KEY, guild ID, banned_user ID, '
+                  'responsible_mod ID, banned_time EPOCH)')
+sqlite_db.execute('CREATE INDEX IF NOT EXISTS audit_log_bans_guild_time ON audit_log_bans(guild, banned_time)')
+sqlite_db.execute('CREATE TABLE IF NOT EXISTS audit_log_ban_sync(guild ID PRIMARY KEY, last_entry_id ID)')
+# Ban counts per moderator per month, maintained together with ban_owners; month is the days since epoch of the first
+# day of the month, and bans we can not attribute to anyone are counted under moderator 0
+ban_stats_need_rebuild = not sqlite_db.execute('SELECT COUNT(*) FROM sqlite_master WHERE type = \'table\' '
+                                               'AND name = \'ban_stats_monthly\'').fetchone()[0]
+sqlite_db.execute('CREATE TABLE IF NOT EXISTS ban_stats_monthly(guild ID, month ID, moderator ID, count INT, '
+                  'PRIMARY KEY(guild, month, moderator))')
+# Pending timed moderation actions (see scheduler); rows are removed once the action ran
+sqlite_db.execute('CREATE TABLE IF NOT EXISTS scheduled_actions(action_id INTEGER PRIMARY KEY, guild ID, user_id ID, '
+                  'action STRING, due_time EPOCH, data STRING)')
+sqlite_db.execute('CREATE INDEX IF NOT EXISTS scheduled_actions_user ON scheduled_actions(guild, user_id, action)')
+# Moderation history; case IDs only ever grow, so they double as the keyset pagination key
+sqlite_db.execute('CREATE TABLE IF NOT EXISTS cases(case_id INTEGER PRIMARY KEY, guild ID, user_id ID, moderator_id ID, '
+                  'action STRING, reason STRING, duration INT, created_time EPOCH)')
+sqlite_db.execute('CREATE INDEX IF NOT EXISTS cases_user ON cases(guild, user_id, case_id)')
+sqlite_db.execute('CREATE INDEX IF NOT EXISTS cases_moderator ON cases(guild, moderator_id, case_id)')
+# Warnings are cases with action 'warn'. Escalation rules trigger an action once a user has `threshold` warnings within
+# `window` seconds; per window, the active warning count of every warned user is kept up to date, so that escalating
+# never counts the history. expired_up_to is the last warning already subtracted from the count.
+sqlite_db.execute('CREATE TABLE IF NOT EXISTS warn_rules(guild ID, threshold INT, window INT, action STRING, '
+                  'duration INT, PRIMARY KEY(guild, threshold, window))')
+sqlite_db.execute('CREATE TABLE IF NOT EXISTS warn_counters(guild ID, user_id ID, window INT, active_count INT, '
+                  'expired_up_to ID, PRIMARY KEY(guild, user_id, window))')
 sqlite_db.execute('CREATE TABLE IF NOT EXISTS tags(guild ID, tag_name STRING PRIMARY KEY, tag_content STRING)')
+sqlite_db.execute('CREATE INDEX IF NOT EXISTS tags_guild_name ON tags(guild, tag_name)')
+sqlite_db.execute('CREATE TABLE IF NOT EXISTS tag_aliases(guild ID, alias STRING, tag_name STRING, '
+                  'PRIMARY KEY(guild, alias))')
+# Tag uses, flushed in batches from pending_tag_uses; every tag has a row, so listings can be walked on these indexes
+sqlite_db.execute('CREATE TABLE IF NOT EXISTS tag_usage(guild ID, tag_name STRING, uses INT, last_used_time EPOCH, '
+                  'PRIMARY KEY(guild, tag_name))')
+sqlite_db.execute('CREATE INDEX IF NOT EXISTS tag_usage_popularity ON tag_usage(guild, uses DESC, tag_name)')
+sqlite_db.execute('INSERT OR IGNORE INTO tag_usage(guild, tag_name, uses, last_used_time) '
+                  'SELECT guild, tag_name, 0, NULL FROM tags')
 sqlite_db.execute('CREATE TABLE IF NOT EXISTS user_activity(guild ID, user_id ID, days_since_epoch ID, first_active_time EPOCH, last_active_time EPOCH, '
                   'PRIMARY KEY(guild, user_id, days_since_epoch))')
 sqlite_db.execute('CREATE TABLE IF NOT EXISTS total_user_count(guild ID, days_since_epoch ID, total_users INT, '
                   'PRIMARY KEY(guild, days_since_epoch))')
 sqlite_db.commit()
 
+# Materialized rollups of user_activity and total_user_count, keyed by the days_since_epoch of the first day of
+# each bucket (the day itself, the monday of the week, the first of the month).
+# These are kept up to date incrementally by update_user_activity and update_total_user_count.
+ACTIVITY_ROLLUP_TABLES = {
+    'daily': 'activity_rollup_daily',
+    'weekly': 'activity_rollup_weekly',
+    'monthly': 'activity_rollup_monthly'
+}
+
+activity_rollups_need_rebuild = False
+for rollup_table in ACTIVITY_ROLLUP_TABLES.values():
+    if not sqlite_db.execute('SELECT COUNT(*) FROM sqlite_master WHERE type = \'table\' AND name = ?',
+                             (rollup_table,)).fetchone()[0]:
+        activity_rollups_need_rebuild = True
+    sqlite_db.execute(f'CREATE TABLE IF NOT EXISTS {rollup_table}(guild ID, bucket ID, active_users INT DEFAULT 0, '
+                      f'total_users INT DEFAULT NULL, PRIMARY KEY(guild, bucket))')
+sqlite_db.commit()
+
 last_sqlite_db_commit_for_user_activity = None
 last_sqlite_db_commit_for_total_user_count = None
 
-def guild_exists_in_config(guild):
+def days_since_epoch_to_date(days_since_epoch: int) -> date:
+    return date(1970, 1, 1) + timedelta(days=days_since_epoch)
+
+def get_activity_rollup_bucket(granularity: str, days_since_epoch: int) -> int:
+    """Get the bucket (days since epoch of the first day of the bucket) a day falls into.
+
+    Args:
+        granularity: Either 'daily', 'weekly' or 'monthly'
+        days_since_epoch: The day to get the bucket for
+
+    Returns:
+        int: The days since epoch of the first day of the bucket; weeks start on monday
+
+    Raises:
+        ValueError: If granularity is not 'daily', 'weekly' or 'monthly'
+    """
+    if granularity == 'daily':
+        return days_since_epoch
+    elif granularity == 'weekly':
+        return days_since_epoch - days_since_epoch_to_date(days_since_epoch).weekday()
+    elif granularity == 'monthly':
+        return days_since_epoch - days_since_epoch_to_date(days_since_epoch).day + 1
+    raise ValueError("Granularity must be either 'daily', 'weekly' or 'monthly'")
+
+def _bump_activity_rollups(cursor: sqlite3.Cursor, guild_id: int, user_id: int, days_since_epoch: int) -> None:
+    # Called once per new (guild, user, day) row in user_activity. The user is a new active user for the day by
+    # definition; for the week and month, we only need to check if the user already has a row earlier in the bucket,
+    # which is a range lookup on the user_activity primary key.
+    for granularity, rollup_table in ACTIVITY_ROLLUP_TABLES.items():
+        bucket = get_activity_rollup_bucket(granularity, days_since_epoch)
+        if bucket != days_since_epoch:
+            cursor.execute('SELECT 1 FROM user_activity WHERE guild = ? AND user_id = ? '
+                           'AND days_since_epoch BETWEEN ? AND ? LIMIT 1',
+                           (guild_id, user_id, bucket, days_since_epoch - 1))
+            if cursor.fetchone() is not None:
+                continue
+
+        cursor.execute(f'INSERT INTO {rollup_table}(guild, bucket, active_users) VALUES (?, ?, 1) '
+                       f'ON CONFLICT(guild, bucket) DO UPDATE SET active_users = active_users + 1',
+                       (guild_id, bucket))
+
+def _set_total_users_rollups(cursor: sqlite3.Cursor, guild_id: int, days_since_epoch: int, total_users: int) -> None:
+    # The total user count of a bucket is the last known count inside it
+    for granularity, rollup_table in ACTIVITY_ROLLUP_TABLES.items():
+        cursor.execute(f'INSERT INTO {rollup_table}(guild, bucket, total_users) VALUES (?, ?, ?) '
+                       f'ON CONFLICT(guild, bucket) DO UPDATE SET total_users = excluded.total_users',
+                       (guild_id, get_activity_rollup_bucket(granularity, days_since_epoch), total_users))
+
+def rebuild_activity_rollups() -> None:
+    """Rebuild all activity rollup tables from user_activity and total_user_count.
+
+    This does full scans, and is only needed once when the rollup tables are first created on an existing database.
+    """
     cursor = sqlite_db.cursor()
-    cursor.execute('SELECT COUNT(*) FROM config WHERE guild = ?', (guild.id,))
+    for rollup_table in ACTIVITY_ROLLUP_TABLES.values():
+        cursor.execute(f'DELETE FROM {rollup_table}')
+
+    # Walk the rows in (guild, user, day) order; this lets us count distinct users per bucket without remembering
+    # more than the last bucket seen per granularity.
+    counts: dict[tuple[str, int, int], int] = {}
+    last_seen: dict[str, tuple[int, int, int]] = {}
+    cursor.execute('SELECT guild, user_id, days_since_epoch FROM user_activity ORDER BY guild, user_id, days_since_epoch')
+    for guild_id, user_id, days_since_epoch in cursor.fetchall():
+        for granularity in ACTIVITY_ROLLUP_TABLES.keys():
+            bucket = get_activity_rollup_bucket(granularity, days_since_epoch)
+            if last_seen.get(granularity) == (guild_id, user_id, bucket):
+                continue
+            last_seen[granularity] = (guild_id, user_id, bucket)
+            counts[(granularity, guild_id, bucket)] = counts.get((granularity, guild_id, bucket), 0) + 1
+
+    for granularity, rollup_table in ACTIVITY_ROLLUP_TABLES.items():
+        cursor.executemany(f'INSERT INTO {rollup_table}(guild, bucket, active_users) VALUES (?, ?, ?) '
+                           f'ON CONFLICT(guild, bucket) DO UPDATE SET active_users = excluded.active_users',
+                           [(guild_id, bucket, count) for (count_granularity, guild_id, bucket), count in counts.items()
+                            if count_granularity == granularity])
+
+    # Days are ordered, so the last write for each bucket wins
+    cursor.execute('SELECT guild, days_since_epoch, total_users FROM total_user_count ORDER BY guild, days_since_epoch')
+    for guild_id, days_since_epoch, total_users in cursor.fetchall():
+        _set_total_users_rollups(cursor, guild_id, days_since_epoch, total_users)
+
+    cursor.close()
+    sqlite_db.commit()
+
+if activity_rollups_need_rebuild:
+    rebuild_activity_rollups()
+
+# HyperLogLog sketches of the active users of a guild, per day and per month, for approximate unique active user
+# counts over long windows. Sketches touched by update_user_activity are kept in memory, and written back when
+# user_activity is committed.
+activity_sketches_need_rebuild = not sqlite_db.execute('SELECT COUNT(*) FROM sqlite_master WHERE type = \'table\' '
+                                                       'AND name = \'user_activity_sketch\'').fetchone()[0]
+sqlite_db.execute('CREATE TABLE IF NOT EXISTS user_activity_sketch(guild ID, days_since_epoch ID, registers BLOB, '
+                  'PRIMARY KEY(guild, days_since_epoch))')
+sqlite_db.execute('CREATE TABLE IF NOT EXISTS user_activity_sketch_monthly(guild ID, bucket ID, registers BLOB, '
+                  'PRIMARY KEY(guild, bucket))')
+sqlite_db.commit()
+
+# (table, guild, bucket) -> sketch
+dirty_activity_sketches: dict[tuple[str, int, int], HyperLogLog] = {}
+
+def _load_activity_sketch(cursor: sqlite3.Cursor, table: str, guild_id: int, bucket: int) -> HyperLogLog:
+    key = (table, guild_id, bucket)
+    if key in dirty_activity_sketches:
+        return dirty_activity_sketches[key]
+
+    bucket_column = 'days_since_epoch' if table == 'user_activity_sketch' else 'bucket'
+    cursor.execute(f'SELECT registers FROM {table} WHERE guild = ? AND {bucket_column} = ?', (guild_id, bucket))
     res = cursor.fetchone()
+    sketch = HyperLogLog(res[0] if res is not None else None)
+    dirty_activity_sketches[key] = sketch
+    return sketch
+
+def _add_to_activity_sketches(cursor: sqlite3.Cursor, guild_id: int, user_id: int, days_since_epoch: int) -> None:
+    _load_activity_sketch(cursor, 'user_activity_sketch', guild_id, days_since_epoch).add(user_id)
+    _load_activity_sketch(cursor, 'user_activity_sketch_monthly', guild_id,
+                          get_activity_rollup_bucket('monthly', days_since_epoch)).add(user_id)
+
+def _flush_activity_sketches(cursor: sqlite3.Cursor) -> None:
+    for (table, guild_id, bucket), sketch in dirty_activity_sketches.items():
+        cursor.execute(f'INSERT OR REPLACE INTO {table} VALUES (?, ?, ?)', (guild_id, bucket, sketch.to_bytes()))
+    dirty_activity_sketches.clear()
+
+def rebuild_activity_sketches() -> None:
+    """Rebuild all activity sketches from user_activity.
+
+    This does a full scan, and is only needed once when the sketch tables are first created on an existing database.
+    """
+    cursor = sqlite_db.cursor()
+    cursor.execute('DELETE FROM user_activity_sketch')
+    cursor.execute('DELETE FROM user_activity_sketch_monthly')
+    dirty_activity_sketches.clear()
+
+    cursor.execute('SELECT guild, user_id, days_since_epoch FROM user_activity')
+    for guild_id, user_id, days_since_epoch in cursor.fetchall():
+        _add_to_activity_sketches(cursor, guild_id, user_id, days_since_epoch)
+    _flush_activity_sketches(cursor)
+
     cursor.close()
+    sqlite_db.commit()
+
+if activity_sketches_need_rebuild:
+    rebuild_activity_sketches()
+
+def get_unique_active_user_estimate(guild: discord.Guild, days: int) -> int:
+    """Get an estimate of the amount of unique active users in a guild in the last days.
 
-    if res is None or res[0] == 0:
-        return False
-    return True
+    Months that are fully inside the window are read from the monthly sketches, so a window costs at most
+    about two months worth of daily sketches plus one sketch per month. The standard error is about 1.6%.
+
+    Args:
+        guild: The Discord guild to get the estimate for
+        days: The length of the window in days, including today
+
+    Returns:
+        int: The estimated amount of unique active users
+    """
+    last_day = (datetime.now(timezone.utc) - datetime(1970, 1, 1, tzinfo=timezone.utc)).days
+    first_day = last_day - days + 1
+
+    # Split the window into the days before the first full month, the full months, and the days after them
+    first_full_month = get_activity_rollup_bucket('monthly', first_day)
+    if first_full_month != first_day:
+        first_full_month = get_activity_rollup_bucket('monthly', first_full_month + 31)
+    after_last_full_month = get_activity_rollup_bucket('monthly', last_day + 1)
+
+    cursor = sqlite_db.cursor()
+    _flush_activity_sketches(cursor)
+
+    if first_full_month < after_last_full_month:
+        cursor.execute('SELECT registers FROM user_activity_sketch_monthly WHERE guild = ? AND bucket >= ? AND bucket < ?',
+                       (guild.id, first_full_month, after_last_full_month))
+        sketch_blobs = cursor.fetchall()
+        cursor.execute('SELECT registers FROM user_activity_sketch WHERE guild = ? '
+                       'AND ((days_since_epoch >= ? AND days_since_epoch < ?) OR days_since_epoch BETWEEN ? AND ?)',
+                       (guild.id, first_day, first_full_month, after_last_full_month, last_day))
+        sketch_blobs += cursor.fetchall()
+    else:
+        cursor.execute('SELECT registers FROM user_activity_sketch WHERE guild = ? AND days_since_epoch BETWEEN ? AND ?',
+                       (guild.id, first_day, last_day))
+        sketch_blobs = cursor.fetchall()
+    cursor.close()
+
+    return HyperLogLog.merge_all([registers for (registers,) in sketch_blobs]).count()
+
+def get_activity_rollups(guild: discord.Guild, granularity: str, first_bucket: int,
+                         last_bucket: int) -> dict[int, tuple[int, int | None]]:
+    """Get the activity rollups of a guild for a range of buckets.
+
+    Args:
+        guild: The Discord guild to get the rollups for
+        granularity: Either 'daily', 'weekly' or 'monthly'
+        first_bucket: The first bucket to get, as returned by get_activity_rollup_bucket
+        last_bucket: The last bucket to get, as returned by get_activity_rollup_bucket
+
+    Returns:
+        dict[int, tuple[int, int | None]]: A dict of bucket to (active users, total users), for the buckets that
+        have data; total users is None if no total user count was stored in the bucket
+
+    Raises:
+        ValueError: If granularity is not 'daily', 'weekly' or 'monthly'
+    """
+    if granularity not in ACTIVITY_ROLLUP_TABLES:
+        raise ValueError("Granularity must be either 'daily', 'weekly' or 'monthly'")
+
+    cursor = sqlite_db.cursor()
+    cursor.execute(f'SELECT bucket, active_users, total_users FROM {ACTIVITY_ROLLUP_TABLES[granularity]} '
+                   f'WHERE guild = ? AND bucket BETWEEN ? AND ?', (guild.id, first_bucket, last_bucket))
+    res = cursor.fetchall()
+    cursor.close()
+
+    return {bucket: (active_users, total_users) for bucket, active_users, total_users in res}
 
 def init_guild(guild):
-    if guild_exists_in_config(guild):
-        return
+    init_guilds([guild])
 
+def init_guilds(guilds: List[discord.Guild]) -> None:
+    # One statement and one commit for all guilds, however many there are
     cur = sqlite_db.cursor()
-    cur.execute('INSERT INTO config(guild) VALUES (?)', (guild.id,))
+    cur.executemany('INSERT OR IGNORE INTO config(guild) VALUES (?)', [(guild.id,) for guild in guilds])
     cur.close()
     sqlite_db.commit()
 
+def get_bot_state(key: str) -> str | None:
+    cursor = sqlite_db.cursor()
+    cursor.execute('SELECT value FROM bot_state WHERE key = ?', (key,))
+    res = cursor.fetchone()
+    cursor.close()
+
+    if res is None:
+        return None
+    return res[0]
+
+def set_bot_state(key: str, value: str) -> None:
+    cursor = sqlite_db.cursor()
+    cursor.execute('INSERT OR REPLACE INTO bot_state(key, value) VALUES (?, ?)', (key, value))
+    cursor.close()
+    sqlite_db.commit()
+
 def get_guild_log_channel(guild: discord.Guild) -> discord.TextChannel | discord.VoiceChannel | None:
     cursor = sqlite_db.cursor()
     cursor.execute('SELECT log_channel FROM config WHERE guild = ?', (guild.id,))
@@ -141,15 +430,18 @@ def update_user_activity(guild: discord.Guild, user: discord.User | discord.Memb
         cursor.execute(
             'INSERT INTO user_activity(guild, user_id, days_since_epoch, first_active_time, last_active_time) VALUES (?, ?, ?, ?, ?)',
             (guild.id, user.id, days_since_epoch, int(current_time.timestamp()), int(current_time.timestamp())))
-
-    cursor.close()
+        _bump_activity_rollups(cursor, guild.id, user.id, days_since_epoch)
+        _add_to_activity_sketches(cursor, guild.id, user.id, days_since_epoch)
 
     # We don't issue sqlite db commits for this too often, since this function will fire _very_ often
     assert last_sqlite_db_commit_for_user_activity is not None
-    if (current_time - last_sqlite_db_commit_for_user_activity).total_seconds() > 10:
+    if (current_time - last_sqlite_db_commit_for_user_activity).total_seconds() >= batched_commit_seconds:
         last_sqlite_db_commit_for_user_activity = current_time
+        _flush_activity_sketches(cursor)
         sqlite_db.commit()
 
+    cursor.close()
+
 def get_this_day_active_user_count(guild: discord.Guild) -> int:
     cursor = sqlite_db.cursor()
     cursor.execute('SELECT COUNT(*) FROM user_activity WHERE guild = ? AND days_since_epoch = ?',
@@ -195,10 +487,15 @@ def update_total_user_count(guild: discord.Guild) -> None:
              guild.member_count)
         )
 
+    if guild.member_count is not None:
+        _set_total_users_rollups(cursor, guild.id,
+                                 (datetime.now(timezone.utc) - datetime(1970, 1, 1, tzinfo=timezone.utc)).days,
+                                 guild.member_count)
+
     cursor.close()
     # We don't issue sqlite db commits for this too often, since this function will fire _very_ often
     assert last_sqlite_db_commit_for_total_user_count is not None
-    if (datetime.now(timezone.utc) - last_sqlite_db_commit_for_total_user_count).total_seconds() > 10:
+    if (datetime.now(timezone.utc) - last_sqlite_db_commit_for_total_user_count).total_seconds() >= batched_commit_seconds:
         last_sqlite_db_commit_for_total_user_count = datetime.now(timezone.utc)
         sqlite_db.commit()
 
@@ -256,29 +553,230 @@ class SavedBan:
                 f'banned_user_id={self.banned_user_id}, '
                 f'banned_time={int(self.banned_time.timestamp())})')
 
+class SavedBanIndex:
+    """Saved bans grouped by banned user and sorted by time, for matching them against audit log entries."""
+
+    def __init__(self, saved_bans: List[SavedBan]):
+        # banned user id -> (ban timestamps, bans), both sorted by time
+        self.bans_by_user: dict[int, tuple[list[float], list[SavedBan]]] = {}
+        for saved_ban in sorted(saved_bans, key=lambda saved_ban: saved_ban.banned_time):
+            if saved_ban.banned_user_id not in self.bans_by_user:
+                self.bans_by_user[saved_ban.banned_user_id] = ([], [])
+            times, bans = self.bans_by_user[saved_ban.banned_user_id]
+            times.append(saved_ban.banned_time.timestamp())
+            bans.append(saved_ban)
+
+    def pop_closest(self, banned_user_id: int, banned_time: datetime, max_difference: float = 20) -> SavedBan | None:
+        """Remove and return the ban of a user closest in time to banned_time, if one is within max_difference seconds."""
+        if banned_user_id not in self.bans_by_user:
+            return None
+
+        times, bans = self.bans_by_user[banned_user_id]
+        timestamp = banned_time.timestamp()
+
+        closest_index = None
+        index = bisect_left(times, timestamp - max_difference)
+        while index < len(times) and times[index] <= timestamp + max_difference:
+            if closest_index is None or abs(times[index] - timestamp) < abs(times[closest_index] - timestamp):
+                closest_index = index
+            index += 1
+
+        if closest_index is None:
+            return None
+
+        times.pop(closest_index)
+        return bans.pop(closest_index)
+
+    def remaining(self) -> List[SavedBan]:
+        return [saved_ban for times, bans in self.bans_by_user.values() for saved_ban in bans]
+
+    def __len__(self) -> int:
+        return sum(len(bans) for times, bans in self.bans_by_user.values())
+
+UNTRACKABLE_BAN_MODERATOR = 0
+
+def get_ban_stats_month(time: datetime) -> int:
+    return get_activity_rollup_bucket('monthly', (time - datetime(1970, 1, 1, tzinfo=timezone.utc)).days)
+
+def _bump_ban_stats(cursor: sqlite3.Cursor, guild_id: int, moderator_id: int, banned_time: int) -> None:
+    cursor.execute('INSERT INTO ban_stats_monthly(guild, month, moderator, count) VALUES (?, ?, ?, 1) '
+                   'ON CONFLICT(guild, month, moderator) DO UPDATE SET count = count + 1',
+                   (guild_id, get_ban_stats_month(datetime.fromtimestamp(banned_time, tz=timezone.utc)), moderator_id))
+
 def add_ban(guild: discord.Guild, responsible_mod: discord.User | discord.Member,
             banned_user: discord.User | discord.Member) -> None:
+    banned_time = int(datetime.now(timezone.utc).timestamp())
+
     cursor = sqlite_db.cursor()
-    cursor.execute('INSERT INTO ban_owners(guild, banned_user, responsible_mod, banned_time) VALUES (?, ?, ?, unixepoch(\'now\'))',
-                   (guild.id, banned_user.id, responsible_mod.id))
+    cursor.execute('INSERT INTO ban_owners(guild, banned_user, responsible_mod, banned_time) VALUES (?, ?, ?, ?)',
+                   (guild.id, banned_user.id, responsible_mod.id, banned_time))
+    _bump_ban_stats(cursor, guild.id, responsible_mod.id, banned_time)
     cursor.close()
     sqlite_db.commit()
 
-def add_audit_log_ban(guild: discord.Guild, audit_log_entry: discord.AuditLogEntry) -> None:
-    assert isinstance(audit_log_entry, discord.AuditLogEntry)
-    assert type(audit_log_entry.target) == discord.User or type(audit_log_entry.target) == discord.Member
-    assert type(audit_log_entry.user) == discord.User or type(audit_log_entry.user) == discord.Member
-    print(f'Adding audit log ban for {audit_log_entry.target.name} ({audit_log_entry.target.id}),'
-          f' by {audit_log_entry.user.name} ({audit_log_entry.user.id})'
-          f' guild {guild.name} ({guild.id}), '
-          f' ban time {audit_log_entry.created_at} ({int(audit_log_entry.created_at.timestamp())}) to database.')
+def add_bans(guild: discord.Guild, responsible_mod: discord.User | discord.Member, banned_user_ids: List[int],
+             reason: str | None = None) -> None:
+    # Same as add_ban and add_case, for many users in one transaction. The ban time is now, so call this as soon as the
+    # bans are done; banstats matches them to the audit log within 20 seconds.
+    if len(banned_user_ids) == 0:
+        return
+
+    banned_time = int(datetime.now(timezone.utc).timestamp())
+
+    cursor = sqlite_db.cursor()
+    cursor.executemany('INSERT INTO ban_owners(guild, banned_user, responsible_mod, banned_time) VALUES (?, ?, ?, ?)',
+                       [(guild.id, banned_user_id, responsible_mod.id, banned_time) for banned_user_id in banned_user_ids])
+    cursor.execute('INSERT INTO ban_stats_monthly(guild, month, moderator, count) VALUES (?, ?, ?, ?) '
+                   'ON CONFLICT(guild, month, moderator) DO UPDATE SET count = count + excluded.count',
+                   (guild.id, get_ban_stats_month(datetime.fromtimestamp(banned_time, tz=timezone.utc)),
+                    responsible_mod.id, len(banned_user_ids)))
+    _insert_cases(cursor, guild.id, banned_user_ids, responsible_mod.id, 'ban', reason, None)
+    cursor.close()
+    sqlite_db.commit()
+
+class AuditLogBan:
+    entry_id: int
+    banned_user_id: int
+    responsible_mod_id: int
+    banned_time: datetime
+
+    def __repr__(self):
+        return (f'AuditLogBan(entry_id={self.entry_id}, '
+                f'responsible_mod_id={self.responsible_mod_id}, '
+                f'banned_user_id={self.banned_user_id}, '
+                f'banned_time={int(self.banned_time.timestamp())})')
+
+def add_audit_log_ban(guild: discord.Guild, audit_log_ban: AuditLogBan) -> None:
+    _log.debug('Adding audit log ban for %s by %s, ban time %s (%s), to database',
+               audit_log_ban.banned_user_id, audit_log_ban.responsible_mod_id, audit_log_ban.banned_time,
+               int(audit_log_ban.banned_time.timestamp()), extra={'guild_id': guild.id, 'event': 'audit_log_ban'})
 
     cursor = sqlite_db.cursor()
     cursor.execute('INSERT INTO ban_owners(guild, banned_user, responsible_mod, banned_time) VALUES (?, ?, ?, ?)',
-                   (guild.id, audit_log_entry.target.id, audit_log_entry.user.id, int(audit_log_entry.created_at.timestamp())))
+                   (guild.id, audit_log_ban.banned_user_id, audit_log_ban.responsible_mod_id,
+                    int(audit_log_ban.banned_time.timestamp())))
+    _bump_ban_stats(cursor, guild.id, audit_log_ban.responsible_mod_id, int(audit_log_ban.banned_time.timestamp()))
+    cursor.close()
+    sqlite_db.commit()
+
+def add_untrackable_ban(guild: discord.Guild, audit_log_ban: AuditLogBan) -> None:
+    # Bans made through us without a ban_owners row; we only know they happened
+    cursor = sqlite_db.cursor()
+    _bump_ban_stats(cursor, guild.id, UNTRACKABLE_BAN_MODERATOR, int(audit_log_ban.banned_time.timestamp()))
+    cursor.close()
+    sqlite_db.commit()
+
+def get_ban_stats(guild: discord.Guild, month: int | None = None) -> dict[int | str, int]:
+    """Get the amount of bans per moderator in a guild, sorted by the amount of bans.
+
+    Args:
+        guild: The Discord guild to get the ban stats for
+        month: The month to get the ban stats for, as returned by get_ban_stats_month; None for all time
+
+    Returns:
+        dict[int | str, int]: A dict of moderator ID to ban count; bans that can not be attributed to a moderator
+        are under 'untrackable'
+    """
+    cursor = sqlite_db.cursor()
+    if month is not None:
+        cursor.execute('SELECT moderator, count FROM ban_stats_monthly WHERE guild = ? AND month = ? '
+                       'ORDER BY count DESC', (guild.id, month))
+    else:
+        cursor.execute('SELECT moderator, SUM(count) AS total FROM ban_stats_monthly WHERE guild = ? '
+                       'GROUP BY moderator ORDER BY total DESC', (guild.id,))
+    res = cursor.fetchall()
+    cursor.close()
+
+    return {'untrackable' if moderator == UNTRACKABLE_BAN_MODERATOR else moderator: count for moderator, count in res}
+
+def rebuild_ban_stats_from_ban_owners(guild: discord.Guild | None = None) -> None:
+    """Recount the ban stats of a guild (or all guilds) from ban_owners.
+
+    This drops the untrackable ban counts; they have to be recounted from the audit log afterwards.
+    """
+    cursor = sqlite_db.cursor()
+    guild_filter = 'WHERE guild = ?' if guild is not None else ''
+    guild_args = (guild.id,) if guild is not None else ()
+    cursor.execute(f'DELETE FROM ban_stats_monthly {guild_filter}', guild_args)
+    # The days since epoch of the first day of the month; same as get_ban_stats_month
+    cursor.execute(f'INSERT INTO ban_stats_monthly(guild, month, moderator, count) '
+                   f'SELECT guild, CAST(julianday(date(banned_time, \'unixepoch\', \'start of month\')) - 2440587.5 AS INTEGER), '
+                   f'responsible_mod, COUNT(*) FROM ban_owners {guild_filter} GROUP BY 1, 2, 3', guild_args)
+    cursor.close()
+    sqlite_db.commit()
+
+if ban_stats_need_rebuild:
+    rebuild_ban_stats_from_ban_owners()
+
+def get_audit_log_ban_high_water_mark(guild: discord.Guild) -> int | None:
+    cursor = sqlite_db.cursor()
+    cursor.execute('SELECT last_entry_id FROM audit_log_ban_sync WHERE guild = ?', (guild.id,))
+    res = cursor.fetchone()
+    cursor.close()
+
+    if res is None:
+        return None
+    return res[0]
+
+def add_synced_audit_log_bans(guild: discord.Guild, entries: List[discord.AuditLogEntry]) -> List[AuditLogBan]:
+    """Store newly synced audit log ban entries, and move the guild's high water mark to the newest of them.
+
+    Args:
+        guild: The Discord guild the entries are from
+        entries: The audit log entries, in any order
+
+    Returns:
+        List[AuditLogBan]: The entries that were not stored yet, sorted by time
+    """
+    if len(entries) == 0:
+        return []
+
+    new_audit_log_bans = []
+    cursor = sqlite_db.cursor()
+    for entry in sorted(entries, key=lambda entry: entry.id):
+        if entry.target is None:
+            continue
+
+        cursor.execute('INSERT OR IGNORE INTO audit_log_bans(entry_id, guild, banned_user, responsible_mod, banned_time) '
+                       'VALUES (?, ?, ?, ?, ?)',
+                       (entry.id, guild.id, entry.target.id, entry.user_id, int(entry.created_at.timestamp())))
+        if cursor.rowcount == 0:
+            continue
+
+        audit_log_ban = AuditLogBan()
+        audit_log_ban.entry_id = entry.id
+        audit_log_ban.banned_user_id = entry.target.id
+        audit_log_ban.responsible_mod_id = entry.user_id
+        audit_log_ban.banned_time = datetime.fromtimestamp(int(entry.created_at.timestamp()), tz=timezone.utc)
+        new_audit_log_bans.append(audit_log_ban)
+
+    cursor.execute('INSERT INTO audit_log_ban_sync(guild, last_entry_id) VALUES (?, ?) '
+                   'ON CONFLICT(guild) DO UPDATE SET last_entry_id = MAX(last_entry_id, excluded.last_entry_id)',
+                   (guild.id, max(entry.id for entry in entries)))
     cursor.close()
     sqlite_db.commit()
 
+    return new_audit_log_bans
+
+def get_audit_log_bans_between(guild: discord.Guild, before: datetime, after: datetime) -> List[AuditLogBan]:
+    cursor = sqlite_db.cursor()
+    cursor.execute('SELECT entry_id, banned_user, responsible_mod, banned_time FROM audit_log_bans '
+                   'WHERE guild = ? AND banned_time BETWEEN ? AND ?',
+                   (guild.id, int(after.timestamp()), int(before.timestamp())))
+    db_results = cursor.fetchall()
+    cursor.close()
+
+    results = []
+    for db_result in db_results:
+        audit_log_ban = AuditLogBan()
+        audit_log_ban.entry_id = db_result[0]
+        audit_log_ban.banned_user_id = db_result[1]
+        audit_log_ban.responsible_mod_id = db_result[2]
+        audit_log_ban.banned_time = datetime.fromtimestamp(db_result[3], tz=timezone.utc)
+        results.append(audit_log_ban)
+
+    return results
+
 def get_bans_between(guild: discord.Guild, before: datetime, after: datetime) -> List[SavedBan]:
     cursor = sqlite_db.cursor()
     cursor.execute('SELECT banned_user, responsible_mod, banned_time FROM ban_owners WHERE guild=? AND banned_time BETWEEN ? and ?',
@@ -296,6 +794,291 @@ def get_bans_between(guild: discord.Guild, before: datetime, after: datetime) ->
 
     return results
 
+class ScheduledAction:
+    action_id: int
+    guild_id: int
+    user_id: int
+    action: str
+    due_time: int
+    data: str | None
+
+    def __repr__(self):
+        return (f'ScheduledAction(action_id={self.action_id}, guild_id={self.guild_id}, user_id={self.user_id}, '
+                f'action={self.action}, due_time={self.due_time}, data={self.data})')
+
+def add_scheduled_action(guild_id: int, user_id: int, action: str, due_time: int,
+                         data: str | None = None) -> ScheduledAction:
+    cursor = sqlite_db.cursor()
+    cursor.execute('INSERT INTO scheduled_actions(guild, user_id, action, due_time, data) VALUES (?, ?, ?, ?, ?)',
+                   (guild_id, user_id, action, due_time, data))
+    scheduled_action = ScheduledAction()
+    scheduled_action.action_id = cursor.lastrowid
+    scheduled_action.guild_id = guild_id
+    scheduled_action.user_id = user_id
+    scheduled_action.action = action
+    scheduled_action.due_time = due_time
+    scheduled_action.data = data
+    cursor.close()
+    sqlite_db.commit()
+    return scheduled_action
+
+def get_scheduled_actions() -> List[ScheduledAction]:
+    cursor = sqlite_db.cursor()
+    cursor.execute('SELECT action_id, guild, user_id, action, due_time, data FROM scheduled_actions')
+    res = cursor.fetchall()
+    cursor.close()
+
+    results = []
+    for action_id, guild_id, user_id, action, due_time, data in res:
+        scheduled_action = ScheduledAction()
+        scheduled_action.action_id = action_id
+        scheduled_action.guild_id = guild_id
+        scheduled_action.user_id = user_id
+        scheduled_action.action = action
+        scheduled_action.due_time = due_time
+        scheduled_action.data = data
+        results.append(scheduled_action)
+    return results
+
+def remove_scheduled_action(action_id: int) -> None:
+    cursor = sqlite_db.cursor()
+    cursor.execute('DELETE FROM scheduled_actions WHERE action_id = ?', (action_id,))
+    cursor.close()
+    sqlite_db.commit()
+
+def remove_scheduled_actions_for_user(guild_id: int, user_id: int, action: str) -> List[int]:
+    cursor = sqlite_db.cursor()
+    cursor.execute('SELECT action_id FROM scheduled_actions WHERE guild = ? AND user_id = ? AND action = ?',
+                   (guild_id, user_id, action))
+    action_ids = [action_id for (action_id,) in cursor.fetchall()]
+    cursor.execute('DELETE FROM scheduled_actions WHERE guild = ? AND user_id = ? AND action = ?',
+                   (guild_id, user_id, action))
+    cursor.close()
+    sqlite_db.commit()
+    return action_ids
+
+def remove_scheduled_actions_for_users(guild_id: int, user_ids: List[int], action: str) -> List[int]:
+    # Same as remove_scheduled_actions_for_user, for many users in one transaction
+    cursor = sqlite_db.cursor()
+    action_ids = []
+    for user_id in user_ids:
+        cursor.execute('SELECT action_id FROM scheduled_actions WHERE guild = ? AND user_id = ? AND action = ?',
+                       (guild_id, user_id, action))
+        action_ids += [action_id for (action_id,) in cursor.fetchall()]
+    cursor.executemany('DELETE FROM scheduled_actions WHERE guild = ? AND user_id = ? AND action = ?',
+                       [(guild_id, user_id, action) for user_id in user_ids])
+    cursor.close()
+    sqlite_db.commit()
+    return action_ids
+
+class Case:
+    case_id: int
+    user_id: int
+    moderator_id: int
+    action: str
+    reason: str | None
+    duration: int | None
+    created_time: datetime
+
+    def __repr__(self):
+        return (f'Case(case_id={self.case_id}, user_id={self.user_id}, moderator_id={self.moderator_id}, '
+                f'action={self.action}, created_time={int(self.created_time.timestamp())})')
+
+def add_case(guild: discord.Guild, user_id: int, moderator_id: int, action: str, reason: str | None = None,
+             duration: int | None = None) -> None:
+    add_cases(guild, [user_id], moderator_id, action, reason, duration)
+
+def _insert_cases(cursor: sqlite3.Cursor, guild_id: int, user_ids: List[int], moderator_id: int, action: str,
+                  reason: str | None, duration: int | None) -> None:
+    cursor.executemany('INSERT INTO cases(guild, user_id, moderator_id, action, reason, duration, created_time) '
+                       'VALUES (?, ?, ?, ?, ?, ?, unixepoch(\'now\'))',
+                       [(guild_id, user_id, moderator_id, action, reason, duration) for user_id in user_ids])
+
+def add_cases(guild: discord.Guild, user_ids: List[int], moderator_id: int, action: str, reason: str | None = None,
+              duration: int | None = None) -> None:
+    cursor = sqlite_db.cursor()
+    _insert_cases(cursor, guild.id, user_ids, moderator_id, action, reason, duration)
+    cursor.close()
+    sqlite_db.commit()
+
+def get_cases(guild: discord.Guild, *, user_id: int | None = None, moderator_id: int | None = None,
+              before_case_id: int | None = None, after_case_id: int | None = None, limit: int = 10) -> List[Case]:
+    """Get a page of cases of a user or by a moderator, newest first, using keyset pagination on the case ID.
+
+    Args:
+        guild: The Discord guild to get the cases for
+        user_id: Only get the cases of this user
+        moderator_id: Only get the cases by this moderator
+        before_case_id: Get the page of cases older than this case
+        after_case_id: Get the page of cases newer than this case
+        limit: The size of the page
+
+    Returns:
+        List[Case]: The cases, newest first
+    """
+    conditions = ['guild = ?']
+    args: list = [guild.id]
+    if user_id is not None:
+        conditions.append('user_id = ?')
+        args.append(user_id)
+    if moderator_id is not None:
+        conditions.append('moderator_id = ?')
+        args.append(moderator_id)
+    if before_case_id is not None:
+        conditions.append('case_id < ?')
+        args.append(before_case_id)
+    if after_case_id is not None:
+        conditions.append('case_id > ?')
+        args.append(after_case_id)
+
+    # Walking towards newer cases has to go up the index, and is flipped back afterwards
+    order = 'ASC' if after_case_id is not None else 'DESC'
+
+    cursor = sqlite_db.cursor()
+    cursor.execute(f'SELECT case_id, user_id, moderator_id, action, reason, duration, created_time FROM cases '
+                   f'WHERE {' AND '.join(conditions)} ORDER BY case_id {order} LIMIT ?', (*args, limit))
+    res = cursor.fetchall()
+    cursor.close()
+
+    cases = []
+    for case_id, case_user_id, case_moderator_id, action, reason, duration, created_time in res:
+        case = Case()
+        case.case_id = case_id
+        case.user_id = case_user_id
+        case.moderator_id = case_moderator_id
+        case.action = action
+        case.reason = reason
+        case.duration = duration
+        case.created_time = datetime.fromtimestamp(created_time, tz=timezone.utc)
+        cases.append(case)
+
+    if order == 'ASC':
+        cases.reverse()
+    return cases
+
+def get_case_count(guild: discord.Guild, user_id: int) -> int:
+    cursor = sqlite_db.cursor()
+    cursor.execute('SELECT COUNT(*) FROM cases WHERE guild = ? AND user_id = ?', (guild.id, user_id))
+    res = cursor.fetchone()
+    cursor.close()
+    return res[0]
+
+class WarnRule:
+    threshold: int
+    window: int
+    action: str
+    duration: int | None
+
+    def __repr__(self):
+        return (f'WarnRule(threshold={self.threshold}, window={self.window}, action={self.action}, '
+                f'duration={self.duration})')
+
+# Per guild, the rules by window and then by threshold, so a warning only looks up its count for each window
+warn_rules_cache: dict[int, dict[int, dict[int, WarnRule]]] = {}
+
+def get_warn_rules(guild: discord.Guild) -> dict[int, dict[int, WarnRule]]:
+    metrics.record_cache_lookup('warn_rules', guild.id in warn_rules_cache)
+    if guild.id not in warn_rules_cache:
+        cursor = sqlite_db.cursor()
+        cursor.execute('SELECT threshold, window, action, duration FROM warn_rules WHERE guild = ?', (guild.id,))
+        res = cursor.fetchall()
+        cursor.close()
+
+        rules: dict[int, dict[int, WarnRule]] = {}
+        for threshold, window, action, duration in res:
+            rule = WarnRule()
+            rule.threshold = threshold
+            rule.window = window
+            rule.action = action
+            rule.duration = duration
+            rules.setdefault(window, {})[threshold] = rule
+        warn_rules_cache[guild.id] = rules
+    return warn_rules_cache[guild.id]
+
+def set_warn_rule(guild: discord.Guild, threshold: int, window: int, action: str, duration: int | None) -> None:
+    cursor = sqlite_db.cursor()
+    cursor.execute('INSERT OR REPLACE INTO warn_rules(guild, threshold, window, action, duration) VALUES (?, ?, ?, ?, ?)',
+                   (guild.id, threshold, window, action, duration))
+    cursor.close()
+    sqlite_db.commit()
+    warn_rules_cache.pop(guild.id, None)
+
+def remove_warn_rule(guild: discord.Guild, threshold: int, window: int) -> bool:
+    cursor = sqlite_db.cursor()
+    cursor.execute('DELETE FROM warn_rules WHERE guild = ? AND threshold = ? AND window = ?',
+                   (guild.id, threshold, window))
+    removed = cursor.rowcount > 0
+    # Counters of windows no rule uses anymore are dead weight
+    cursor.execute('DELETE FROM warn_counters WHERE guild = ? AND window NOT IN '
+                   '(SELECT window FROM warn_rules WHERE guild = ?)', (guild.id, guild.id))
+    cursor.close()
+    sqlite_db.commit()
+    warn_rules_cache.pop(guild.id, None)
+    return removed
+
+def _get_active_warning_count(cursor: sqlite3.Cursor, guild_id: int, user_id: int, window: int, now: int) -> int:
+    cursor.execute('SELECT active_count, expired_up_to FROM warn_counters WHERE guild = ? AND user_id = ? AND window = ?',
+                   (guild_id, user_id, window))
+    res = cursor.fetchone()
+
+    if res is None:
+        # First warning counted for this window, e.g. because the rule is new; count the window once
+        cursor.execute('SELECT COALESCE(MAX(case_id), 0) FROM cases WHERE guild = ? AND user_id = ? '
+                       'AND action = \'warn\' AND created_time <= ?', (guild_id, user_id, now - window))
+        expired_up_to = cursor.fetchone()[0]
+        cursor.execute('SELECT COUNT(*) FROM cases WHERE guild = ? AND user_id = ? AND case_id > ? '
+                       'AND action = \'warn\'', (guild_id, user_id, expired_up_to))
+        active_count = cursor.fetchone()[0]
+    else:
+        active_count, expired_up_to = res
+        # Lazily expire the warnings that left the window since the last warning; this only looks at the cases
+        # after expired_up_to, so every warning is subtracted once
+        cursor.execute('SELECT COUNT(*), MAX(case_id) FROM cases WHERE guild = ? AND user_id = ? AND case_id > ? '
+                       'AND action = \'warn\' AND created_time <= ?', (guild_id, user_id, expired_up_to, now - window))
+        expired_count, last_expired = cursor.fetchone()
+        if expired_count > 0:
+            active_count -= expired_count
+            expired_up_to = last_expired
+        # The warning just added
+        active_count += 1
+
+    cursor.execute('INSERT OR REPLACE INTO warn_counters(guild, user_id, window, active_count, expired_up_to) '
+                   'VALUES (?, ?, ?, ?, ?)', (guild_id, user_id, window, active_count, expired_up_to))
+    return active_count
+
+def add_warning(guild: discord.Guild, user_id: int, moderator_id: int,
+                reason: str | None = None) -> tuple[dict[int, int], List[WarnRule]]:
+    """Warn a user, and find the escalation rules the warning reaches.
+
+    Args:
+        guild: The Discord guild the user is warned in
+        user_id: The ID of the warned user
+        moderator_id: The ID of the moderator that warned the user
+        reason: The reason for the warning
+
+    Returns:
+        tuple[dict[int, int], List[WarnRule]]: The active warnings of the user per rule window, including this one,
+        and the rules whose threshold this warning reached
+    """
+    now = int(datetime.now(timezone.utc).timestamp())
+    rules = get_warn_rules(guild)
+
+    cursor = sqlite_db.cursor()
+    cursor.execute('INSERT INTO cases(guild, user_id, moderator_id, action, reason, duration, created_time) '
+                   'VALUES (?, ?, ?, \'warn\', ?, NULL, ?)', (guild.id, user_id, moderator_id, reason, now))
+
+    active_counts = {}
+    reached_rules = []
+    for window, rules_by_threshold in rules.items():
+        active_counts[window] = _get_active_warning_count(cursor, guild.id, user_id, window, now)
+        # Only reaching a threshold escalates, so further warnings in the same window do not repeat the action
+        if active_counts[window] in rules_by_threshold:
+            reached_rules.append(rules_by_threshold[active_counts[window]])
+
+    cursor.close()
+    sqlite_db.commit()
+    return active_counts, reached_rules
+
 def get_ban_image_url(guild: discord.Guild) -> str:
     cursor = sqlite_db.cursor()
     cursor.execute('SELECT ban_image_url FROM config WHERE guild = ?', (guild.id,))
@@ -339,35 +1122,144 @@ def set_guild_tag(guild: discord.Guild, tag_name: str, tag_content: str) -> None
     cursor = sqlite_db.cursor()
     cursor.execute('INSERT OR REPLACE INTO tags(guild, tag_name, tag_content) VALUES (?, ?, ?)',
                    (guild.id, tag_name, tag_content))
+    cursor.execute('INSERT OR IGNORE INTO tag_usage(guild, tag_name, uses, last_used_time) VALUES (?, ?, 0, NULL)',
+                   (guild.id, tag_name))
     cursor.close()
     sqlite_db.commit()
 
-def get_guild_tag(guild: discord.Guild, tag_name: str) -> str | None:
+def remove_guild_tag(guild: discord.Guild, tag_name: str) -> None:
     cursor = sqlite_db.cursor()
-    cursor.execute('SELECT tag_content FROM tags WHERE guild=? AND tag_name=?', (guild.id, tag_name))
-    res = cursor.fetchone()
+    cursor.execute('DELETE FROM tags WHERE guild=? AND tag_name=?', (guild.id, tag_name))
+    cursor.execute('DELETE FROM tag_usage WHERE guild=? AND tag_name=?', (guild.id, tag_name))
+    cursor.execute('DELETE FROM tag_aliases WHERE guild=? AND tag_name=?', (guild.id, tag_name))
     cursor.close()
+    sqlite_db.commit()
 
-    if res is None:
-        return None
+def get_guild_tags_and_aliases(guild: discord.Guild) -> tuple[dict[str, str], dict[str, str]]:
+    """Get every tag of a guild by name, and the tag name of every alias, to build the tag index from."""
+    cursor = sqlite_db.cursor()
+    cursor.execute('SELECT tag_name, tag_content FROM tags WHERE guild=?', (guild.id,))
+    tags = {str(tag_name): tag_content for tag_name, tag_content in cursor.fetchall()}
+    cursor.execute('SELECT alias, tag_name FROM tag_aliases WHERE guild=?', (guild.id,))
+    aliases = {str(alias): str(tag_name) for alias, tag_name in cursor.fetchall()}
+    cursor.close()
+    return tags, aliases
+
+def set_tag_alias(guild: discord.Guild, alias: str, tag_name: str) -> None:
+    cursor = sqlite_db.cursor()
+    cursor.execute('INSERT OR REPLACE INTO tag_aliases(guild, alias, tag_name) VALUES (?, ?, ?)',
+                   (guild.id, alias, tag_name))
+    cursor.close()
+    sqlite_db.commit()
+
+def remove_tag_alias(guild: discord.Guild, alias: str) -> None:
+    cursor = sqlite_db.cursor()
+    cursor.execute('DELETE FROM tag_aliases WHERE guild=? AND alias=?', (guild.id, alias))
+    cursor.close()
+    sqlite_db.commit()
+
+def get_guild_tag_count(guild: discord.Guild) -> int:
+    cursor = sqlite_db.cursor()
+    cursor.execute('SELECT COUNT(*) FROM tags WHERE guild=?', (guild.id,))
+    res = cursor.fetchone()
+    cursor.close()
     return res[0]
 
-def remove_guild_tag(guild: discord.Guild, tag_name: str) -> None:
+def get_guild_tags_page(guild: discord.Guild, *, after_tag: tuple[str, int] | None = None,
+                        before_tag: tuple[str, int] | None = None, by_popularity: bool = False, limit: int = 25,
+                        preview_length: int = 20) -> List[tuple[str, str, int]]:
+    """Get a page of tags of a guild, using keyset pagination on the tag name, or the uses and then the tag name.
+
+    Args:
+        guild: The Discord guild to get the tags for
+        after_tag: Get the page of tags after this (tag name, uses)
+        before_tag: Get the page of tags before this (tag name, uses)
+        by_popularity: Sort by uses, most used first, instead of by name
+        limit: The size of the page
+        preview_length: The length the tag content is cut to; cut content gets '...' appended
+
+    Returns:
+        List[tuple[str, str, int]]: The tag names, content previews and uses, in the requested order
+    """
+    conditions = ['tag_usage.guild = ?']
+    args: list = [guild.id]
+    if by_popularity:
+        if after_tag is not None:
+            conditions.append('(tag_usage.uses < ? OR (tag_usage.uses = ? AND tag_usage.tag_name > ?))')
+            args += [after_tag[1], after_tag[1], after_tag[0]]
+        elif before_tag is not None:
+            conditions.append('(tag_usage.uses > ? OR (tag_usage.uses = ? AND tag_usage.tag_name < ?))')
+            args += [before_tag[1], before_tag[1], before_tag[0]]
+        order = 'tag_usage.uses DESC, tag_usage.tag_name' if before_tag is None \
+            else 'tag_usage.uses, tag_usage.tag_name DESC'
+    else:
+        if after_tag is not None:
+            conditions.append('tag_usage.tag_name > ?')
+            args.append(after_tag[0])
+        elif before_tag is not None:
+            conditions.append('tag_usage.tag_name < ?')
+            args.append(before_tag[0])
+        order = 'tag_usage.tag_name' if before_tag is None else 'tag_usage.tag_name DESC'
+
+    # Every tag has a tag_usage row, so the page is walked on its indexes; one more character than the preview is
+    # selected, to know whether it was cut
     cursor = sqlite_db.cursor()
-    cursor.execute('DELETE FROM tags WHERE guild=? AND tag_name=?', (guild.id, tag_name))
+    cursor.execute(f'SELECT tag_usage.tag_name, substr(tags.tag_content, 1, ?), tag_usage.uses FROM tag_usage '
+                   f'JOIN tags ON tags.guild = tag_usage.guild AND tags.tag_name = tag_usage.tag_name '
+                   f'WHERE {' AND '.join(conditions)} ORDER BY {order} LIMIT ?', (preview_length + 1, *args, limit))
+    res = cursor.fetchall()
+    cursor.close()
+
+    if before_tag is not None:
+        res.reverse()
+    return [(tag_name, preview[:preview_length] + '...' if len(preview) > preview_length else preview, uses)
+            for tag_name, preview, uses in res]
+
+# (guild, tag name) -> [uses, last used time] not yet written to tag_usage
+pending_tag_uses: dict[tuple[int, str], list[int]] = {}
+last_tag_uses_flush = int(datetime.now(timezone.utc).timestamp())
+
+def record_tag_use(guild: discord.Guild, tag_name: str) -> None:
+    """Count a use of a tag; uses are kept in memory, and written by flush_tag_uses at most every 10 seconds."""
+    current_time = int(datetime.now(timezone.utc).timestamp())
+
+    pending_use = pending_tag_uses.setdefault((guild.id, tag_name), [0, current_time])
+    pending_use[0] += 1
+    pending_use[1] = current_time
+
+    if current_time - last_tag_uses_flush > 10:
+        flush_tag_uses()
+
+def flush_tag_uses() -> None:
+    global last_tag_uses_flush
+    last_tag_uses_flush = int(datetime.now(timezone.utc).timestamp())
+    if len(pending_tag_uses) == 0:
+        return
+
+    # Selecting from tags drops the uses of tags deleted in the meantime
+    cursor = sqlite_db.cursor()
+    cursor.executemany('INSERT INTO tag_usage(guild, tag_name, uses, last_used_time) '
+                       'SELECT guild, tag_name, ?, ? FROM tags WHERE guild = ? AND tag_name = ? '
+                       'ON CONFLICT(guild, tag_name) DO UPDATE SET uses = uses + excluded.uses, '
+                       'last_used_time = excluded.last_used_time',
+                       [(uses, last_used_time, guild_id, tag_name)
+                        for (guild_id, tag_name), (uses, last_used_time) in pending_tag_uses.items()])
     cursor.close()
     sqlite_db.commit()
+    pending_tag_uses.clear()
+
+def get_top_tags(guild: discord.Guild, limit: int = 10) -> List[tuple[str, int, datetime | None]]:
+    """Get the most used tags of a guild, with their uses and when they were last used."""
+    flush_tag_uses()
 
-def get_all_guild_tags(guild: discord.Guild) -> dict[str, str]:
     cursor = sqlite_db.cursor()
-    cursor.execute('SELECT tag_name, tag_content FROM tags WHERE guild=?', (guild.id,))
+    cursor.execute('SELECT tag_name, uses, last_used_time FROM tag_usage WHERE guild = ? AND uses > 0 '
+                   'ORDER BY uses DESC, tag_name LIMIT ?', (guild.id, limit))
     res = cursor.fetchall()
     cursor.close()
 
-    tags = {}
-    for tag_name, tag_content in res:
-        tags[tag_name] = tag_content
-    return tags
+    return [(tag_name, uses, datetime.fromtimestamp(last_used_time, tz=timezone.utc)
+             if last_used_time is not None else None) for tag_name, uses, last_used_time in res]
 
 
 def get_footer(guild: discord.Guild, type: str) -> str | None:
@@ -419,3 +1311,6 @@ def set_footer(guild: discord.Guild, footer_text: str | None, type: str) -> None
                        (guild.id,))
     cursor.close()
     sqlite_db.commit()
+
+# Count and time every call to the functions above, by function name
+metrics.instrument_module_functions(globals(), __name__, metrics.db_seconds)
@@ -0,0 +1,91 @@
+"""Diagnostics of the bot, as JSON lines on stdout.
+
+Records are put on a queue where they are logged, and formatted and written by a background thread, so logging never
+waits on stdout in the event loop. LOG_LEVEL sets the default level (default: INFO), and LOG_LEVELS the levels of
+single modules, e.g. `moderation=DEBUG,discord=WARNING`. Records below the level of their logger are dropped before
+anything is formatted.
+
+Fields: time, level, logger and message, with guild_id, event, handler and duration_ms where they are given as
+`extra`, cluster in cluster mode, and exception with the traceback if there is one.
+"""
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+from datetime import datetime, timezone
+
+# Fields that can be passed in `extra` to be written out
+EXTRA_FIELDS = ('guild_id', 'event', 'handler', 'duration_ms')
+
+# Set by cluster.py for every worker process, so the lines of the workers can be told apart
+cluster_id = int(os.environ['CLUSTER_ID']) if 'CLUSTER_ID' in os.environ else None
+
+_listener: logging.handlers.QueueListener | None = None
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for field in EXTRA_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if cluster_id is not None:
+            entry['cluster'] = cluster_id
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class _DeferredQueueHandler(logging.handlers.QueueHandler):
+    # The default prepare() formats the whole record, traceback included, in the logging thread; only the message is
+    # merged here, since its arguments may change after this returns. The writer thread does the rest.
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+def _parse_levels(levels: str) -> dict[str, str]:
+    parsed = {}
+    for entry in levels.split(','):
+        if entry.strip() == '':
+            continue
+        name, _, level = entry.partition('=')
+        parsed[name.strip()] = level.strip().upper()
+    return parsed
+
+
+def setup() -> None:
+    """Send all logging, of the bot and of discord.py, through the queue to the JSON writer."""
+    global _listener
+    if _listener is not None:
+        return
+
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(JsonFormatter())
+    _listener = logging.handlers.QueueListener(log_queue, stream_handler)
+    _listener.start()
+
+    root = logging.getLogger()
+    root.handlers.clear()
+    root.addHandler(_DeferredQueueHandler(log_queue))
+    root.setLevel(os.environ.get('LOG_LEVEL', 'INFO').upper())
+    for name, level in _parse_levels(os.environ.get('LOG_LEVELS', '')).items():
+        logging.getLogger(name).setLevel(level)
+
+
+def stop() -> None:
+    """Write out what is still queued; call before exiting."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
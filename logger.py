@@ -1,12 +1,22 @@
 import discord
 import datetime
+import logging
+
+from typing import List, Literal
+from dateutil.relativedelta import relativedelta
 
 from discord.ext import commands, tasks
+from discord import app_commands
 from common_helpers import get_formatted_user_string
 
-from pprint import pprint
-
 import db
+import metrics
+from shards import get_guilds_by_shard
+
+_log = logging.getLogger(__name__)
+
+# The most periods /activity shows at once, over all of its pages
+MAX_ACTIVITY_BUCKETS = 1000
 
 class LoggerCog(commands.Cog):
     def __init__(self, bot):
@@ -54,14 +64,21 @@ class LoggerCog(commands.Cog):
             if guild.id not in self.last_active_user_channel_update or (datetime.datetime.now(datetime.timezone.utc) - self.last_active_user_channel_update[guild.id]).total_seconds() > 60:
                 self.last_active_user_channel_update[guild.id] = datetime.datetime.now(datetime.timezone.utc)
                 await active_user_stat_channel.edit(name=f'Active Today: {active_user_count} ({active_user_count - last_day_active_user_count})')
-                print(f'Active user count updated for guild {guild.id} to {active_user_count}')
+                _log.debug('Active user count updated to %s', active_user_count, extra={'guild_id': guild.id})
 
     # We also run this function every night at 1 minute past UTC midnight
     @tasks.loop(time=datetime.time(hour=0, minute=1, tzinfo=datetime.timezone.utc))
     async def do_total_user_count_update_globally(self):
-        print('Updating total user count globally')
-        for guild in self.bot.guilds:
-            await self._handle_total_user_count_change(guild)
+        _log.info('Updating total user count globally')
+        guilds_by_shard = get_guilds_by_shard(self.bot)
+        for shard_id, shard in self.bot.shards.items():
+            # Member counts of a disconnected shard are stale, and its stat channels can not be edited right now
+            if shard.is_closed():
+                _log.warning('Skipping total user count update of closed shard %s', shard_id)
+                continue
+
+            for guild in guilds_by_shard[shard_id]:
+                await self._handle_total_user_count_change(guild)
 
     async def _handle_total_user_count_change(self, guild: discord.Guild) -> None:
         db.update_total_user_count(guild)
@@ -77,6 +94,132 @@ class LoggerCog(commands.Cog):
         await total_user_count_stat_channel.edit(name=f'Total Users: {total_user_count} '
                                                       f'({total_user_count - last_day_total_user_count if last_day_total_user_count is not None else 'N/A'})')
 
+    class ActivityView(discord.ui.View):
+        def __init__(self, author: discord.abc.User, pages: List[discord.Embed]):
+            super().__init__(timeout=180)
+            self.author = author
+            self.pages = pages
+            self.page = 0
+            self.message: discord.Message | None = None
+
+        async def interaction_check(self, interaction: discord.Interaction) -> bool:
+            if interaction.user.id != self.author.id:
+                await interaction.response.send_message("You cannot use this button!", ephemeral=True)
+                return False
+            return True
+
+        @discord.ui.button(label='Older', style=discord.ButtonStyle.gray)
+        async def older_button(self, interaction: discord.Interaction, button: discord.ui.Button) -> None:
+            if self.page > 0:
+                self.page -= 1
+                await interaction.response.edit_message(embed=self.pages[self.page], view=self)
+            else:
+                await interaction.response.defer()
+
+        @discord.ui.button(label='Newer', style=discord.ButtonStyle.gray)
+        async def newer_button(self, interaction: discord.Interaction, button: discord.ui.Button) -> None:
+            if self.page < len(self.pages) - 1:
+                self.page += 1
+                await interaction.response.edit_message(embed=self.pages[self.page], view=self)
+            else:
+                await interaction.response.defer()
+
+        async def on_timeout(self) -> None:
+            # Remove buttons when the view times out
+            self.clear_items()
+            if self.message is not None:
+                await self.message.edit(view=self)
+
+    @commands.hybrid_command(name='activity', description='Get the active and total user trends of this guild.')
+    @app_commands.describe(granularity='The size of each period',
+                           periods='The amount of periods to show, ending at the end date; ignored if a start is given',
+                           start='The first day to show, e.g. 2024-01-31',
+                           end='The last day to show, e.g. 2024-03-31; defaults to today')
+    async def activity(self, ctx: commands.Context, granularity: Literal['daily', 'weekly', 'monthly'] = 'daily',
+                       periods: int = 14, start: str | None = None, end: str | None = None) -> None:
+        if ctx.guild is None:
+            await ctx.send('This command can only be used in a guild.', ephemeral=True)
+            return
+
+        try:
+            start_date = datetime.date.fromisoformat(start) if start is not None else None
+            end_date = datetime.date.fromisoformat(end) if end is not None \
+                else datetime.datetime.now(datetime.timezone.utc).date()
+        except ValueError:
+            await ctx.send('Dates must look like 2024-01-31.', ephemeral=True)
+            return
+
+        if start_date is not None and start_date > end_date:
+            await ctx.send('The start date must not be after the end date.', ephemeral=True)
+            return
+
+        if granularity == 'daily':
+            step = relativedelta(days=1)
+        elif granularity == 'weekly':
+            step = relativedelta(weeks=1)
+        else:
+            step = relativedelta(months=1)
+
+        last_bucket = db.get_activity_rollup_bucket(granularity, (end_date - datetime.date(1970, 1, 1)).days)
+        if start_date is not None:
+            first_bucket = db.get_activity_rollup_bucket(granularity, (start_date - datetime.date(1970, 1, 1)).days)
+        else:
+            if periods <= 0:
+                await ctx.send('The amount of periods must be positive.', ephemeral=True)
+                return
+            first_bucket = (db.days_since_epoch_to_date(last_bucket) - step * (periods - 1)
+                            - datetime.date(1970, 1, 1)).days
+
+        # Walk from the first to the last bucket to get the starting day of every bucket we show
+        buckets = []
+        bucket_date = db.days_since_epoch_to_date(first_bucket)
+        while (bucket_date - datetime.date(1970, 1, 1)).days <= last_bucket:
+            buckets.append((bucket_date - datetime.date(1970, 1, 1)).days)
+            if len(buckets) > MAX_ACTIVITY_BUCKETS:
+                await ctx.send(f'That is more than {MAX_ACTIVITY_BUCKETS} periods; use a shorter range or a larger '
+                               f'granularity.', ephemeral=True)
+                return
+            bucket_date += step
+
+        rollups = db.get_activity_rollups(ctx.guild, granularity, buckets[0], buckets[-1])
+
+        date_format_string = '%b %Y' if granularity == 'monthly' else '%d. %b %Y'
+        lines = []
+        for bucket in buckets:
+            active_users, total_users = rollups.get(bucket, (0, None))
+            lines.append(f'{db.days_since_epoch_to_date(bucket).strftime(date_format_string)} - '
+                         f'{active_users} active, {total_users if total_users is not None else 'N/A'} total')
+
+        # Growth over the whole range, from the first and last buckets that have a total user count
+        total_user_counts = [rollups[bucket][1] for bucket in buckets
+                             if bucket in rollups and rollups[bucket][1] is not None]
+        if len(total_user_counts) > 0:
+            total_user_change = (f'{total_user_counts[-1] - total_user_counts[0]:+} '
+                                 f'({total_user_counts[0]} to {total_user_counts[-1]})')
+        else:
+            total_user_change = 'N/A'
+        unique_active_users_30 = db.get_unique_active_user_estimate(ctx.guild, 30)
+        unique_active_users_365 = db.get_unique_active_user_estimate(ctx.guild, 365)
+
+        # One embed shows at most 25 periods; longer ranges are split into pages
+        pages = []
+        for page_start in range(0, len(lines), 25):
+            embed = discord.Embed(title=f'Activity ({granularity})', colour=discord.Colour.blue())
+            embed.description = '\n'.join(lines[page_start:page_start + 25])
+            embed.add_field(name='Total users change', value=total_user_change)
+            embed.add_field(name='Unique active users (30 days)', value=f'~{unique_active_users_30}')
+            embed.add_field(name='Unique active users (365 days)', value=f'~{unique_active_users_365}')
+            if len(lines) > 25:
+                embed.set_footer(text=f'Page {page_start // 25 + 1}/{(len(lines) + 24) // 25}')
+            pages.append(embed)
+
+        if len(pages) == 1:
+            await ctx.send(embed=pages[0])
+            return
+
+        view = self.ActivityView(ctx.author, pages)
+        view.message = await ctx.send(embed=pages[0], view=view)
+
     #
     # Messages
     #
@@ -101,6 +244,7 @@ class LoggerCog(commands.Cog):
 
         embed = discord.Embed()
 
+        metrics.record_cache_lookup('message', event.cached_message is not None)
         if event.cached_message is not None:
             message = event.cached_message
             embed.title = 'Message deleted'
@@ -143,6 +287,7 @@ class LoggerCog(commands.Cog):
         old_content: str | None = None
 
         # If the message is cached, use that to get the old content, else, check the DB
+        metrics.record_cache_lookup('message', event.cached_message is not None)
         if event.cached_message is not None:
             old_content = event.cached_message.content
         else:
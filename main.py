@@ -1,22 +1,42 @@
+import hashlib
+import json
+import logging
 import os
+from time import monotonic, perf_counter
 from typing import Callable, Awaitable
 
 import discord
 from discord.ext import commands
 from discord import app_commands
 
+import cache_policy
 import config
 import db
+import log_setup
 import logger
+import metrics
 import moderation
+import perf
 import tags
 import antispam
+import shards
+
+process_start_time = monotonic()
+
+log_setup.setup()
+_log = logging.getLogger(__name__)
 
 # Read token enviroment variable
 token = os.environ["BOT_TOKEN"]
 
-intents = discord.Intents.all()
-added_cogs = False
+# Intents and caching; see cache_policy for the profiles
+client_options = cache_policy.get_client_options()
+
+# Sharding; leave both unset to let Discord pick the shard count, and run all shards in this process
+shard_count = int(os.environ['SHARD_COUNT']) if 'SHARD_COUNT' in os.environ else None
+shard_ids = [int(shard_id) for shard_id in os.environ['SHARD_IDS'].split(',')] if 'SHARD_IDS' in os.environ else None
+# Sync the command tree even if it did not change, e.g. after it was changed by hand
+force_command_sync = os.environ.get('FORCE_COMMAND_SYNC', '0') == '1'
 
 async def command_error_handler_impl(send_err_embed: Callable[[str], Awaitable[None]],
                                      error: commands.CommandError | app_commands.AppCommandError) -> None:
@@ -48,8 +68,20 @@ async def command_error_handler_impl(send_err_embed: Callable[[str], Awaitable[N
         raise error
 
 class ErrorHandlingTree(app_commands.CommandTree):
+    async def _call(self, interaction: discord.Interaction) -> None:
+        # Every application command, and hybrid command used as one, is run through here
+        start = perf_counter()
+        try:
+            await super()._call(interaction)
+        finally:
+            if interaction.command is not None:
+                perf.record_call(f'/{interaction.command.qualified_name}', 'interaction', perf_counter() - start,
+                                 (interaction,))
+
     async def on_error(self, interaction: discord.Interaction, error: app_commands.AppCommandError) -> None:
-        print('in tree error handler: ', interaction, error)
+        _log.info('Application command error: %s', error,
+                  extra={'guild_id': interaction.guild_id, 'event': 'app_command_error',
+                         'handler': interaction.command.qualified_name if interaction.command is not None else None})
 
         async def send_err_embed(description: str) -> None:
             embed = discord.Embed(description=description, colour=discord.Colour.red())
@@ -57,42 +89,110 @@ class ErrorHandlingTree(app_commands.CommandTree):
 
         await command_error_handler_impl(send_err_embed, error)
 
-class Bot(commands.Bot):
+class Bot(commands.AutoShardedBot):
     def __init__(self):
-        super().__init__(command_prefix='.!', intents=intents, tree_cls=ErrorHandlingTree)
+        super().__init__(command_prefix='.!', tree_cls=ErrorHandlingTree, shard_count=shard_count, shard_ids=shard_ids,
+                         **client_options)
+        # Kept on the bot rather than in a global, so it is plainly per process in cluster mode
+        self.added_cogs = False
+
+    def dispatch(self, event: str, /, *args, **kwargs) -> None:
+        # Every gateway event is first dispatched as socket_event_type, with its type
+        if event == 'socket_event_type':
+            metrics.gateway_events.inc(args[0])
+        super().dispatch(event, *args, **kwargs)
+
+    async def _run_event(self, coro: Callable[..., Awaitable], event_name: str, *args, **kwargs) -> None:
+        # Every listener, of the bot and of the cogs, is run through here in its own task
+        handler = coro.__qualname__
+
+        async def timed_coro(*args, **kwargs) -> None:
+            start = perf_counter()
+            try:
+                await coro(*args, **kwargs)
+            except Exception:
+                metrics.handler_errors.inc(handler)
+                raise
+            finally:
+                perf.record_call(handler, event_name, perf_counter() - start, args)
+
+        await super()._run_event(timed_coro, event_name, *args, **kwargs)
+
+    def _get_command_tree_hash(self) -> str:
+        # The same payloads tree.sync() sends, in a stable order
+        payloads = sorted((command.to_dict(self.tree) for command in self.tree.get_commands()),
+                          key=lambda payload: (payload.get('type', 1), payload['name']))
+        return hashlib.sha256(json.dumps(payloads, sort_keys=True).encode()).hexdigest()
+
+    async def sync_command_tree(self) -> None:
+        # The global sync is slow and rate limited, so it is only done if the commands changed since the last one
+        state_key = f'command_tree_hash:{self.application_id}'
+        command_tree_hash = self._get_command_tree_hash()
+        if not force_command_sync and db.get_bot_state(state_key) == command_tree_hash:
+            _log.info('Application commands unchanged, not syncing')
+            return
+
+        await bot.tree.sync()  # If you want to define specific guilds, pass a discord object with id (Currently, this is global)
+        db.set_bot_state(state_key, command_tree_hash)
+
+        _log.info('Sucessfully synced applications commands')
 
     async def startup(self) -> None:
         await bot.wait_until_ready()
-        await bot.tree.sync()  # If you want to define specific guilds, pass a discord object with id (Currently, this is global)
+        _log.info('All shards ready %.1fs after start', monotonic() - process_start_time)
 
-        print('Sucessfully synced applications commands')
+        # Commands are global, so in cluster mode only one process has to sync them
+        if shards.is_primary_cluster():
+            await self.sync_command_tree()
 
-        print('Init DB for all guilds')
-        for guild in bot.guilds:
-            db.init_guild(guild)
+        _log.info('Finished bot startup of cluster %s, connected as %s with shards %s of %s', shards.cluster_id,
+                  bot.user, sorted(bot.shards), bot.shard_count)
 
-        print(f'Finished bot startup, connected as {bot.user}')
+    async def on_shard_ready(self, shard_id: int) -> None:
+        # Every shard gets its guilds ready on its own, without waiting for the other shards
+        shard_guilds = shards.get_shard_guilds(self, shard_id)
+        db.init_guilds(shard_guilds)
+        _log.info('Shard %s ready with %s guilds %.1fs after start', shard_id, len(shard_guilds),
+                  monotonic() - process_start_time)
 
     async def on_guild_join(self, guild: discord.Guild) -> None:
-        print(f'Joined guild {guild.name} ({guild.id})')
+        _log.info('Joined guild %s', guild.name, extra={'guild_id': guild.id})
         db.init_guild(guild)
 
     async def setup_hook(self) -> None:
-        global added_cogs
-
         # As far as I can tell, if the connection drops, this seems to fire again.
         # Stop adding the same cogs over and over again.
-        if not added_cogs:
+        if not self.added_cogs:
             await self.add_cog(config.ConfigCog(bot))
             await self.add_cog(logger.LoggerCog(bot))
             await self.add_cog(moderation.ModerationCog(bot))
             await self.add_cog(tags.TagCog(bot))
             await self.add_cog(antispam.AntiSpamCog(bot))
-            added_cogs = True
+            await self.add_cog(shards.ShardHealthCog(bot))
+            await self.add_cog(perf.PerfCog(bot))
+            metrics.instrument_bot(self)
+            await metrics.start(shards.cluster_id)
+            self.added_cogs = True
         self.loop.create_task(self.startup())
 
+    async def invoke(self, ctx: commands.Context) -> None:
+        # Prefix commands, including hybrid commands used with the prefix
+        start = perf_counter()
+        try:
+            await super().invoke(ctx)
+        finally:
+            if ctx.command is not None:
+                perf.record_call(f'{self.command_prefix}{ctx.command.qualified_name}', 'message',
+                                 perf_counter() - start, (ctx,))
+
+    async def close(self) -> None:
+        await metrics.stop()
+        await super().close()
+
     async def on_command_error(self, ctx: commands.Context, error: commands.CommandError) -> None:
-        print('in command error handler: ', ctx, error)
+        _log.info('Command error: %s', error,
+                  extra={'guild_id': ctx.guild.id if ctx.guild is not None else None, 'event': 'command_error',
+                         'handler': ctx.command.qualified_name if ctx.command is not None else None})
 
         async def send_err_embed(description: str) -> None:
             embed = discord.Embed(description=description, colour=discord.Colour.red())
@@ -101,4 +201,8 @@ class Bot(commands.Bot):
         await command_error_handler_impl(send_err_embed, error)
 
 bot = Bot()
-bot.run(token)
\ No newline at end of file
+try:
+    # Logging is already set up, so discord.py should not add its own handler
+    bot.run(token, log_handler=None)
+finally:
+    log_setup.stop()
\ No newline at end of file
@@ -0,0 +1,208 @@
+import functools
+import logging
+import os
+from bisect import bisect_left
+from time import perf_counter
+from types import FunctionType
+from typing import Callable, Iterable, List
+
+from aiohttp import web
+
+# Local HTTP endpoint for Prometheus to scrape; in cluster mode, every process listens on the port plus its cluster ID
+metrics_http_port = int(os.environ['METRICS_HTTP_PORT']) if 'METRICS_HTTP_PORT' in os.environ else None
+metrics_http_host = os.environ.get('METRICS_HTTP_HOST', '127.0.0.1')
+
+_log = logging.getLogger(__name__)
+
+_registry: list = []
+_runner: web.AppRunner | None = None
+
+
+def _escape_label_value(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(label_names: tuple[str, ...], label_values: tuple, extra: str = '') -> str:
+    pairs = [f'{name}="{_escape_label_value(value)}"' for name, value in zip(label_names, label_values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if len(pairs) > 0 else ''
+
+
+class Counter:
+    """A value that only goes up, per combination of label values; recording is a single dict update."""
+
+    def __init__(self, name: str, documentation: str, label_names: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.values: dict[tuple, float] = {}
+        _registry.append(self)
+
+    def inc(self, *label_values, amount: float = 1) -> None:
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def expose(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        for label_values, value in self.values.items():
+            lines.append(f'{self.name}{_format_labels(self.label_names, label_values)} {value}')
+        return lines
+
+
+class Histogram:
+    """Distribution of durations in seconds; observations only bump one bucket, and are summed up when scraped."""
+
+    DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, name: str, documentation: str, label_names: Iterable[str] = (),
+                 buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.buckets = buckets
+        # Per label values: [count per bucket, with one more for +Inf], sum
+        self.values: dict[tuple, list] = {}
+        _registry.append(self)
+
+    def observe(self, value: float, *label_values) -> None:
+        entry = self.values.get(label_values)
+        if entry is None:
+            entry = self.values[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+        entry[0][bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+
+    def expose(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        for label_values, (bucket_counts, total) in self.values.items():
+            cumulative = 0
+            for bound, bucket_count in zip((*self.buckets, '+Inf'), bucket_counts):
+                cumulative += bucket_count
+                lines.append(f'{self.name}_bucket'
+                             f'{_format_labels(self.label_names, label_values, f'le="{bound}"')} {cumulative}')
+            lines.append(f'{self.name}_sum{_format_labels(self.label_names, label_values)} {total}')
+            lines.append(f'{self.name}_count{_format_labels(self.label_names, label_values)} {cumulative}')
+        return lines
+
+
+class CallbackGauge:
+    """A value read when scraped, for things the bot already keeps track of, such as gateway latency."""
+
+    def __init__(self, name: str, documentation: str, label_names: Iterable[str],
+                 callback: Callable[[], Iterable[tuple[tuple, float]]]):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.callback = callback
+        _registry.append(self)
+
+    def expose(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} gauge']
+        for label_values, value in self.callback():
+            lines.append(f'{self.name}{_format_labels(self.label_names, label_values)} {value}')
+        return lines
+
+
+gateway_events = Counter('gargibot_gateway_events_total', 'Gateway events received, by type.', ['type'])
+handler_seconds = Histogram('gargibot_handler_seconds', 'Time spent in event handlers.', ['handler'])
+handler_errors = Counter('gargibot_handler_errors_total', 'Event handlers that raised.', ['handler'])
+db_seconds = Histogram('gargibot_db_seconds', 'Time spent in DB functions.', ['function'])
+http_requests = Counter('gargibot_http_requests_total', 'Requests made to the Discord API, by route.',
+                        ['method', 'route'])
+# discord.py handles 429s internally and only logs them, so this counts its warnings on the discord.http logger. It
+# stays at zero if that logger is set above WARNING (e.g. LOG_LEVELS=discord=ERROR), or if the log wording changes.
+http_rate_limits = Counter('gargibot_http_rate_limits_total',
+                           'Rate limits hit on the Discord API, counted from the discord.http warning log; '
+                           'zero if that logger is set above WARNING.', ['scope'])
+antispam_detections = Counter('gargibot_antispam_detections_total', 'Anti-spam detections.', ['result'])
+cache_requests = Counter('gargibot_cache_requests_total', 'Cache lookups, by cache and whether they hit.',
+                         ['cache', 'result'])
+
+
+def record_cache_lookup(cache: str, hit: bool) -> None:
+    cache_requests.inc(cache, 'hit' if hit else 'miss')
+
+
+def instrument_module_functions(module_globals: dict, module_name: str, histogram: Histogram) -> None:
+    """Time every public function defined in a module, labelled with its name, by replacing it in the module.
+
+    Functions of the module calling each other call the wrappers too; only the outermost call is timed, so time is
+    never counted twice. Calls are expected from one thread only, as with the DB.
+    """
+    # Amount of timed calls currently running
+    depth = [0]
+    for name, value in list(module_globals.items()):
+        if isinstance(value, FunctionType) and value.__module__ == module_name and not name.startswith('_'):
+            module_globals[name] = _timed(value, histogram, depth)
+
+
+def _timed(function: FunctionType, histogram: Histogram, depth: list[int]) -> Callable:
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if depth[0] > 0:
+            return function(*args, **kwargs)
+        depth[0] += 1
+        start = perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            depth[0] -= 1
+            histogram.observe(perf_counter() - start, function.__name__)
+    return wrapper
+
+
+class _RateLimitLogHandler(logging.Handler):
+    # discord.py handles 429s itself, and only tells about them in its log
+    def emit(self, record: logging.LogRecord) -> None:
+        if record.msg.startswith('We are being rate limited.'):
+            http_rate_limits.inc('route')
+        elif record.msg.startswith('Global rate limit has been hit.'):
+            http_rate_limits.inc('global')
+
+
+def instrument_bot(bot) -> None:
+    """Count the API requests and rate limits of a bot, and expose its gateway latencies."""
+    original_request = bot.http.request
+
+    async def request(route, **kwargs):
+        # The path is the route template, such as /channels/{channel_id}/messages, so the labels stay few
+        http_requests.inc(route.method, route.path)
+        return await original_request(route, **kwargs)
+
+    bot.http.request = request
+
+    rate_limit_handler = _RateLimitLogHandler(level=logging.WARNING)
+    logging.getLogger('discord.http').addHandler(rate_limit_handler)
+
+    CallbackGauge('gargibot_gateway_latency_seconds', 'Heartbeat latency of each shard.', ['shard'],
+                  lambda: [((shard_id,), latency) for shard_id, latency in bot.latencies
+                           if latency == latency])  # NaN before the first heartbeat
+
+
+async def _handle_metrics(request: web.Request) -> web.Response:
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.expose())
+    return web.Response(text='\n'.join(lines) + '\n', content_type='text/plain', charset='utf-8',
+                        headers={'X-Content-Type-Options': 'nosniff'})
+
+
+async def start(cluster_id: int = 0) -> None:
+    """Start the metrics server in the running event loop, if METRICS_HTTP_PORT is set."""
+    global _runner
+    if metrics_http_port is None or _runner is not None:
+        return
+
+    app = web.Application()
+    app.router.add_get('/metrics', _handle_metrics)
+
+    _runner = web.AppRunner(app, access_log=None)
+    await _runner.setup()
+    await web.TCPSite(_runner, metrics_http_host, metrics_http_port + cluster_id).start()
+    _log.info('Metrics server listening on %s:%s', metrics_http_host, metrics_http_port + cluster_id)
+
+
+async def stop() -> None:
+    global _runner
+    if _runner is not None:
+        await _runner.cleanup()
+        _runner = None
@@ -1,28 +1,123 @@
-from datetime import datetime, UTC, timezone, timedelta
-from typing import Literal, List
+from datetime import datetime, UTC, timedelta
+from typing import Callable, Literal, List
 from dateutil.relativedelta import relativedelta
-from pathlib import Path
 
+import asyncio
 import discord
-import os
+import logging
+import re
+from time import monotonic
 import db
+import purge_logs
+import purge_log_server
+import shards
+from scheduler import TimedActionScheduler
 from pytimeparse.timeparse import timeparse
 
-from discord.ext import commands
+from discord.ext import commands, tasks
 from discord.ui import Button, View
 from discord import app_commands
 
 from common_helpers import get_formatted_user_string
 
-purge_logs_location = Path(os.environ.get('PURGE_LOGS_LOCATION', 'purge_logs/'))
-purge_logs_location.mkdir(parents=True, exist_ok=True)
+_log = logging.getLogger(__name__)
 
-purge_logs_url_prepend = os.environ.get('PURGE_LOGS_URL_PREPEND')
+# Limits for /massban; the bulk ban endpoint takes up to 200 users per request, and the fallback bans this many users
+# at once
+massban_bulk_chunk_size = 200
+massban_concurrency = 5
+
+# Discord does not allow timeouts longer than this; longer mutes are re-applied by the scheduler shortly before the
+# current timeout runs out
+max_timeout_duration = timedelta(days=28)
+timeout_reapply_margin = timedelta(hours=1)
+
+# How often banstats may pull new ban entries from the audit log of a guild
+audit_log_ban_sync_interval = timedelta(seconds=60)
+
+
+class MassbanFlags(commands.FlagConverter):
+    # With the prefix, everything up to the first flag is user IDs: `.!massban 111 222 reason: spam`; the message
+    # range is only ever taken from explicit first_message_id:/last_message_id: flags
+    user_ids: str | None = commands.flag(default=None, positional=True,
+                                         description='The IDs or mentions of the users to ban, separated by spaces.')
+    first_message_id: str | None = commands.flag(
+        default=None, description='Ban the authors of the messages starting at this message.')
+    last_message_id: str | None = commands.flag(
+        default=None, description='Ban the authors of the messages up to this message.')
+    reason: str | None = commands.flag(default=None, description='The reason for the bans.')
 
 
 class ModerationCog(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
+        self.audit_log_sync_locks: dict[int, asyncio.Lock] = {}
+        self.last_audit_log_sync: dict[int, datetime] = {}
+        # Purge logs are shared by all processes in cluster mode, so only one of them cleans them up and serves them
+        if shards.is_primary_cluster():
+            self.enforce_purge_log_retention.start()
+        self.scheduler = TimedActionScheduler(self._run_scheduled_action,
+                                              lambda guild_id: shards.owns_guild(self.bot, guild_id))
+
+    async def cog_load(self) -> None:
+        self.scheduler.start()
+        if shards.is_primary_cluster():
+            await purge_log_server.start()
+
+    async def cog_unload(self) -> None:
+        self.scheduler.stop()
+        await purge_log_server.stop()
+
+    async def _apply_long_timeout(self, member: discord.Member, until: datetime, reason: str | None) -> None:
+        # Time out for as long as Discord allows, and schedule the next timeout if that is not enough
+        remaining = until - datetime.now(UTC)
+        if remaining <= timedelta(0):
+            return
+
+        await member.timeout(min(remaining, max_timeout_duration), reason=reason)
+        if remaining > max_timeout_duration:
+            self.scheduler.schedule(member.guild.id, member.id, 'timeout',
+                                    int((datetime.now(UTC) + max_timeout_duration - timeout_reapply_margin).timestamp()),
+                                    data=str(int(until.timestamp())))
+
+    async def _run_scheduled_action(self, scheduled_action: db.ScheduledAction) -> None:
+        await self.bot.wait_until_ready()
+
+        guild = self.bot.get_guild(scheduled_action.guild_id)
+        if guild is None:
+            # Unavailable during an outage; fail so the scheduler keeps the action and retries it
+            raise RuntimeError(f'Guild {scheduled_action.guild_id} is not available')
+
+        if scheduled_action.action == 'unban':
+            try:
+                await guild.unban(discord.Object(id=scheduled_action.user_id), reason='Temporary ban expired')
+            except discord.NotFound:
+                return
+
+            db.add_case(guild, scheduled_action.user_id, self.bot.user.id, 'unban', 'Temporary ban expired')
+
+            embed = discord.Embed(title='Member unbanned', colour=discord.Colour.green())
+            embed.add_field(name='Member', value=f'<@{scheduled_action.user_id}> ({scheduled_action.user_id})')
+            embed.add_field(name='Reason', value='Temporary ban expired')
+            await self._send_embed_to_log(guild, embed)
+        elif scheduled_action.action == 'timeout':
+            try:
+                member = guild.get_member(scheduled_action.user_id) or await guild.fetch_member(scheduled_action.user_id)
+            except discord.NotFound:
+                # Left the guild; they will not be muted when they come back, same as a plain timeout
+                return
+
+            assert scheduled_action.data is not None
+            await self._apply_long_timeout(member, datetime.fromtimestamp(int(scheduled_action.data), tz=UTC),
+                                           reason='Re-applying long mute')
+        else:
+            _log.error('Unknown scheduled action %s', scheduled_action, extra={'guild_id': scheduled_action.guild_id})
+
+    @tasks.loop(hours=1)
+    async def enforce_purge_log_retention(self) -> None:
+        compressed_count, deleted_count = await purge_logs.enforce_retention()
+        if compressed_count != 0 or deleted_count != 0:
+            _log.info('Purge log retention: compressed %s, deleted %s logs', compressed_count, deleted_count)
 
     def _create_success_embed(self, user_affected: discord.User | discord.Member, type: str,
                               guild: discord.Guild) -> discord.Embed:
@@ -75,7 +170,9 @@ class ModerationCog(commands.Cog):
     async def _send_dm(self, user_affected: discord.User | discord.Member, action_type: str, ctx: commands.Context,
                        reason: str | None = None) -> bool:
         embed = discord.Embed()
-        embed.title = f'You have been {action_type} from {ctx.guild.name}.'
+        # Warnings are given in a guild; everything else removes the user from it
+        preposition = 'in' if action_type == 'warned' else 'from'
+        embed.title = f'You have been {action_type} {preposition} {ctx.guild.name}.'
         if reason is None:
             embed.description = f'You have been {action_type}.'
         else:
@@ -98,25 +195,54 @@ class ModerationCog(commands.Cog):
             fail_embed.title = f'Failed to send DM to {user_affected.name}!'
             fail_embed.description = f'Normally this means that the user has their DMs closed.'
             await ctx.send(embed=fail_embed)
-            print(f'Failed to send DM to {user_affected.name} with Forbidden!')
+            _log.info('Failed to send DM to %s with Forbidden', user_affected.name,
+                      extra={'guild_id': ctx.guild.id, 'event': action_type})
             return False
         except discord.HTTPException:
-            print(f'Failed to send DM to {user_affected.name} with HTTPException!')
+            _log.warning('Failed to send DM to %s with HTTPException', user_affected.name,
+                         extra={'guild_id': ctx.guild.id, 'event': action_type})
             return False
         return True
 
+    def _log_action_timings(self, action: str, guild: discord.Guild, user_affected: discord.User | discord.Member,
+                            timings: dict[str, float]) -> None:
+        _log.debug('%s %s took %s', action, user_affected.name,
+                   ', '.join(f'{phase} {duration * 1000:.0f}ms' for phase, duration in timings.items()),
+                   extra={'guild_id': guild.id, 'event': action,
+                          'duration_ms': round(sum(timings.values()) * 1000, 1)})
+
     async def do_ban(self, ctx: commands.Context, user_to_ban: discord.User | discord.Member, *,
-                      reason: str | None = None) -> None:
-        print(f'Banning user {user_to_ban.name} (responsible mod: {ctx.author.name})')
+                      reason: str | None = None, duration: int | None = None) -> None:
+        _log.info('Banning user %s (responsible mod: %s)', user_to_ban.name, ctx.author.name,
+                  extra={'guild_id': ctx.guild.id, 'event': 'ban'})
+        timings: dict[str, float] = {}
+
+        # The DM has to go out before the ban, or the user can not receive it anymore
+        phase_start = monotonic()
         await self._send_dm(user_to_ban, action_type='banned', reason=reason, ctx=ctx)
+        timings['dm'] = monotonic() - phase_start
 
+        phase_start = monotonic()
         await ctx.guild.ban(user=user_to_ban, reason=f'By {ctx.author.name} - {reason}', delete_message_days=0)
+        timings['ban'] = monotonic() - phase_start
+
+        # A permanent ban replaces a temporary one; do_tempban schedules the new unban after this
+        if duration is None:
+            self.scheduler.cancel(ctx.guild.id, user_to_ban.id, 'unban')
+
+        # Nothing after the ban depends on each other; record it, and post the confirmation and log at the same time
+        phase_start = monotonic()
         db.add_ban(ctx.guild, banned_user=user_to_ban, responsible_mod=ctx.author)
-        await ctx.send(embed=self._create_success_embed(user_affected=user_to_ban, type="banned", guild=ctx.guild))
-        await self._send_embed_to_log(ctx.guild, self._create_log_embed(user_affected=user_to_ban,
-                                                                        responsible_mod=ctx.author,
-                                                                        reason=reason,
-                                                                        log_type='banned'))
+        db.add_case(ctx.guild, user_to_ban.id, ctx.author.id, 'ban', reason, duration)
+        await asyncio.gather(
+            ctx.send(embed=self._create_success_embed(user_affected=user_to_ban, type="banned", guild=ctx.guild)),
+            self._send_embed_to_log(ctx.guild, self._create_log_embed(user_affected=user_to_ban,
+                                                                      responsible_mod=ctx.author,
+                                                                      reason=reason,
+                                                                      log_type='banned'))
+        )
+        timings['record'] = monotonic() - phase_start
+        self._log_action_timings('Ban of', ctx.guild, user_to_ban, timings)
 
     @commands.hybrid_command(name='ban', description='Ban a member from this guild.', aliases=['naenae'])
     @commands.has_permissions(ban_members=True)
@@ -180,6 +306,196 @@ class ModerationCog(commands.Cog):
 
         await self.do_ban(ctx, user_to_ban, reason=reason)
 
+    async def _massban_user_ids(self, guild: discord.Guild, user_ids: List[int], reason: str,
+                                on_banned: Callable[[List[int]], None]) -> tuple[List[int], List[int]]:
+        # on_banned is called with the users of every chunk, or single ban, as soon as it is done
+        banned: List[int] = []
+        failed: List[int] = []
+
+        # Use the bulk ban endpoint where we can
+        remaining = list(user_ids)
+        if hasattr(guild, 'bulk_ban'):
+            try:
+                while len(remaining) > 0:
+                    chunk = remaining[:massban_bulk_chunk_size]
+                    result = await guild.bulk_ban([discord.Object(id=user_id) for user_id in chunk], reason=reason,
+                                                  delete_message_seconds=0)
+                    banned += [user.id for user in result.banned]
+                    failed += [user.id for user in result.failed]
+                    on_banned([user.id for user in result.banned])
+                    remaining = remaining[massban_bulk_chunk_size:]
+            except discord.HTTPException as e:
+                # Bulk banning needs manage guild on top of ban members; fall back to banning one by one
+                _log.warning('Bulk ban failed, falling back to single bans: %s', e,
+                             extra={'guild_id': guild.id, 'event': 'massban'})
+
+        # Otherwise, ban with a bounded amount of concurrent requests
+        semaphore = asyncio.Semaphore(massban_concurrency)
+
+        async def ban_one(user_id: int) -> None:
+            async with semaphore:
+                try:
+                    await guild.ban(discord.Object(id=user_id), reason=reason, delete_message_seconds=0)
+                    banned.append(user_id)
+                    on_banned([user_id])
+                except discord.HTTPException:
+                    failed.append(user_id)
+
+        await asyncio.gather(*[ban_one(user_id) for user_id in remaining])
+        return banned, failed
+
+    async def _get_authors_in_message_range(self, channel: discord.abc.Messageable, first_message_id: int,
+                                            last_message_id: int) -> List[int]:
+        author_ids: dict[int, None] = {}
+        async for message in channel.history(limit=None, after=discord.Object(id=first_message_id - 1),
+                                             before=discord.Object(id=last_message_id + 1)):
+            author_ids[message.author.id] = None
+        return list(author_ids.keys())
+
+    @commands.hybrid_command(name='massban', description='Ban many users at once.')
+    @commands.has_permissions(ban_members=True)
+    async def massban(self, ctx: commands.Context, *, flags: MassbanFlags) -> None:
+        user_ids, reason = flags.user_ids, flags.reason
+        first_message_id, last_message_id = flags.first_message_id, flags.last_message_id
+
+        if ctx.guild is None:
+            await ctx.send('This command can only be used in a guild.', ephemeral=True)
+            return
+
+        if ctx.author is None:
+            await ctx.send('Somehow, the author of the command could not be determined; '
+                           'please report this bug to electrode!', ephemeral=True)
+            return
+
+        if (first_message_id is None) != (last_message_id is None):
+            await ctx.send('Pass both the first and the last message ID.', ephemeral=True)
+            return
+
+        await ctx.defer()
+
+        targets: dict[int, None] = {}
+        if user_ids is not None:
+            for user_id in re.findall(r'\d{15,21}', user_ids):
+                targets[int(user_id)] = None
+        if first_message_id is not None and last_message_id is not None:
+            if not first_message_id.isdigit() or not last_message_id.isdigit():
+                await ctx.send('The message IDs must be numbers.', ephemeral=True)
+                return
+            first, last = sorted([int(first_message_id), int(last_message_id)])
+            for author_id in await self._get_authors_in_message_range(ctx.channel, first, last):
+                targets[author_id] = None
+
+        # Never ban ourselves or the moderator
+        targets.pop(self.bot.user.id, None)
+        targets.pop(ctx.author.id, None)
+
+        if len(targets) == 0:
+            await ctx.send('No users to ban.', ephemeral=True)
+            return
+
+        class MassbanConfirmView(View):
+            def __init__(self, cog, ctx, user_ids, reason):
+                super().__init__(timeout=60)
+                self.cog = cog
+                self.ctx = ctx
+                self.user_ids = user_ids
+                self.reason = reason
+
+                confirm = Button(label=f"Ban {len(user_ids)} Users", style=discord.ButtonStyle.red)
+                confirm.callback = self.confirm_callback
+                self.add_item(confirm)
+
+                cancel = Button(label="Cancel", style=discord.ButtonStyle.grey)
+                cancel.callback = self.cancel_callback
+                self.add_item(cancel)
+
+            async def confirm_callback(self, interaction: discord.Interaction):
+                if interaction.user.id != self.ctx.author.id:
+                    await interaction.response.send_message("You cannot use this button!", ephemeral=True)
+                    return
+
+                await interaction.response.edit_message(view=None)
+                await self.cog.do_massban(self.ctx, self.user_ids, reason=self.reason)
+
+            async def cancel_callback(self, interaction: discord.Interaction):
+                if interaction.user.id != self.ctx.author.id:
+                    await interaction.response.send_message("You cannot use this button!", ephemeral=True)
+                    return
+
+                await interaction.message.edit(view=None)
+                await interaction.response.send_message("Mass ban cancelled.")
+
+        view = MassbanConfirmView(self, ctx, list(targets.keys()), reason)
+        await ctx.send(f'About to ban {len(targets)} users. Are you sure?', view=view)
+
+    async def do_massban(self, ctx: commands.Context, user_ids: List[int], *, reason: str | None = None) -> None:
+        _log.info('Mass banning %s users (responsible mod: %s)', len(user_ids), ctx.author.name,
+                  extra={'guild_id': ctx.guild.id, 'event': 'massban'})
+        def record_bans(banned_user_ids: List[int]) -> None:
+            # Written as every chunk finishes, so the ban times stay close to the audit log entries
+            db.add_bans(ctx.guild, ctx.author, banned_user_ids, reason)
+            # Mass bans are permanent, so they replace any temporary ban
+            self.scheduler.cancel_many(ctx.guild.id, banned_user_ids, 'unban')
+
+        banned, failed = await self._massban_user_ids(ctx.guild, user_ids, reason=f'By {ctx.author.name} - {reason}',
+                                                      on_banned=record_bans)
+
+        embed = discord.Embed(title='Members banned', colour=discord.Colour.red())
+        embed.description = f'Banned **{len(banned)}** users.'
+        if len(failed) > 0:
+            embed.description += f' Failed to ban {len(failed)} users.'
+        embed.set_thumbnail(url=db.get_ban_image_url(ctx.guild))
+        await ctx.send(embed=embed)
+
+        # One log embed for all of them; the field value limit is 1024 characters
+        embed = discord.Embed(title='Members mass banned', colour=discord.Colour.red())
+        banned_string = ', '.join(str(user_id) for user_id in banned)
+        embed.add_field(name=f'Members ({len(banned)})',
+                        value=banned_string if len(banned_string) <= 1024 else banned_string[:1020] + '...',
+                        inline=False)
+        if len(failed) > 0:
+            embed.add_field(name='Failed', value=str(len(failed)))
+        embed.add_field(name='Responsible Moderator', value=ctx.author)
+        embed.add_field(name='Reason', value='(none)' if reason is None else reason)
+        await self._send_embed_to_log(ctx.guild, embed)
+
+    @commands.hybrid_command(name='tempban', description='Ban a member from this guild for some time.')
+    @commands.has_permissions(ban_members=True)
+    @app_commands.describe(user_to_ban='The user to ban.', duration='How long to ban for, e.g. 7d.',
+                           reason='The reason for the ban.')
+    async def tempban(self, ctx: commands.Context, user_to_ban: discord.User | discord.Member, duration: str, *,
+                      reason: str | None = None) -> None:
+        if ctx.guild is None:
+            await ctx.send('This command can only be used in a guild.', ephemeral=True)
+            return
+
+        if user_to_ban.id == self.bot.user.id:
+            await ctx.send('You cannot ban me!', ephemeral=True)
+            return
+
+        if ctx.author is None:
+            await ctx.send('Somehow, the author of the command could not be determined; '
+                           'please report this bug to electrode!', ephemeral=True)
+            return
+
+        duration_seconds = timeparse(duration)
+        if duration_seconds is None or duration_seconds <= 0:
+            await ctx.send('Could not parse the duration; use something like `7d` or `12h`.', ephemeral=True)
+            return
+
+        await self.do_tempban(ctx, user_to_ban, int(duration_seconds), reason=reason)
+
+    async def do_tempban(self, ctx: commands.Context, user_to_ban: discord.User | discord.Member, duration: int, *,
+                         reason: str | None = None) -> None:
+        await self.do_ban(ctx, user_to_ban, reason=reason, duration=duration)
+
+        # A new temporary ban replaces any earlier one
+        self.scheduler.cancel(ctx.guild.id, user_to_ban.id, 'unban')
+        unban_time = datetime.now(UTC) + timedelta(seconds=duration)
+        self.scheduler.schedule(ctx.guild.id, user_to_ban.id, 'unban', int(unban_time.timestamp()))
+        await ctx.send(embed=self._create_text_embed(f'{user_to_ban.name} will be unbanned '
+                                                     f'<t:{int(unban_time.timestamp())}:R>.'))
+
     @commands.hybrid_command(name='kick', description='Kick a member from this guild.', aliases=['dabon'])
     @commands.has_permissions(kick_members=True)
     @app_commands.describe(user_to_kick='The user to kick.', reason='The reason for the kick.')
@@ -198,15 +514,30 @@ class ModerationCog(commands.Cog):
                            'please report this bug to electrode!', ephemeral=True)
             return
 
-        print(f'Kicking user {user_to_kick.name} (responsible mod: {ctx.author.name})')
+        _log.info('Kicking user %s (responsible mod: %s)', user_to_kick.name, ctx.author.name,
+                  extra={'guild_id': ctx.guild.id, 'event': 'kick'})
+        timings: dict[str, float] = {}
+
+        # The DM has to go out before the kick, or the user can not receive it anymore
+        phase_start = monotonic()
         await self._send_dm(user_to_kick, action_type='kicked', reason=reason, ctx=ctx)
+        timings['dm'] = monotonic() - phase_start
 
+        phase_start = monotonic()
         await ctx.guild.kick(user=user_to_kick, reason=reason)
-        await ctx.send(embed=self._create_success_embed(user_affected=user_to_kick, type="kicked", guild=ctx.guild))
-        await self._send_embed_to_log(ctx.guild, self._create_log_embed(user_affected=user_to_kick,
-                                                                        responsible_mod=ctx.author,
-                                                                        reason=reason,
-                                                                        log_type='kicked'))
+        timings['kick'] = monotonic() - phase_start
+
+        phase_start = monotonic()
+        db.add_case(ctx.guild, user_to_kick.id, ctx.author.id, 'kick', reason)
+        await asyncio.gather(
+            ctx.send(embed=self._create_success_embed(user_affected=user_to_kick, type="kicked", guild=ctx.guild)),
+            self._send_embed_to_log(ctx.guild, self._create_log_embed(user_affected=user_to_kick,
+                                                                      responsible_mod=ctx.author,
+                                                                      reason=reason,
+                                                                      log_type='kicked'))
+        )
+        timings['record'] = monotonic() - phase_start
+        self._log_action_timings('Kick of', ctx.guild, user_to_kick, timings)
 
     @commands.hybrid_command(name='unban', description='Unban a member from this guild.', aliases=['whip'])
     @commands.has_permissions(ban_members=True)
@@ -222,12 +553,15 @@ class ModerationCog(commands.Cog):
                            'please report this bug to electrode!', ephemeral=True)
             return
 
-        print(f'Unbanning user {user_to_unban.name} (responsible mod: {ctx.author.name})')
+        _log.info('Unbanning user %s (responsible mod: %s)', user_to_unban.name, ctx.author.name,
+                  extra={'guild_id': ctx.guild.id, 'event': 'unban'})
+        self.scheduler.cancel(ctx.guild.id, user_to_unban.id, 'unban')
         try:
             await ctx.guild.unban(user=user_to_unban, reason=reason)
         except discord.errors.NotFound:
             await ctx.send(embed=self._create_text_embed('This user is not banned!'))
             return
+        db.add_case(ctx.guild, user_to_unban.id, ctx.author.id, 'unban', reason)
         await ctx.send(embed=self._create_success_embed(user_affected=user_to_unban, type="unbanned", guild=ctx.guild))
         await self._send_embed_to_log(ctx.guild, self._create_log_embed(user_affected=user_to_unban,
                                                                         responsible_mod=ctx.author,
@@ -280,23 +614,40 @@ class ModerationCog(commands.Cog):
             mute_time_delta = timedelta(days=28)
             indefinite_mute = True
 
-        await user_to_mute.timeout(mute_time_delta, reason=f'By {ctx.author.name} - {reason}')
+        await self.do_mute(ctx, user_to_mute, mute_time_delta, indefinite_mute=indefinite_mute, reason=reason)
+
+    async def do_mute(self, ctx: commands.Context, user_to_mute: discord.Member, mute_time_delta: timedelta, *,
+                      indefinite_mute: bool = False, reason: str | None = None) -> None:
+        timings: dict[str, float] = {}
+
+        # A new mute replaces any long mute still being re-applied
+        self.scheduler.cancel(ctx.guild.id, user_to_mute.id, 'timeout')
+
+        phase_start = monotonic()
+        await self._apply_long_timeout(user_to_mute, datetime.now(UTC) + mute_time_delta,
+                                       reason=f'By {ctx.author.name} - {reason}')
+        timings['mute'] = monotonic() - phase_start
 
         # Send the embed that is sent into the channel
         embed = discord.Embed(description=f'Muted {user_to_mute.mention} '
                                           f'{('for' + str(mute_time_delta)) if not indefinite_mute else 'indefinitely'}'
                                           f' - `{reason}`', color=discord.Color.orange())
-        await ctx.send(embed=embed)
 
         # Send a log for this
-        embed = self._create_log_embed(user_affected=user_to_mute,
-                                       responsible_mod=ctx.author,
-                                       reason=reason,
-                                       log_type='muted')
-        embed.add_field(name='Duration', value=str(mute_time_delta)
-                                               + (' (as long as possible)' if indefinite_mute else ''),
-                        inline=False)
-        await self._send_embed_to_log(ctx.guild, embed)
+        log_embed = self._create_log_embed(user_affected=user_to_mute,
+                                           responsible_mod=ctx.author,
+                                           reason=reason,
+                                           log_type='muted')
+        log_embed.add_field(name='Duration', value=str(mute_time_delta)
+                                                   + (' (as long as possible)' if indefinite_mute else ''),
+                            inline=False)
+
+        phase_start = monotonic()
+        db.add_case(ctx.guild, user_to_mute.id, ctx.author.id, 'mute', reason,
+                    None if indefinite_mute else int(mute_time_delta.total_seconds()))
+        await asyncio.gather(ctx.send(embed=embed), self._send_embed_to_log(ctx.guild, log_embed))
+        timings['record'] = monotonic() - phase_start
+        self._log_action_timings('Mute of', ctx.guild, user_to_mute, timings)
 
     @commands.hybrid_command(name='unmute', description='Unmute a member from this guild.', aliases=['unshush'])
     @commands.has_permissions(kick_members=True)
@@ -319,7 +670,9 @@ class ModerationCog(commands.Cog):
             await ctx.send('This user is not muted!', ephemeral=True)
             return
 
+        self.scheduler.cancel(ctx.guild.id, user_to_unmute.id, 'timeout')
         await user_to_unmute.timeout(None, reason=f'By - {ctx.author.name}')
+        db.add_case(ctx.guild, user_to_unmute.id, ctx.author.id, 'unmute')
 
         embed = discord.Embed(description=f'Unmuted {user_to_unmute.mention}.', color=discord.Color.green())
         await ctx.send(embed=embed)
@@ -330,12 +683,218 @@ class ModerationCog(commands.Cog):
                                        log_type='unmuted')
         await self._send_embed_to_log(ctx.guild, embed)
 
+    @commands.hybrid_command(name='warn', description='Warn a member of this guild.')
+    @commands.has_permissions(kick_members=True)
+    @app_commands.describe(user_to_warn='The user to warn.', reason='The reason for the warning.')
+    async def warn(self, ctx: commands.Context, user_to_warn: discord.Member, *, reason: str | None = None) -> None:
+        if ctx.guild is None:
+            await ctx.send('This command can only be used in a guild.', ephemeral=True)
+            return
+
+        if user_to_warn.id == self.bot.user.id:
+            await ctx.send('You cannot warn me!', ephemeral=True)
+            return
+
+        if ctx.author is None:
+            await ctx.send('Somehow, the author of the command could not be determined; '
+                           'please report this bug to electrode!', ephemeral=True)
+            return
+
+        _log.info('Warning user %s (responsible mod: %s)', user_to_warn.name, ctx.author.name,
+                  extra={'guild_id': ctx.guild.id, 'event': 'warn'})
+        active_counts, reached_rules = db.add_warning(ctx.guild, user_to_warn.id, ctx.author.id, reason)
+
+        embed = discord.Embed(description=f'Warned {user_to_warn.mention} - `{reason}`', color=discord.Color.yellow())
+        log_embed = self._create_log_embed(user_affected=user_to_warn,
+                                           responsible_mod=ctx.author,
+                                           reason=reason,
+                                           log_type='warned')
+        for window, active_count in sorted(active_counts.items()):
+            log_embed.add_field(name=f'Warnings in {timedelta(seconds=window)}', value=str(active_count))
+        await asyncio.gather(self._send_dm(user_to_warn, action_type='warned', reason=reason, ctx=ctx),
+                             ctx.send(embed=embed),
+                             self._send_embed_to_log(ctx.guild, log_embed))
+
+        if len(reached_rules) == 0:
+            return
+
+        # Only the most severe action, if a warning reaches several rules at once
+        rule = max(reached_rules, key=lambda rule: (rule.action == 'ban',
+                                                    rule.duration if rule.duration is not None else float('inf')))
+        escalation_reason = f'{rule.threshold} warnings in {timedelta(seconds=rule.window)}'
+        _log.info('Escalating warnings of %s to %s', user_to_warn.name, rule,
+                  extra={'guild_id': ctx.guild.id, 'event': 'warn'})
+        if rule.action == 'ban':
+            if rule.duration is None:
+                await self.do_ban(ctx, user_to_warn, reason=escalation_reason)
+            else:
+                await self.do_tempban(ctx, user_to_warn, rule.duration, reason=escalation_reason)
+        elif rule.action == 'mute':
+            if rule.duration is None:
+                await self.do_mute(ctx, user_to_warn, max_timeout_duration, indefinite_mute=True,
+                                   reason=escalation_reason)
+            else:
+                await self.do_mute(ctx, user_to_warn, timedelta(seconds=rule.duration), reason=escalation_reason)
+
+    @app_commands.command(name='warn_rule', description='Set what happens when a member gets too many warnings.')
+    @app_commands.checks.has_permissions(administrator=True)
+    @app_commands.describe(threshold='The amount of warnings that triggers the action.',
+                           window='The time the warnings have to be in, e.g. 7d.',
+                           action='The action to take, or remove to remove the rule.',
+                           duration='How long to mute or ban for, e.g. 1d; leave empty for as long as possible.')
+    async def warn_rule(self, interaction: discord.Interaction, threshold: app_commands.Range[int, 1, 100],
+                        window: str, action: Literal['mute', 'ban', 'remove'], duration: str | None = None) -> None:
+        if interaction.guild is None:
+            await interaction.response.send_message('This command can only be used in a guild.', ephemeral=True)
+            return
+
+        window_seconds = timeparse(window)
+        if window_seconds is None or window_seconds <= 0:
+            await interaction.response.send_message('Could not parse the window; use something like `7d`.',
+                                                    ephemeral=True)
+            return
+        window_seconds = int(window_seconds)
+
+        if action == 'remove':
+            if db.remove_warn_rule(interaction.guild, threshold, window_seconds):
+                await interaction.response.send_message(embed=self._create_text_embed(
+                    f'Removed the rule for {threshold} warnings in {timedelta(seconds=window_seconds)}.'))
+            else:
+                await interaction.response.send_message('There is no such rule!', ephemeral=True)
+            return
+
+        duration_seconds = None
+        if duration is not None:
+            duration_seconds = timeparse(duration)
+            if duration_seconds is None or duration_seconds <= 0:
+                await interaction.response.send_message('Could not parse the duration; use something like `1d`.',
+                                                        ephemeral=True)
+                return
+            duration_seconds = int(duration_seconds)
+
+        db.set_warn_rule(interaction.guild, threshold, window_seconds, action, duration_seconds)
+        await interaction.response.send_message(embed=self._create_text_embed(
+            f'{threshold} warnings in {timedelta(seconds=window_seconds)} now lead to a {action}'
+            f'{f' for {timedelta(seconds=duration_seconds)}' if duration_seconds is not None else ''}.'))
+
+    @app_commands.command(name='warn_rules', description='List what happens when a member gets too many warnings.')
+    async def warn_rules(self, interaction: discord.Interaction) -> None:
+        if interaction.guild is None:
+            await interaction.response.send_message('This command can only be used in a guild.', ephemeral=True)
+            return
+
+        rules = sorted((rule for rules_by_threshold in db.get_warn_rules(interaction.guild).values()
+                        for rule in rules_by_threshold.values()), key=lambda rule: (rule.window, rule.threshold))
+        embed = discord.Embed(title='Warning rules')
+        if len(rules) == 0:
+            embed.description = 'No rules set; warnings do not lead to anything.'
+        else:
+            embed.description = '\n'.join(
+                f'{rule.threshold} warnings in {timedelta(seconds=rule.window)} → {rule.action}'
+                f'{f' for {timedelta(seconds=rule.duration)}' if rule.duration is not None else ''}'
+                for rule in rules)
+        await interaction.response.send_message(embed=embed)
+
+    @staticmethod
+    def _format_case(case: db.Case) -> str:
+        duration = f' for {timedelta(seconds=case.duration)}' if case.duration is not None else ''
+        reason = f' - `{case.reason[:40]}`' if case.reason is not None else ''
+        return (f'**#{case.case_id}** {case.action}{duration} of <@{case.user_id}> by <@{case.moderator_id}> '
+                f'<t:{int(case.created_time.timestamp())}:R>{reason}')
+
+    @staticmethod
+    def _format_cases_field(cases: List[db.Case], case_count: int) -> str:
+        # Embed field values are limited to 1024 characters; leave out the cases that do not fit
+        lines = []
+        length = 0
+        for case in cases:
+            line = ModerationCog._format_case(case)
+            if length + len(line) + 1 + len('\n...') > 1024:
+                break
+            lines.append(line)
+            length += len(line) + 1
+        value = '\n'.join(lines)
+        if case_count > len(lines):
+            value += '\n...'
+        return value[:1024]
+
+    class CasesView(View):
+        def __init__(self, author: discord.abc.User, guild: discord.Guild, user_id: int | None,
+                     moderator_id: int | None, per_page: int = 10):
+            super().__init__(timeout=180)
+            self.author = author
+            self.guild = guild
+            self.user_id = user_id
+            self.moderator_id = moderator_id
+            self.per_page = per_page
+            self.cases: List[db.Case] = []
+            self.message: discord.Message | None = None
+
+        def load_page(self, before_case_id: int | None = None, after_case_id: int | None = None) -> bool:
+            """Load the page of cases older or newer than a case; keeps the current page if there is none."""
+            cases = db.get_cases(self.guild, user_id=self.user_id, moderator_id=self.moderator_id,
+                                 before_case_id=before_case_id, after_case_id=after_case_id, limit=self.per_page)
+            if len(cases) == 0:
+                return False
+            self.cases = cases
+            return True
+
+        def get_page_content(self) -> discord.Embed:
+            embed = discord.Embed(title='Cases')
+            if len(self.cases) == 0:
+                embed.description = 'No cases found.'
+            else:
+                embed.description = '\n'.join(ModerationCog._format_case(case) for case in self.cases)
+                embed.set_footer(text=f'Cases #{self.cases[-1].case_id} - #{self.cases[0].case_id}')
+            return embed
+
+        async def interaction_check(self, interaction: discord.Interaction) -> bool:
+            if interaction.user.id != self.author.id:
+                await interaction.response.send_message("You cannot use this button!", ephemeral=True)
+                return False
+            return True
+
+        @discord.ui.button(label='Newer', style=discord.ButtonStyle.gray)
+        async def newer_button(self, interaction: discord.Interaction, button: discord.ui.Button) -> None:
+            if len(self.cases) > 0 and self.load_page(after_case_id=self.cases[0].case_id):
+                await interaction.response.edit_message(embed=self.get_page_content(), view=self)
+            else:
+                await interaction.response.defer()
+
+        @discord.ui.button(label='Older', style=discord.ButtonStyle.gray)
+        async def older_button(self, interaction: discord.Interaction, button: discord.ui.Button) -> None:
+            if len(self.cases) > 0 and self.load_page(before_case_id=self.cases[-1].case_id):
+                await interaction.response.edit_message(embed=self.get_page_content(), view=self)
+            else:
+                await interaction.response.defer()
+
+        async def on_timeout(self) -> None:
+            # Remove buttons when the view times out
+            self.clear_items()
+            if self.message is not None:
+                await self.message.edit(view=self)
+
+    @commands.hybrid_command(name='cases', description='Get the moderation history of a user or a moderator.')
+    @commands.has_permissions(kick_members=True)
+    @app_commands.describe(user='The user to get the cases of.', moderator='The moderator to get the cases by.')
+    async def cases(self, ctx: commands.Context, user: discord.User | None = None,
+                    moderator: discord.User | None = None) -> None:
+        if ctx.guild is None:
+            await ctx.send('This command can only be used in a guild.', ephemeral=True)
+            return
+
+        view = self.CasesView(ctx.author, ctx.guild, user.id if user is not None else None,
+                              moderator.id if moderator is not None else None)
+        view.load_page()
+        view.message = await ctx.send(embed=view.get_page_content(), view=view)
+
     class BanStatsView(View):
         current_begin_of_month: datetime
 
-        def __init__(self, bot, ctx, current_date):
+        def __init__(self, cog, ctx, current_date):
             super().__init__(timeout=None)
-            self.bot = bot
+            self.cog = cog
+            self.bot = cog.bot
             self.ctx = ctx
             self.current_begin_of_month = current_date.replace(day=1)
 
@@ -360,14 +919,11 @@ class ModerationCog(commands.Cog):
                 end_of_month = datetime.now(UTC)
 
             # Get the initial banstats
-            ban_stats = await self._get_banstats_between_dates(
-                guild=self.ctx.guild,
-                before=end_of_month,
-                after=self.current_begin_of_month
-            )
+            await self.cog.sync_audit_log_bans(self.ctx.guild)
+            ban_stats = db.get_ban_stats(self.ctx.guild, db.get_ban_stats_month(self.current_begin_of_month))
 
             # Create the embed
-            ban_stats_embed = self._banstats_to_embed(ban_stats)
+            ban_stats_embed = self._banstats_to_embed(ban_stats, db.get_ban_stats(self.ctx.guild))
             self._add_before_after_to_banstats_embed(ban_stats_embed, end_of_month, self.current_begin_of_month)
 
             return ban_stats_embed
@@ -395,18 +951,15 @@ class ModerationCog(commands.Cog):
                 end_of_month = datetime.now(UTC)
 
             assert interaction.guild is not None
-            ban_stats = await self._get_banstats_between_dates(
-                guild=interaction.guild,
-                before=end_of_month,
-                after=self.current_begin_of_month
-            )
+            await self.cog.sync_audit_log_bans(interaction.guild)
+            ban_stats = db.get_ban_stats(interaction.guild, db.get_ban_stats_month(self.current_begin_of_month))
 
-            ban_stats_embed = self._banstats_to_embed(ban_stats)
+            ban_stats_embed = self._banstats_to_embed(ban_stats, db.get_ban_stats(interaction.guild))
             self._add_before_after_to_banstats_embed(ban_stats_embed, end_of_month, self.current_begin_of_month)
 
             await interaction.response.edit_message(embed=ban_stats_embed, view=self)
 
-        def _banstats_to_embed(self, banstats: dict) -> discord.Embed:
+        def _banstats_to_embed(self, banstats: dict, all_time_banstats: dict) -> discord.Embed:
             embed = discord.Embed()
             embed.title = 'Ban stats'
             embed.colour = discord.Colour.green()
@@ -434,6 +987,8 @@ class ModerationCog(commands.Cog):
             if total_bans != 0:
                 embed.add_field(name='Total bans', value=str(total_bans), inline=False)
 
+            embed.add_field(name='All-time bans', value=str(sum(all_time_banstats.values())), inline=False)
+
             return embed
 
         def _add_before_after_to_banstats_embed(self, embed: discord.Embed, before: datetime, after: datetime) -> None:
@@ -441,104 +996,70 @@ class ModerationCog(commands.Cog):
             embed.set_footer(
                 text=f'Banstats between {after.strftime(date_format_string)} and {before.strftime(date_format_string)}')
 
-        def _get_audit_log_ban_in_db(self, audit_log_entry: discord.AuditLogEntry,
-                                     database_saved_bans: List[db.SavedBan]) -> db.SavedBan | None:
-            assert audit_log_entry.target is not None
-            assert audit_log_entry.user is not None
-            assert audit_log_entry.created_at is not None
-
-            debug_this = False
-            if debug_this:
-                print(
-                    f'Trying to find ban in DB for {audit_log_entry.target.id} at {audit_log_entry.created_at} ({int(audit_log_entry.created_at.timestamp())}).')
-
-            # Try to find a database ban here
-            current_top_db_entry: db.SavedBan | None = None
-            for db_ban_entry in database_saved_bans:
-                if debug_this:
-                    print(f'-> Entry: {db_ban_entry.banned_user_id} - {int(db_ban_entry.banned_time.timestamp())}, '
-                          f'responsible mod: {db_ban_entry.responsible_mod_id}')
-                if db_ban_entry.banned_user_id == audit_log_entry.target.id and abs(
-                        (audit_log_entry.created_at - db_ban_entry.banned_time).total_seconds()) <= 20:
-                    if current_top_db_entry is not None:
-                        # If we have a potential DB entry already saved, replace it with this one if the time difference is closer
-                        if abs((audit_log_entry.created_at - current_top_db_entry.banned_time).total_seconds()) > abs(
-                                (db_ban_entry.banned_time - current_top_db_entry.banned_time).total_seconds()):
-                            if debug_this:
-                                print('--> Choosing this one as a replacement')
-                            current_top_db_entry = db_ban_entry
-                    else:
-                        if debug_this:
-                            print('--> Choosing this one as a first')
-                        current_top_db_entry = db_ban_entry
-
-            # If we have no DB entry for this ban, log this, else, remove the entry from the DB list.
-            if current_top_db_entry is None:
-                print(
-                    f'DB-entry-less ban! Banned user is {audit_log_entry.target.id}, banned by {audit_log_entry.user.id} at {audit_log_entry.created_at} ({int(audit_log_entry.created_at.timestamp())}).')
-            else:
-                database_saved_bans.remove(current_top_db_entry)
-
-            return current_top_db_entry
-
-        async def _get_banstats_between_dates(self, guild: discord.Guild, before: datetime, after: datetime) -> dict[
-            int | str, int]:
-            # Get the list of bans from audit log between the times
-            audit_log_ban_entries = [entry async for entry in
-                                     guild.audit_logs(action=discord.AuditLogAction.ban, before=before, after=after)]
-
-            # Get the list of saved database bans between the times
-            database_saved_bans = db.get_bans_between(guild, before, after)
+    async def sync_audit_log_bans(self, guild: discord.Guild, force: bool = False) -> None:
+        # Pull the audit log ban entries newer than the newest one we have stored into the DB, and count them.
+        # The first sync of a guild pulls everything the audit log still has.
+        if guild.id not in self.audit_log_sync_locks:
+            self.audit_log_sync_locks[guild.id] = asyncio.Lock()
+
+        async with self.audit_log_sync_locks[guild.id]:
+            last_sync = self.last_audit_log_sync.get(guild.id)
+            if not force and last_sync is not None and datetime.now(UTC) - last_sync < audit_log_ban_sync_interval:
+                return
+
+            high_water_mark = db.get_audit_log_ban_high_water_mark(guild)
+            after = discord.Object(id=high_water_mark) if high_water_mark is not None else None
+            new_entries = [entry async for entry in
+                           guild.audit_logs(limit=None, action=discord.AuditLogAction.ban, after=after)]
+            self._reconcile_audit_log_bans(guild, db.add_synced_audit_log_bans(guild, new_entries))
+            self.last_audit_log_sync[guild.id] = datetime.now(UTC)
+
+    def _reconcile_audit_log_bans(self, guild: discord.Guild, audit_log_bans: List[db.AuditLogBan]) -> None:
+        # Count the audit log bans that do not already have a ban_owners row (which was counted when it was added)
+        if len(audit_log_bans) == 0:
+            return
 
-            # The actual banstats themselves
-            ban_stats: dict[int | str, int] = {}
+        database_saved_bans = db.SavedBanIndex(db.get_bans_between(
+            guild,
+            before=max(audit_log_ban.banned_time for audit_log_ban in audit_log_bans) + timedelta(seconds=20),
+            after=min(audit_log_ban.banned_time for audit_log_ban in audit_log_bans) - timedelta(seconds=20)
+        ))
+
+        for audit_log_ban in audit_log_bans:
+            # Find the closest database ban for this user within 20 seconds, and take it out of the index
+            if database_saved_bans.pop_closest(audit_log_ban.banned_user_id, audit_log_ban.banned_time) is not None:
+                continue
+
+            _log.info('DB-entry-less ban of %s, banned by %s at %s (%s)', audit_log_ban.banned_user_id,
+                      audit_log_ban.responsible_mod_id, audit_log_ban.banned_time,
+                      int(audit_log_ban.banned_time.timestamp()), extra={'guild_id': guild.id, 'event': 'audit_log_ban'})
+
+            # If the ban is not in the DB, and it was made by us (or we do not know who made it), then it is untrackable
+            if audit_log_ban.responsible_mod_id is None or audit_log_ban.responsible_mod_id == self.bot.user.id:
+                db.add_untrackable_ban(guild, audit_log_ban)
+            # If the ban is not in the DB, but it was not made by us, then it was made manually; add it to the DB
+            else:
+                db.add_audit_log_ban(guild, audit_log_ban)
 
-            # We now iterate the audit log bans
-            for audit_log_entry in audit_log_ban_entries:
-                assert audit_log_entry.target is not None
-                assert audit_log_entry.user is not None
-                assert audit_log_entry.created_at is not None
+    @app_commands.command(name='rebuild_banstats', description='Recount the ban stats of this guild from the ban history.')
+    @app_commands.checks.has_permissions(administrator=True)
+    async def rebuild_banstats(self, interaction: discord.Interaction) -> None:
+        if interaction.guild is None:
+            await interaction.response.send_message('This command can only be used in a guild.', ephemeral=True)
+            return
 
-                # Look up the ban in the DB
-                db_ban_entry = self._get_audit_log_ban_in_db(audit_log_entry, database_saved_bans)
+        await interaction.response.defer(ephemeral=True)
 
-                # If the ban is not in the DB, and it was made by us, then it is untrackable
-                if db_ban_entry is None and audit_log_entry.user.id == self.bot.user.id:
-                    if 'untrackable' not in ban_stats:
-                        ban_stats['untrackable'] = 1
-                    else:
-                        ban_stats['untrackable'] += 1
-                    continue
-                # If we found a DB entry for the ban, increment the banstats for the moderator listed
-                # This makes importing banstats from other bots a bit more doable:tm:
-                elif db_ban_entry is not None:
-                    if db_ban_entry.responsible_mod_id not in ban_stats:
-                        ban_stats[db_ban_entry.responsible_mod_id] = 1
-                    else:
-                        ban_stats[db_ban_entry.responsible_mod_id] += 1
-                # If the ban is not in the DB, but it was not made by us, then it was made manually;
-                # add it to the DB, and add it to the banstats
-                else:
-                    if db_ban_entry is None:
-                        db.add_audit_log_ban(guild, audit_log_entry)
-
-                    # Increment the banstats for the moderator
-                    if audit_log_entry.user.id not in ban_stats:
-                        ban_stats[audit_log_entry.user.id] = 1
-                    else:
-                        ban_stats[audit_log_entry.user.id] += 1
-
-            # Log how many bans are in the DB and not in the audit log
-            print(f'Bans in DB and not audit log: {len(database_saved_bans)}')
-
-            # Iterate through what is left of the DB entries
-            for db_ban_entry in database_saved_bans:
-                if db_ban_entry.responsible_mod_id not in ban_stats:
-                    ban_stats[db_ban_entry.responsible_mod_id] = 1
-                else:
-                    ban_stats[db_ban_entry.responsible_mod_id] += 1
+        # Count everything in ban_owners, then recount the untrackable (and any unrecorded manual) bans from the
+        # locally stored audit log
+        await self.sync_audit_log_bans(interaction.guild, force=True)
+        async with self.audit_log_sync_locks[interaction.guild.id]:
+            db.rebuild_ban_stats_from_ban_owners(interaction.guild)
+            self._reconcile_audit_log_bans(interaction.guild, db.get_audit_log_bans_between(
+                interaction.guild, before=datetime.now(UTC), after=datetime.fromtimestamp(0, tz=UTC)))
 
-            return {k: v for k, v in sorted(ban_stats.items(), key=lambda item: item[1], reverse=True)}
+        await interaction.followup.send(f'Rebuilt ban stats: {sum(db.get_ban_stats(interaction.guild).values())} bans '
+                                        f'counted.', ephemeral=True)
 
     @commands.hybrid_command(name='banstats', description='Get the amount of bans in the last month.')
     async def banstats(self, ctx: commands.Context[commands.Bot]) -> None:
@@ -547,13 +1068,54 @@ class ModerationCog(commands.Cog):
             return
 
         current_time = datetime.now(UTC)
-        view = self.BanStatsView(self.bot, ctx, current_time)
+        view = self.BanStatsView(self, ctx, current_time)
         await ctx.send(embed=await view.get_embed(), view=view)
 
+    def _message_matches_purge_filters(self, message: discord.Message, author: discord.User | None,
+                                       contains: str | None, pattern: re.Pattern | None,
+                                       has_attachments: bool | None, bots_only: bool) -> bool:
+        if author is not None and message.author.id != author.id:
+            return False
+        if contains is not None and contains.lower() not in message.content.lower():
+            return False
+        if pattern is not None and pattern.search(message.content) is None:
+            return False
+        if has_attachments is not None and (len(message.attachments) > 0) != has_attachments:
+            return False
+        if bots_only and not message.author.bot:
+            return False
+        return True
+
+    async def _delete_purge_batch(self, channel: discord.abc.Messageable, batch: List[discord.Message]) -> None:
+        # The bulk delete endpoint only takes messages younger than 14 days; older ones have to be deleted one by one
+        bulk_cutoff = datetime.now(UTC) - timedelta(days=14) + timedelta(minutes=1)
+        bulk = [message for message in batch if message.created_at > bulk_cutoff]
+        single = [message for message in batch if message.created_at <= bulk_cutoff]
+
+        if len(bulk) == 1:
+            single += bulk
+        elif len(bulk) > 1:
+            await channel.delete_messages(bulk)
+
+        for message in single:
+            try:
+                await message.delete()
+            except discord.NotFound:
+                pass
+
     @commands.hybrid_command(name='purge', description='Purge messages from this channel.')
     @commands.has_permissions(manage_messages=True)
-    @app_commands.describe(amount='The amount of messages to purge.')
-    async def purge(self, ctx: commands.Context, amount: int = 10) -> None:
+    @app_commands.describe(amount='The amount of messages to purge.',
+                           author='Only purge messages from this user.',
+                           contains='Only purge messages containing this text.',
+                           regex='Only purge messages matching this regular expression.',
+                           has_attachments='Only purge messages with (or without) attachments.',
+                           bots_only='Only purge messages from bots.',
+                           newer_than='Only purge messages newer than this, e.g. 2h.',
+                           older_than='Only purge messages older than this, e.g. 30m.')
+    async def purge(self, ctx: commands.Context, amount: int = 10, author: discord.User | None = None,
+                    contains: str | None = None, regex: str | None = None, has_attachments: bool | None = None,
+                    bots_only: bool = False, newer_than: str | None = None, older_than: str | None = None) -> None:
         if amount <= 0:
             await ctx.send('The amount of messages to purge must be positive.', ephemeral=True)
             return
@@ -562,32 +1124,133 @@ class ModerationCog(commands.Cog):
             await ctx.send('This command can only be used in a guild.', ephemeral=True)
             return
 
-        list_of_deleted = await ctx.channel.purge(limit=amount + 1, bulk=True)
+        pattern: re.Pattern | None = None
+        if regex is not None:
+            try:
+                pattern = re.compile(regex)
+            except re.error as e:
+                await ctx.send(f'Invalid regular expression: {e}', ephemeral=True)
+                return
+
+        after: datetime | None = None
+        before: datetime | None = None
+        for name, time_string in [('newer_than', newer_than), ('older_than', older_than)]:
+            if time_string is None:
+                continue
+            time_seconds = timeparse(time_string)
+            if time_seconds is None or time_seconds <= 0:
+                await ctx.send(f'Could not parse `{name}`; use something like `2h` or `30m`.', ephemeral=True)
+                return
+            if name == 'newer_than':
+                after = datetime.now(UTC) - timedelta(seconds=time_seconds)
+            else:
+                before = datetime.now(UTC) - timedelta(seconds=time_seconds)
+
+        # Slash commands can easily take longer than the interaction response timeout here
+        await ctx.defer(ephemeral=True)
+
+        # Never purge the command message itself as part of the filtered messages; remove it up front instead
+        if ctx.interaction is None:
+            if before is None or ctx.message.created_at < before:
+                before = ctx.message.created_at
+            try:
+                await ctx.message.delete()
+            except discord.NotFound:
+                pass
+
+        progress_message = await ctx.send(embed=self._create_text_embed(f'Purging up to {amount} messages...'),
+                                          ephemeral=True)
+        last_progress_update = datetime.now(UTC)
+
+        file = purge_logs.get_purge_log_path(ctx.guild, ctx.channel)
+        deleted_count = 0
+        scanned_count = 0
+        batch: List[discord.Message] = []
+        # Batches are deleted newest first, and only their records are kept; the log is written once at the end, so it
+        # is oldest first throughout. A batch is recorded before it is deleted, so that if deleting or reading the
+        # history fails partway, everything that may already be deleted still gets logged.
+        records: List[dict] = []
+
+        try:
+            # Stream the channel history newest first, and delete matching messages in batches of 100
+            async for message in ctx.channel.history(limit=None, before=before, after=after, oldest_first=False):
+                scanned_count += 1
+                if not self._message_matches_purge_filters(message, author, contains, pattern, has_attachments,
+                                                           bots_only):
+                    continue
 
-        # Save the purge log.
-        file = purge_logs_location / f'{ctx.guild.name.lower().replace(' ', '-')}-' \
-                                     f'{ctx.channel.name.lower().replace(' ', '-')}-' \
-                                     f'{datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%SZ')}.txt'
+                batch.append(message)
+                if len(batch) == 100 or deleted_count + len(batch) >= amount:
+                    records += [purge_logs.message_to_record(message) for message in batch]
+                    await self._delete_purge_batch(ctx.channel, batch)
+                    deleted_count += len(batch)
+                    batch = []
 
-        with open(file, 'a') as f:
-            f.write(f'Purged {len(list_of_deleted)} messages in {ctx.channel.name} ({ctx.guild.name})\n')
-            for message in reversed(list_of_deleted):
-                f.write(f'\t{message.author.name} - {message.created_at} - id: ({message.id})\n')
-                f.write(f'\t\t{message.content.replace('\n', '\n\t\t')}\n')
-            f.flush()
+                    if deleted_count >= amount:
+                        break
 
-        embed = discord.Embed(title='Purged messages', description=f'Deleted {len(list_of_deleted)} messages.')
-        await ctx.send(embed=embed)
+                    if datetime.now(UTC) - last_progress_update > timedelta(seconds=5):
+                        last_progress_update = datetime.now(UTC)
+                        await progress_message.edit(embed=self._create_text_embed(
+                            f'Purging... deleted {deleted_count}/{amount} messages ({scanned_count} scanned).'))
+
+            if len(batch) > 0:
+                records += [purge_logs.message_to_record(message) for message in batch]
+                await self._delete_purge_batch(ctx.channel, batch)
+                deleted_count += len(batch)
+        finally:
+            if len(records) > 0:
+                await purge_logs.write_purge_log(file, ctx.guild, records)
+
+        await progress_message.edit(embed=self._create_text_embed(
+            f'Done; deleted {deleted_count} messages ({scanned_count} scanned).'))
+
+        embed = discord.Embed(title='Purged messages', description=f'Deleted {deleted_count} messages.')
+        await ctx.channel.send(embed=embed)
 
         # Log the purge
         log_channel = db.get_guild_log_channel(ctx.guild)
-        if log_channel is not None:
-            embed = discord.Embed(title='Purged messages', description=f'Deleted {len(list_of_deleted)} messages in'
+        if log_channel is not None and deleted_count > 0:
+            embed = discord.Embed(title='Purged messages', description=f'Deleted {deleted_count} messages in '
                                                                        f'{ctx.channel.mention}.')
-            if purge_logs_url_prepend is not None:
-                embed.add_field(name='Log file', value=f'[Link]({purge_logs_url_prepend}{file.name})')
+            purge_log_url = purge_logs.get_purge_log_url(file.name)
+            if purge_log_url is not None:
+                embed.add_field(name='Log file', value=f'[Link]({purge_log_url})')
             await log_channel.send(embed=embed)
 
+    @app_commands.command(name='purge_search', description='Find purged messages by message ID or author.')
+    @app_commands.checks.has_permissions(manage_messages=True)
+    @app_commands.describe(message_id='The ID of the purged message.', author='The author of the purged messages.')
+    async def purge_search(self, interaction: discord.Interaction, message_id: str | None = None,
+                           author: discord.User | None = None) -> None:
+        if interaction.guild is None:
+            await interaction.response.send_message('This command can only be used in a guild.', ephemeral=True)
+            return
+
+        if (message_id is None) == (author is None):
+            await interaction.response.send_message('Pass either a message ID or an author.', ephemeral=True)
+            return
+
+        if message_id is not None and not message_id.isdigit():
+            await interaction.response.send_message('The message ID must be a number.', ephemeral=True)
+            return
+
+        found = await purge_logs.find_purged_messages(interaction.guild,
+                                                      message_id=int(message_id) if message_id is not None else None,
+                                                      author_id=author.id if author is not None else None)
+        if len(found) == 0:
+            await interaction.response.send_message('No purged messages found.', ephemeral=True)
+            return
+
+        lines = []
+        for found_message_id, author_id, file_name in found:
+            purge_log_url = purge_logs.get_purge_log_url(file_name)
+            file_string = file_name if purge_log_url is None else f'[{file_name}]({purge_log_url})'
+            lines.append(f'`{found_message_id}` by <@{author_id}> - {file_string}')
+
+        embed = discord.Embed(title='Purged messages', description='\n'.join(lines))
+        await interaction.response.send_message(embed=embed, ephemeral=True)
+
     @commands.hybrid_command(name='info', description='Get information about a user.')
     @app_commands.describe(user='The user to get information about.')
     async def info(self, ctx: commands.Context, user: discord.Member | discord.User) -> None:
@@ -599,13 +1262,21 @@ class ModerationCog(commands.Cog):
             await ctx.send('I am a bot!', ephemeral=True)
             return
 
+        # Without a full member cache, members may not be cached even if they are in the guild
+        if not isinstance(user, discord.Member) and not ctx.guild.chunked:
+            try:
+                user = await ctx.guild.fetch_member(user.id)
+            except discord.NotFound:
+                pass
+
         embed = discord.Embed(title=f'Info for {user.name}')
         if isinstance(user, discord.Member):
             embed.description = f'{f'AKA: {user.nick}, ' if user.nick is not None else ''}ID: {user.id}'
 
         embed.set_thumbnail(url=user.display_avatar.url)
 
-        if isinstance(user, discord.Member) and type(user.status) is not str:
+        # Without the presences intent, everyone looks offline
+        if isinstance(user, discord.Member) and type(user.status) is not str and self.bot.intents.presences:
             embed.add_field(name='Overall Status', value=user.status, inline=False)
             embed.add_field(name='Desktop Status', value=user.desktop_status)
             embed.add_field(name='Mobile Status', value=user.mobile_status)
@@ -616,7 +1287,17 @@ class ModerationCog(commands.Cog):
         if isinstance(user, discord.Member):
             embed.add_field(name='Joined at', value=f'<t:{int(user.joined_at.timestamp())}:f>', inline=False)
 
+        # Cases are only for those who can see them with /cases too
+        case_count = db.get_case_count(ctx.guild, user.id) if ctx.author.guild_permissions.kick_members else 0
+        if case_count > 0:
+            recent_cases = db.get_cases(ctx.guild, user_id=user.id, limit=5)
+            embed.add_field(name=f'Cases ({case_count})', value=self._format_cases_field(recent_cases, case_count),
+                            inline=False)
+
         if len(user.mutual_guilds) > 0:
-            embed.add_field(name='Seen on', value='\n'.join([guild.name for guild in user.mutual_guilds]), inline=False)
+            # Only guilds where the user is cached; that is all of them only with the full member cache
+            embed.add_field(name='Seen on' if all(guild.chunked for guild in self.bot.guilds)
+                            else 'Seen on (cached members only)',
+                            value='\n'.join([guild.name for guild in user.mutual_guilds]), inline=False)
 
         await ctx.send(embed=embed)
\ No newline at end of file
@@ -0,0 +1,192 @@
+import asyncio
+import cProfile
+import discord
+import logging
+import os
+import pstats
+import tracemalloc
+
+from collections import deque
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Iterable, List, Literal
+
+from discord import app_commands
+from discord.ext import commands
+
+import metrics
+
+_log = logging.getLogger(__name__)
+
+# Calls that take longer than this are logged, with their event and guild
+slow_call_seconds = float(os.environ.get('PERF_SLOW_CALL_MS', '500')) / 1000
+# Durations kept per handler for the percentiles in /perf
+samples_per_handler = int(os.environ.get('PERF_SAMPLES_PER_HANDLER', '1000'))
+# Where /profile writes its captures, to be opened with pstats or tracemalloc.Snapshot.load
+profiles_location = Path(os.environ.get('PROFILES_LOCATION', 'profiles/'))
+
+
+class HandlerStats:
+    def __init__(self):
+        self.calls = 0
+        self.slow_calls = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+        # Only the most recent durations, so recording stays O(1) and the percentiles follow current behaviour
+        self.recent_seconds: deque[float] = deque(maxlen=samples_per_handler)
+
+    def get_percentile(self, percentile: float) -> float:
+        if len(self.recent_seconds) == 0:
+            return 0.0
+        ordered = sorted(self.recent_seconds)
+        return ordered[min(int(len(ordered) * percentile), len(ordered) - 1)]
+
+
+# Per listener (e.g. LoggerCog.on_message) or command (e.g. /warn), since the process started
+handler_stats: dict[str, HandlerStats] = {}
+
+
+def _get_guild_id(args: Iterable) -> int | None:
+    # Listeners get guilds, raw events with a guild_id, or models, contexts and interactions with a guild
+    for arg in args:
+        if isinstance(arg, discord.Guild):
+            return arg.id
+        guild_id = getattr(arg, 'guild_id', None)
+        if isinstance(guild_id, int):
+            return guild_id
+        guild = getattr(arg, 'guild', None)
+        if isinstance(guild, discord.Guild):
+            return guild.id
+    return None
+
+
+def record_call(handler: str, event_name: str, duration: float, args: Iterable = ()) -> None:
+    """Record how long a listener or command took; the guild is only looked up for slow calls."""
+    stats = handler_stats.get(handler)
+    if stats is None:
+        stats = handler_stats[handler] = HandlerStats()
+    stats.calls += 1
+    stats.total_seconds += duration
+    stats.recent_seconds.append(duration)
+    if duration > stats.max_seconds:
+        stats.max_seconds = duration
+    metrics.handler_seconds.observe(duration, handler)
+
+    if duration >= slow_call_seconds:
+        stats.slow_calls += 1
+        _log.warning('Slow call to %s', handler, extra={'handler': handler, 'event': event_name,
+                                                        'guild_id': _get_guild_id(args),
+                                                        'duration_ms': round(duration * 1000, 1)})
+
+
+def _summarize_cprofile(path: Path, limit: int) -> List[str]:
+    stats = pstats.Stats(str(path))
+    stats.sort_stats('tottime')
+    lines = []
+    for function in stats.fcn_list[:limit]:
+        file_name, line_number, function_name = function
+        _, call_count, own_seconds, cumulative_seconds, _ = stats.stats[function]
+        lines.append(f'{own_seconds:7.3f}s {cumulative_seconds:7.3f}s {call_count:>7} '
+                     f'{function_name} ({os.path.basename(file_name)}:{line_number})')
+    return lines
+
+
+def _summarize_tracemalloc(start: tracemalloc.Snapshot, end: tracemalloc.Snapshot, path: Path,
+                           limit: int) -> List[str]:
+    end.dump(str(path))
+    lines = []
+    for difference in end.compare_to(start, 'lineno')[:limit]:
+        frame = difference.traceback[0]
+        lines.append(f'{difference.size_diff / 1024:+9.1f}KiB {difference.size / 1024:9.1f}KiB '
+                     f'{os.path.basename(frame.filename)}:{frame.lineno}')
+    return lines
+
+
+def is_owner():
+    async def predicate(interaction: discord.Interaction) -> bool:
+        return await interaction.client.is_owner(interaction.user)
+    return app_commands.check(predicate)
+
+
+class PerfCog(commands.Cog):
+    def __init__(self, bot):
+        self.bot = bot
+        self.profiling = False
+
+    @app_commands.command(name='perf', description='Get the listeners and commands of the bot that take the most time.')
+    @app_commands.checks.has_permissions(administrator=True)
+    @app_commands.describe(sort='What to sort the handlers by.')
+    async def perf(self, interaction: discord.Interaction, sort: Literal['total', 'p99'] = 'total') -> None:
+        def sort_key(item: tuple[str, HandlerStats]) -> float:
+            return item[1].total_seconds if sort == 'total' else item[1].get_percentile(0.99)
+
+        top_handlers = sorted(handler_stats.items(), key=sort_key, reverse=True)[:15]
+
+        embed = discord.Embed(title='Handler performance', colour=discord.Colour.blue())
+        embed.description = (f'Top handlers of this process by {"total time" if sort == "total" else "p99 time"}; '
+                             f'percentiles are of the last {samples_per_handler} calls. Calls over '
+                             f'{slow_call_seconds * 1000:.0f}ms count as slow.')
+        for handler, stats in top_handlers:
+            embed.add_field(name=handler,
+                            value=f'Calls: {stats.calls} ({stats.slow_calls} slow)\n'
+                                  f'Total: {stats.total_seconds:.2f}s\n'
+                                  f'Mean: {stats.total_seconds / stats.calls * 1000:.1f}ms\n'
+                                  f'p50: {stats.get_percentile(0.5) * 1000:.1f}ms, '
+                                  f'p99: {stats.get_percentile(0.99) * 1000:.1f}ms\n'
+                                  f'Max: {stats.max_seconds * 1000:.1f}ms')
+        if len(top_handlers) == 0:
+            embed.description += '\n\nNothing recorded yet.'
+
+        await interaction.response.send_message(embed=embed, ephemeral=True)
+
+    @app_commands.command(name='profile', description='Profile the bot for some time, and get the top functions.')
+    @is_owner()
+    @app_commands.describe(mode='cprofile for where time goes, tracemalloc for where memory is allocated.',
+                           seconds='How long to profile for.')
+    async def profile(self, interaction: discord.Interaction, mode: Literal['cprofile', 'tracemalloc'] = 'cprofile',
+                      seconds: app_commands.Range[int, 1, 300] = 30) -> None:
+        if self.profiling:
+            await interaction.response.send_message('A profile is already being captured.', ephemeral=True)
+            return
+        self.profiling = True
+        await interaction.response.send_message(f'Capturing a {mode} profile for {seconds}s.', ephemeral=True)
+
+        try:
+            profiles_location.mkdir(parents=True, exist_ok=True)
+            timestamp = datetime.now(timezone.utc).strftime('%Y%m%d-%H%M%S')
+
+            # The capture runs while waiting, so the loop keeps running, and is what gets profiled;
+            # writing and summarizing the result happens off the loop
+            if mode == 'cprofile':
+                path = profiles_location / f'cprofile-{timestamp}.prof'
+                profiler = cProfile.Profile()
+                profiler.enable()
+                try:
+                    await asyncio.sleep(seconds)
+                finally:
+                    profiler.disable()
+                await asyncio.to_thread(profiler.dump_stats, str(path))
+                summary = await asyncio.to_thread(_summarize_cprofile, path, 15)
+                header = f'{"own":>8} {"total":>8} {"calls":>7} function'
+            else:
+                path = profiles_location / f'tracemalloc-{timestamp}.snapshot'
+                # Tracing slows down every allocation, so it is only on while capturing
+                was_tracing = tracemalloc.is_tracing()
+                if not was_tracing:
+                    tracemalloc.start()
+                try:
+                    start = await asyncio.to_thread(tracemalloc.take_snapshot)
+                    await asyncio.sleep(seconds)
+                    end = await asyncio.to_thread(tracemalloc.take_snapshot)
+                finally:
+                    if not was_tracing:
+                        tracemalloc.stop()
+                summary = await asyncio.to_thread(_summarize_tracemalloc, start, end, path, 15)
+                header = f'{"change":>12} {"size":>12} location'
+        finally:
+            self.profiling = False
+
+        embed = discord.Embed(title=f'{mode} profile of {seconds}s', colour=discord.Colour.blue())
+        embed.description = f'```\n{header}\n' + '\n'.join(summary) + '\n```'
+        embed.set_footer(text=f'Written to {path}')
+        await interaction.followup.send(embed=embed, ephemeral=True)
@@ -0,0 +1,66 @@
+import hmac
+import logging
+import mimetypes
+import time
+
+from aiohttp import web
+
+import purge_logs
+
+mimetypes.add_type('application/x-ndjson', '.jsonl')
+
+_log = logging.getLogger(__name__)
+
+_runner: web.AppRunner | None = None
+
+
+async def _handle_purge_log(request: web.Request) -> web.StreamResponse:
+    file_name = request.match_info['file_name']
+    if '/' in file_name or '\\' in file_name or file_name.startswith('.'):
+        raise web.HTTPNotFound()
+
+    # Links are signed for the name they were created with, and expire
+    try:
+        expires = int(request.query.get('expires', ''))
+    except ValueError:
+        raise web.HTTPForbidden()
+    if expires < time.time() or not hmac.compare_digest(request.query.get('signature', ''),
+                                                        purge_logs.sign_purge_log_link(file_name, expires)):
+        raise web.HTTPForbidden()
+
+    # Logs can be gzipped by the writer or by retention after the link was made. FileResponse serves a .gz sibling
+    # of the requested file as-is with Content-Encoding: gzip to clients that accept it, and handles ETag and Range.
+    plain_name = file_name.removesuffix('.gz')
+    plain_path = purge_logs.purge_logs_location / plain_name
+    compressed_path = purge_logs.purge_logs_location / (plain_name + '.gz')
+    accepts_gzip = 'gzip' in request.headers.get('Accept-Encoding', '').lower()
+
+    if plain_path.is_file() or (accepts_gzip and compressed_path.is_file()):
+        return web.FileResponse(plain_path)
+    if compressed_path.is_file():
+        return web.FileResponse(compressed_path,
+                                headers={'Content-Disposition': f'attachment; filename="{compressed_path.name}"'})
+    raise web.HTTPNotFound()
+
+
+async def start() -> None:
+    """Start the purge log server in the running event loop, if PURGE_LOGS_HTTP_PORT is set."""
+    global _runner
+    if purge_logs.purge_logs_http_port is None or _runner is not None:
+        return
+
+    app = web.Application()
+    app.router.add_get('/purge_logs/{file_name}', _handle_purge_log)
+
+    _runner = web.AppRunner(app, access_log=None)
+    await _runner.setup()
+    await web.TCPSite(_runner, purge_logs.purge_logs_http_host, purge_logs.purge_logs_http_port).start()
+    _log.info('Purge log server listening on %s:%s', purge_logs.purge_logs_http_host,
+              purge_logs.purge_logs_http_port)
+
+
+async def stop() -> None:
+    global _runner
+    if _runner is not None:
+        await _runner.cleanup()
+        _runner = None
@@ -0,0 +1,222 @@
+import asyncio
+import gzip
+import hashlib
+import hmac
+import json
+import os
+import secrets
+import shutil
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone, timedelta
+from pathlib import Path
+from typing import IO, List
+
+import discord
+
+purge_logs_location = Path(os.environ.get('PURGE_LOGS_LOCATION', 'purge_logs/'))
+purge_logs_location.mkdir(parents=True, exist_ok=True)
+
+purge_logs_url_prepend = os.environ.get('PURGE_LOGS_URL_PREPEND')
+purge_logs_compress = os.environ.get('PURGE_LOGS_COMPRESS', '0') == '1'
+# Kept outside the purge logs directory, since that is usually served publicly
+purge_logs_index_filename = os.environ.get('PURGE_LOGS_INDEX_FILENAME', 'purge_logs_index.db')
+
+# Embedded HTTP server for purge logs (see purge_log_server); links to it are signed and expire.
+# If no secret is set, a random one is used, and links stop working when the bot restarts.
+purge_logs_http_port = int(os.environ['PURGE_LOGS_HTTP_PORT']) if 'PURGE_LOGS_HTTP_PORT' in os.environ else None
+purge_logs_http_host = os.environ.get('PURGE_LOGS_HTTP_HOST', '0.0.0.0')
+purge_logs_http_base_url = os.environ.get('PURGE_LOGS_HTTP_BASE_URL')
+purge_logs_http_secret = os.environ.get('PURGE_LOGS_HTTP_SECRET', '').encode() or secrets.token_bytes(32)
+purge_logs_http_link_lifetime = timedelta(days=int(os.environ.get('PURGE_LOGS_HTTP_LINK_DAYS', '30')))
+
+# Retention; logs older than this are gzipped, and the oldest logs are deleted while the total size is above the cap
+purge_logs_compress_after_days = int(os.environ['PURGE_LOGS_COMPRESS_AFTER_DAYS']) \
+    if 'PURGE_LOGS_COMPRESS_AFTER_DAYS' in os.environ else None
+purge_logs_max_total_bytes = int(float(os.environ['PURGE_LOGS_MAX_TOTAL_MB']) * 1024 * 1024) \
+    if 'PURGE_LOGS_MAX_TOTAL_MB' in os.environ else None
+
+# All file and index access happens on this one thread, so it never blocks the event loop, and the index connection
+# is only ever used from the thread that created it.
+_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='purge-log-writer')
+_index_db: sqlite3.Connection | None = None
+
+
+def _get_index_db() -> sqlite3.Connection:
+    global _index_db
+    if _index_db is None:
+        # Shared by all processes in cluster mode, like the main DB
+        _index_db = sqlite3.connect(purge_logs_index_filename, timeout=float(os.environ.get('DB_BUSY_TIMEOUT', '5')))
+        _index_db.execute('PRAGMA journal_mode=WAL')
+        _index_db.execute('CREATE TABLE IF NOT EXISTS purged_messages(message_id ID PRIMARY KEY, author_id ID, '
+                          'guild ID, file STRING)')
+        _index_db.execute('CREATE INDEX IF NOT EXISTS purged_messages_author ON purged_messages(guild, author_id)')
+        _index_db.execute('CREATE INDEX IF NOT EXISTS purged_messages_file ON purged_messages(file)')
+
+        # Manifest of the files in the purge logs directory, so that retention never has to rescan it
+        manifest_exists = _index_db.execute('SELECT COUNT(*) FROM sqlite_master WHERE type = \'table\' '
+                                            'AND name = \'purge_log_files\'').fetchone()[0]
+        _index_db.execute('CREATE TABLE IF NOT EXISTS purge_log_files(file STRING PRIMARY KEY, size INT, '
+                          'created_time EPOCH, compressed BOOL)')
+        _index_db.execute('CREATE INDEX IF NOT EXISTS purge_log_files_created ON purge_log_files(created_time)')
+        if not manifest_exists:
+            # Only ever done once, to pick up the logs written before the manifest existed
+            for file in purge_logs_location.iterdir():
+                if file.is_file():
+                    stat = file.stat()
+                    _index_db.execute('INSERT INTO purge_log_files(file, size, created_time, compressed) '
+                                      'VALUES (?, ?, ?, ?)', (file.name, stat.st_size, int(stat.st_mtime),
+                                                              file.suffix == '.gz'))
+        _index_db.commit()
+    return _index_db
+
+
+def sign_purge_log_link(file_name: str, expires: int) -> str:
+    return hmac.new(purge_logs_http_secret, f'{file_name}:{expires}'.encode(), hashlib.sha256).hexdigest()
+
+
+def get_purge_log_url(file_name: str) -> str | None:
+    """Get the link to a purge log; signed for the embedded server if it runs, else using PURGE_LOGS_URL_PREPEND."""
+    if purge_logs_http_port is not None and purge_logs_http_base_url is not None:
+        expires = int((datetime.now(timezone.utc) + purge_logs_http_link_lifetime).timestamp())
+        return (f'{purge_logs_http_base_url.rstrip('/')}/purge_logs/{file_name}'
+                f'?expires={expires}&signature={sign_purge_log_link(file_name, expires)}')
+    if purge_logs_url_prepend is not None:
+        return f'{purge_logs_url_prepend}{file_name}'
+    return None
+
+
+def message_to_record(message: discord.Message) -> dict:
+    """Get the purge log record of a message; keep these instead of the messages, as they are much smaller."""
+    return {
+        'message_id': message.id,
+        'author_id': message.author.id,
+        'author_name': message.author.name,
+        'guild_id': message.guild.id if message.guild is not None else None,
+        'channel_id': message.channel.id,
+        'created_at': message.created_at.isoformat(),
+        'edited_at': message.edited_at.isoformat() if message.edited_at is not None else None,
+        'content': message.content,
+        'attachments': [attachment.url for attachment in message.attachments]
+    }
+
+
+def _open_log(file: Path) -> IO[str]:
+    if purge_logs_compress:
+        return gzip.open(file, 'at', encoding='utf-8')
+    return open(file, 'a', encoding='utf-8')
+
+
+def _write_records(file: Path, guild_id: int, records: List[dict]) -> None:
+    index_db = _get_index_db()
+    with _open_log(file) as f:
+        for record in records:
+            f.write(json.dumps(record, ensure_ascii=False) + '\n')
+    index_db.executemany('INSERT OR REPLACE INTO purged_messages(message_id, author_id, guild, file) '
+                         'VALUES (?, ?, ?, ?)',
+                         [(record['message_id'], record['author_id'], guild_id, file.name) for record in records])
+    index_db.execute('INSERT INTO purge_log_files(file, size, created_time, compressed) '
+                     'VALUES (?, ?, unixepoch(\'now\'), ?) ON CONFLICT(file) DO UPDATE SET size = excluded.size',
+                     (file.name, file.stat().st_size, purge_logs_compress))
+    index_db.commit()
+
+
+def get_purge_log_path(guild: discord.Guild, channel: discord.abc.GuildChannel) -> Path:
+    return purge_logs_location / (f'{guild.name.lower().replace(' ', '-')}-'
+                                  f'{channel.name.lower().replace(' ', '-')}-'
+                                  f'{datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%SZ')}'
+                                  f'{'.jsonl.gz' if purge_logs_compress else '.jsonl'}')
+
+
+async def write_purge_log(file: Path, guild: discord.Guild, records: List[dict]) -> None:
+    """Append message records (see message_to_record) to a purge log, oldest first, and index them.
+
+    Pass all records of a purge at once; the order is only kept within a single call.
+
+    All file and index writes happen on the purge log writer thread.
+    """
+    records = sorted(records, key=lambda record: record['message_id'])
+    await asyncio.get_running_loop().run_in_executor(_writer, _write_records, file, guild.id, records)
+
+
+def _find_purged_messages(guild_id: int, message_id: int | None, author_id: int | None,
+                          limit: int) -> List[tuple[int, int, str]]:
+    cursor = _get_index_db().cursor()
+    if message_id is not None:
+        cursor.execute('SELECT message_id, author_id, file FROM purged_messages WHERE message_id = ? AND guild = ?',
+                       (message_id, guild_id))
+    else:
+        cursor.execute('SELECT message_id, author_id, file FROM purged_messages WHERE guild = ? AND author_id = ? '
+                       'ORDER BY message_id DESC LIMIT ?', (guild_id, author_id, limit))
+    res = cursor.fetchall()
+    cursor.close()
+    return res
+
+
+async def find_purged_messages(guild: discord.Guild, message_id: int | None = None, author_id: int | None = None,
+                               limit: int = 25) -> List[tuple[int, int, str]]:
+    """Look up purged messages by message ID or author in the purge log index.
+
+    Returns:
+        List[tuple[int, int, str]]: (message id, author id, purge log file name), newest first
+    """
+    return await asyncio.get_running_loop().run_in_executor(_writer, _find_purged_messages, guild.id, message_id,
+                                                            author_id, limit)
+
+
+def _compress_log(file_name: str) -> str:
+    source = purge_logs_location / file_name
+    destination = purge_logs_location / (file_name + '.gz')
+    with open(source, 'rb') as f_in, gzip.open(destination, 'wb') as f_out:
+        shutil.copyfileobj(f_in, f_out)
+    source.unlink()
+    return destination.name
+
+
+def _enforce_retention() -> tuple[int, int]:
+    index_db = _get_index_db()
+    compressed_count = 0
+    deleted_count = 0
+
+    if purge_logs_compress_after_days is not None:
+        rows = index_db.execute('SELECT file FROM purge_log_files WHERE compressed = 0 AND created_time < '
+                                'unixepoch(\'now\') - ?', (purge_logs_compress_after_days * 24 * 3600,)).fetchall()
+        for (file_name,) in rows:
+            try:
+                compressed_name = _compress_log(file_name)
+            except FileNotFoundError:
+                # Removed by hand; forget about it
+                index_db.execute('DELETE FROM purge_log_files WHERE file = ?', (file_name,))
+                index_db.execute('DELETE FROM purged_messages WHERE file = ?', (file_name,))
+                continue
+
+            index_db.execute('UPDATE purge_log_files SET file = ?, size = ?, compressed = 1 WHERE file = ?',
+                             (compressed_name, (purge_logs_location / compressed_name).stat().st_size, file_name))
+            index_db.execute('UPDATE purged_messages SET file = ? WHERE file = ?', (compressed_name, file_name))
+            index_db.commit()
+            compressed_count += 1
+
+    if purge_logs_max_total_bytes is not None:
+        total_size = index_db.execute('SELECT COALESCE(SUM(size), 0) FROM purge_log_files').fetchone()[0]
+        if total_size > purge_logs_max_total_bytes:
+            for file_name, size in index_db.execute('SELECT file, size FROM purge_log_files '
+                                                    'ORDER BY created_time').fetchall():
+                if total_size <= purge_logs_max_total_bytes:
+                    break
+                (purge_logs_location / file_name).unlink(missing_ok=True)
+                index_db.execute('DELETE FROM purge_log_files WHERE file = ?', (file_name,))
+                index_db.execute('DELETE FROM purged_messages WHERE file = ?', (file_name,))
+                total_size -= size
+                deleted_count += 1
+            index_db.commit()
+
+    return compressed_count, deleted_count
+
+
+async def enforce_retention() -> tuple[int, int]:
+    """Compress old purge logs and delete the oldest ones while the total size is above the cap.
+
+    Returns:
+        tuple[int, int]: The amount of logs compressed and deleted
+    """
+    return await asyncio.get_running_loop().run_in_executor(_writer, _enforce_retention)
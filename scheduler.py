@@ -0,0 +1,106 @@
+import asyncio
+import heapq
+import logging
+import time
+from typing import Awaitable, Callable, List
+
+import db
+
+_log = logging.getLogger(__name__)
+
+
+class TimedActionScheduler:
+    """Runs timed actions stored in the scheduled_actions table when they are due.
+
+    Pending actions are kept in a min-heap by due time, with a single task sleeping until the earliest one; nothing
+    polls. Actions are only removed from the DB once they ran; an action that fails is retried with a growing delay,
+    and one interrupted by a restart runs again after startup, as do actions that became due while the bot was
+    offline. In cluster mode, every process only loads the actions of the guilds it owns.
+    """
+
+    # Delay before retrying a failed action, doubled on every failure up to the maximum
+    retry_delay = 60
+    max_retry_delay = 60 * 60
+
+    def __init__(self, execute: Callable[[db.ScheduledAction], Awaitable[None]],
+                 owns_guild: Callable[[int], bool] = lambda guild_id: True):
+        self.execute = execute
+        self.owns_guild = owns_guild
+        self.pending: dict[int, db.ScheduledAction] = {}
+        self.heap: list[tuple[int, int]] = []
+        self.failures: dict[int, int] = {}
+        self.wakeup = asyncio.Event()
+        self.task: asyncio.Task | None = None
+
+    def start(self) -> None:
+        for scheduled_action in db.get_scheduled_actions():
+            if self.owns_guild(scheduled_action.guild_id):
+                self._push(scheduled_action)
+        self.task = asyncio.get_running_loop().create_task(self._run())
+
+    def stop(self) -> None:
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    def _push(self, scheduled_action: db.ScheduledAction) -> None:
+        self.pending[scheduled_action.action_id] = scheduled_action
+        heapq.heappush(self.heap, (scheduled_action.due_time, scheduled_action.action_id))
+
+    def schedule(self, guild_id: int, user_id: int, action: str, due_time: int, data: str | None = None) -> None:
+        self._push(db.add_scheduled_action(guild_id, user_id, action, due_time, data))
+        # Let the task recheck which action is due first
+        self.wakeup.set()
+
+    def cancel(self, guild_id: int, user_id: int, action: str) -> None:
+        # Cancelled actions stay in the heap until they reach the top, and are then skipped
+        for action_id in db.remove_scheduled_actions_for_user(guild_id, user_id, action):
+            self.pending.pop(action_id, None)
+
+    def cancel_many(self, guild_id: int, user_ids: List[int], action: str) -> None:
+        for action_id in db.remove_scheduled_actions_for_users(guild_id, user_ids, action):
+            self.pending.pop(action_id, None)
+
+    async def _run(self) -> None:
+        while True:
+            self.wakeup.clear()
+
+            if len(self.heap) == 0:
+                await self.wakeup.wait()
+                continue
+
+            due_time, action_id = self.heap[0]
+            if action_id not in self.pending:
+                heapq.heappop(self.heap)
+                continue
+
+            delay = due_time - time.time()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            heapq.heappop(self.heap)
+            # Stays pending while it runs, so a cancel in the meantime is noticed
+            scheduled_action = self.pending[action_id]
+            try:
+                await self.execute(scheduled_action)
+            except Exception:
+                failures = self.failures.get(action_id, 0) + 1
+                self.failures[action_id] = failures
+                retry_delay = min(self.retry_delay * 2 ** (failures - 1), self.max_retry_delay)
+                _log.exception('Failed to run scheduled action %s (failure %s); retrying in %ss', scheduled_action,
+                               failures, retry_delay,
+                               extra={'guild_id': scheduled_action.guild_id, 'event': scheduled_action.action})
+                # The due time in the DB is left as is, so after a restart it is tried again right away
+                if action_id in self.pending:
+                    heapq.heappush(self.heap, (int(time.time()) + retry_delay, action_id))
+                else:
+                    self.failures.pop(action_id, None)
+                continue
+
+            self.failures.pop(action_id, None)
+            self.pending.pop(action_id, None)
+            db.remove_scheduled_action(action_id)
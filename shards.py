@@ -0,0 +1,125 @@
+import discord
+import datetime
+import logging
+import os
+
+from time import monotonic
+from typing import List
+
+from discord.ext import commands, tasks
+
+import metrics
+
+_log = logging.getLogger(__name__)
+
+
+# Set by cluster.py for every worker process; the first one also does the work only one process should do
+cluster_id = int(os.environ.get('CLUSTER_ID', '0'))
+
+
+def is_primary_cluster() -> bool:
+    return cluster_id == 0
+
+
+def owns_guild(bot: commands.AutoShardedBot, guild_id: int) -> bool:
+    """Whether a guild is on one of the shards of this process; works before the shards are connected."""
+    if bot.shard_ids is None:
+        return True
+    return (guild_id >> 22) % bot.shard_count in bot.shard_ids
+
+
+def get_shard_guilds(bot: commands.AutoShardedBot, shard_id: int) -> List[discord.Guild]:
+    return [guild for guild in bot.guilds if guild.shard_id == shard_id]
+
+
+def get_guilds_by_shard(bot: commands.AutoShardedBot) -> dict[int, List[discord.Guild]]:
+    """The guilds of every shard of this process, in a single pass over the guilds."""
+    guilds_by_shard: dict[int, List[discord.Guild]] = {shard_id: [] for shard_id in bot.shards}
+    for guild in bot.guilds:
+        guilds_by_shard.setdefault(guild.shard_id, []).append(guild)
+    return guilds_by_shard
+
+
+class ShardStats:
+    def __init__(self):
+        self.connects = 0
+        self.disconnects = 0
+        self.resumes = 0
+        self.last_connect_time: datetime.datetime | None = None
+
+
+class ShardHealthCog(commands.Cog):
+    def __init__(self, bot):
+        self.bot = bot
+        self.shard_stats: dict[int, ShardStats] = {}
+        # Gateway events per second of the whole process; discord.py does not say which shard an event came from
+        self.events_per_second = 0.0
+        self.last_event_count: float | None = None
+        self.last_event_count_time: float | None = None
+        self.sample_event_rates.start()
+
+    async def cog_unload(self) -> None:
+        self.sample_event_rates.cancel()
+
+    def get_shard_stats(self, shard_id: int) -> ShardStats:
+        if shard_id not in self.shard_stats:
+            self.shard_stats[shard_id] = ShardStats()
+        return self.shard_stats[shard_id]
+
+    @commands.Cog.listener()
+    async def on_shard_connect(self, shard_id: int) -> None:
+        stats = self.get_shard_stats(shard_id)
+        stats.connects += 1
+        stats.last_connect_time = datetime.datetime.now(datetime.timezone.utc)
+        # Anything after the first connect is a reconnect with a new session
+        if stats.connects > 1:
+            _log.warning('Shard %s reconnected (reconnect %s)', shard_id, stats.connects - 1)
+
+    @commands.Cog.listener()
+    async def on_shard_disconnect(self, shard_id: int) -> None:
+        self.get_shard_stats(shard_id).disconnects += 1
+        _log.warning('Shard %s disconnected', shard_id)
+
+    @commands.Cog.listener()
+    async def on_shard_resumed(self, shard_id: int) -> None:
+        self.get_shard_stats(shard_id).resumes += 1
+        _log.info('Shard %s resumed', shard_id)
+
+    @tasks.loop(seconds=30)
+    async def sample_event_rates(self) -> None:
+        # The gateway event counter of the metrics is kept anyway, so sampling it adds nothing per event
+        event_count = sum(metrics.gateway_events.values.values())
+        now = monotonic()
+        if self.last_event_count is not None:
+            self.events_per_second = (event_count - self.last_event_count) / (now - self.last_event_count_time)
+        self.last_event_count = event_count
+        self.last_event_count_time = now
+
+    @sample_event_rates.before_loop
+    async def before_sample_event_rates(self) -> None:
+        await self.bot.wait_until_ready()
+
+    @commands.hybrid_command(name='shards', description='Get the health of the gateway connections of the bot.')
+    async def shards(self, ctx: commands.Context) -> None:
+        embed = discord.Embed(title='Shards', colour=discord.Colour.blue())
+        description = (f'{len(self.bot.shards)} of {self.bot.shard_count} shards run in this process, '
+                       f'receiving {self.events_per_second:.1f} events/s.\n')
+
+        # One line per shard rather than a field each, since embeds take at most 25 fields
+        guilds_by_shard = get_guilds_by_shard(self.bot)
+        sorted_shards = sorted(self.bot.shards.items())
+        for index, (shard_id, shard) in enumerate(sorted_shards):
+            stats = self.get_shard_stats(shard_id)
+            status = 'closed' if shard.is_closed() else f'{round(shard.latency * 1000)}ms'
+            line = (f'\n**Shard {shard_id}**'
+                    f'{' (this guild)' if ctx.guild is not None and ctx.guild.shard_id == shard_id else ''}: '
+                    f'{status}, {len(guilds_by_shard[shard_id])} guilds, '
+                    f'{max(stats.connects - 1, 0)} reconnects, {stats.resumes} resumes')
+            more = f'\n... and {len(sorted_shards) - index} more shards'
+            if len(description) + len(line) + len(more) > 4096:
+                description += more
+                break
+            description += line
+
+        embed.description = description
+        await ctx.send(embed=embed)
@@ -0,0 +1,33 @@
+import re
+from typing import Callable
+
+import discord
+from discord.ext import commands
+
+# Placeholders a tag can contain; everything else, including other text in braces such as code, is kept as-is
+PLACEHOLDERS: dict[str, Callable[[commands.Context], str]] = {
+    'user': lambda ctx: ctx.author.mention,
+    'user_name': lambda ctx: ctx.author.display_name,
+    'channel': lambda ctx: ctx.channel.mention if isinstance(ctx.channel, discord.abc.GuildChannel) else '',
+    'server': lambda ctx: ctx.guild.name if ctx.guild is not None else '',
+}
+
+_PLACEHOLDER_PATTERN = re.compile('{(' + '|'.join(PLACEHOLDERS) + ')}')
+
+
+class TagTemplate:
+    """Tag content split once into literal text and placeholders, so rendering is a single join."""
+
+    def __init__(self, content: str):
+        self.content = content
+        # re.split with a group alternates text and placeholder names, starting and ending with text
+        self.parts = _PLACEHOLDER_PATTERN.split(content)
+
+    @property
+    def is_static(self) -> bool:
+        return len(self.parts) == 1
+
+    def render(self, ctx: commands.Context) -> str:
+        if self.is_static:
+            return self.content
+        return ''.join(part if index % 2 == 0 else PLACEHOLDERS[part](ctx) for index, part in enumerate(self.parts))
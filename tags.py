@@ -1,47 +1,58 @@
 import discord
 import math
 
-from discord.ext import commands
+from discord.ext import commands, tasks
 from discord import app_commands
+from typing import Literal
 
 import db
+import metrics
+from tag_templates import TagTemplate
 
 class TagCog(commands.Cog):
     class TagPaginationView(discord.ui.View):
-        def __init__(self, tags: dict[str, str], per_page: int = 25):
+        def __init__(self, guild: discord.Guild, by_popularity: bool = False, per_page: int = 25):
             super().__init__(timeout=180)  # 3 minute timeout
-            self.tags = tags
+            self.guild = guild
+            self.by_popularity = by_popularity
             self.per_page = per_page
             self.current_page = 0
-            self.total_pages = math.ceil(len(tags) / per_page)
+            self.total_pages = math.ceil(db.get_guild_tag_count(guild) / per_page)
+            # Only the current page is kept; flipping pages fetches the next one after its last or before its first tag
+            self.page_tags = db.get_guild_tags_page(guild, by_popularity=by_popularity, limit=per_page)
             self.message: discord.Message | None = None
 
         def get_page_content(self) -> discord.Embed:
-            start_idx = self.current_page * self.per_page
-            end_idx = start_idx + self.per_page
-            current_tags_keys = list(self.tags.keys())[start_idx:end_idx]
-
             embed = discord.Embed(title="Server Tags")
-            for tag_name in current_tags_keys:
-                embed.add_field(name=tag_name, value=self.tags[tag_name][:20] + '...' if len(self.tags[tag_name]) > 20 else self.tags[tag_name], inline=False)
+            for tag_name, tag_preview, tag_uses in self.page_tags:
+                embed.add_field(name=f'{tag_name} ({tag_uses} uses)' if self.by_popularity else tag_name,
+                                value=tag_preview, inline=False)
             embed.set_footer(text=f"Page {self.current_page + 1}/{self.total_pages}")
             return embed
 
         @discord.ui.button(label="Previous", style=discord.ButtonStyle.gray)
         async def previous_button(self, interaction: discord.Interaction, button: discord.ui.Button) -> None:
-            if self.current_page > 0:
-                self.current_page -= 1
-                await interaction.response.edit_message(embed=self.get_page_content(), view=self)
-            else:
-                await interaction.response.defer()
+            if self.current_page > 0 and len(self.page_tags) > 0:
+                page_tags = db.get_guild_tags_page(self.guild, before_tag=(self.page_tags[0][0], self.page_tags[0][2]),
+                                                   by_popularity=self.by_popularity, limit=self.per_page)
+                if len(page_tags) > 0:
+                    self.page_tags = page_tags
+                    self.current_page -= 1
+                    await interaction.response.edit_message(embed=self.get_page_content(), view=self)
+                    return
+            await interaction.response.defer()
 
         @discord.ui.button(label="Next", style=discord.ButtonStyle.gray)
         async def next_button(self, interaction: discord.Interaction, button: discord.ui.Button) -> None:
-            if self.current_page < self.total_pages - 1:
-                self.current_page += 1
-                await interaction.response.edit_message(embed=self.get_page_content(), view=self)
-            else:
-                await interaction.response.defer()
+            if self.current_page < self.total_pages - 1 and len(self.page_tags) > 0:
+                page_tags = db.get_guild_tags_page(self.guild, after_tag=(self.page_tags[-1][0], self.page_tags[-1][2]),
+                                                   by_popularity=self.by_popularity, limit=self.per_page)
+                if len(page_tags) > 0:
+                    self.page_tags = page_tags
+                    self.current_page += 1
+                    await interaction.response.edit_message(embed=self.get_page_content(), view=self)
+                    return
+            await interaction.response.defer()
 
         async def on_timeout(self) -> None:
             # Remove buttons when the view times out
@@ -51,6 +62,29 @@ class TagCog(commands.Cog):
 
     def __init__(self, bot):
         self.bot = bot
+        # Per guild, every tag name and alias to the tag name and compiled template, so using a tag needs no queries
+        self.tag_index: dict[int, dict[str, tuple[str, TagTemplate]]] = {}
+        self.flush_tag_uses.start()
+
+    async def cog_unload(self) -> None:
+        self.flush_tag_uses.cancel()
+        db.flush_tag_uses()
+
+    @tasks.loop(minutes=1)
+    async def flush_tag_uses(self) -> None:
+        # Uses are also flushed as tags get used; this writes out the last ones when tags stop being used for a while
+        db.flush_tag_uses()
+
+    def _get_tag_index(self, guild: discord.Guild) -> dict[str, tuple[str, TagTemplate]]:
+        metrics.record_cache_lookup('tag_index', guild.id in self.tag_index)
+        if guild.id not in self.tag_index:
+            tags, aliases = db.get_guild_tags_and_aliases(guild)
+            index = {tag_name: (tag_name, TagTemplate(tag_content)) for tag_name, tag_content in tags.items()}
+            for alias, tag_name in aliases.items():
+                if tag_name in index:
+                    index[alias] = index[tag_name]
+            self.tag_index[guild.id] = index
+        return self.tag_index[guild.id]
 
     def _create_tag_embed(self, tag_name: str, tag_content: str) -> discord.Embed:
         embed = discord.Embed(title=tag_name)
@@ -63,12 +97,14 @@ class TagCog(commands.Cog):
             await ctx.send('This command can only be used in a guild!', ephemeral=True)
             return
 
-        tag_contents = db.get_guild_tag(ctx.guild, tag_name)
-        if tag_contents is None:
+        tag = self._get_tag_index(ctx.guild).get(tag_name)
+        if tag is None:
             await ctx.send(f'Tag `{tag_name}` not found!', ephemeral=True)
             return
         else:
-            await ctx.send(embed=self._create_tag_embed(tag_name, tag_contents))
+            tag_name, tag_template = tag
+            db.record_tag_use(ctx.guild, tag_name)
+            await ctx.send(embed=self._create_tag_embed(tag_name, tag_template.render(ctx)))
 
     # Good enough for now
     @app_commands.checks.has_permissions(kick_members=True)
@@ -82,7 +118,24 @@ class TagCog(commands.Cog):
             await interaction.response.send_message('Tag content is too long!', ephemeral=True)
             return
 
+        index = self._get_tag_index(interaction.guild)
+        if tag_name in index and index[tag_name][0] != tag_name:
+            await interaction.response.send_message(f'`{tag_name}` is an alias of `{index[tag_name][0]}`!',
+                                                    ephemeral=True)
+            return
+
+        tag_template = TagTemplate(tag_content)
         db.set_guild_tag(interaction.guild, tag_name, tag_content)
+
+        # Tag names are unique over all guilds in the DB, so setting a tag takes it away from any other guild
+        for guild_id in [guild_id for guild_id, other_index in self.tag_index.items()
+                         if guild_id != interaction.guild.id and tag_name in other_index]:
+            del self.tag_index[guild_id]
+
+        index[tag_name] = (tag_name, tag_template)
+        for name, (indexed_tag_name, _) in index.items():
+            if indexed_tag_name == tag_name:
+                index[name] = index[tag_name]
         await interaction.response.send_message(f'Successfully set tag `{tag_name}`')
 
     # Good enough for now
@@ -94,24 +147,84 @@ class TagCog(commands.Cog):
             return
 
         db.remove_guild_tag(interaction.guild, tag_name)
+        index = self._get_tag_index(interaction.guild)
+        for name in [name for name, (indexed_tag_name, _) in index.items() if indexed_tag_name == tag_name]:
+            del index[name]
         await interaction.response.send_message(f'Successfully deleted tag `{tag_name}`')
 
+    # Good enough for now
+    @app_commands.checks.has_permissions(kick_members=True)
     @app_commands.command()
-    async def get_all_tags(self, interaction: discord.Interaction) -> None:
+    async def set_tag_alias(self, interaction: discord.Interaction, alias: str, tag_name: str) -> None:
         if interaction.guild is None:
             await interaction.response.send_message('This command can only be used in a guild!', ephemeral=True)
             return
 
-        tags = db.get_all_guild_tags(interaction.guild)
-        if len(tags) == 0:
-            await interaction.response.send_message('No tags found!', ephemeral=True)
+        index = self._get_tag_index(interaction.guild)
+        if tag_name not in index:
+            await interaction.response.send_message(f'Tag `{tag_name}` not found!', ephemeral=True)
+            return
+        if alias in index and index[alias][0] == alias:
+            await interaction.response.send_message(f'`{alias}` is already a tag!', ephemeral=True)
+            return
+
+        # Aliases of aliases point to the tag itself
+        tag_name = index[tag_name][0]
+        db.set_tag_alias(interaction.guild, alias, tag_name)
+        index[alias] = index[tag_name]
+        await interaction.response.send_message(f'Successfully set `{alias}` as an alias of `{tag_name}`')
+
+    # Good enough for now
+    @app_commands.checks.has_permissions(kick_members=True)
+    @app_commands.command()
+    async def delete_tag_alias(self, interaction: discord.Interaction, alias: str) -> None:
+        if interaction.guild is None:
+            await interaction.response.send_message('This command can only be used in a guild!', ephemeral=True)
+            return
+
+        index = self._get_tag_index(interaction.guild)
+        if alias not in index or index[alias][0] == alias:
+            await interaction.response.send_message(f'Alias `{alias}` not found!', ephemeral=True)
+            return
+
+        db.remove_tag_alias(interaction.guild, alias)
+        del index[alias]
+        await interaction.response.send_message(f'Successfully deleted alias `{alias}`')
+
+    @app_commands.command()
+    @app_commands.describe(sort='Sort the tags by name or by how often they are used.')
+    async def get_all_tags(self, interaction: discord.Interaction, sort: Literal['name', 'popularity'] = 'name') -> None:
+        if interaction.guild is None:
+            await interaction.response.send_message('This command can only be used in a guild!', ephemeral=True)
             return
 
         # Create the pagination view
-        view = self.TagPaginationView(tags)
+        if sort == 'popularity':
+            db.flush_tag_uses()
+        view = self.TagPaginationView(interaction.guild, by_popularity=sort == 'popularity')
+        if len(view.page_tags) == 0:
+            await interaction.response.send_message('No tags found!', ephemeral=True)
+            return
+
         # Send initial message
         await interaction.response.send_message(embed=view.get_page_content(), view=view)
         # Store the message for timeout handling
         view.message = await interaction.original_response()
 
+    @app_commands.command()
+    async def tag_stats(self, interaction: discord.Interaction) -> None:
+        if interaction.guild is None:
+            await interaction.response.send_message('This command can only be used in a guild!', ephemeral=True)
+            return
+
+        top_tags = db.get_top_tags(interaction.guild)
+        if len(top_tags) == 0:
+            await interaction.response.send_message('No tags have been used yet!', ephemeral=True)
+            return
 
+        embed = discord.Embed(title="Most used tags")
+        embed.description = '\n'.join(
+            f'**{tag_name}** - {uses} uses, last <t:{int(last_used_time.timestamp())}:R>'
+            if last_used_time is not None else f'**{tag_name}** - {uses} uses'
+            for tag_name, uses, last_used_time in top_tags)
+        await interaction.response.send_message(embed=embed)